@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Stand-in for the NCIPlot and cuNCI binaries, used by the benchmarks.
+
+    fake_nciplot.py [--cuda] input.nci
+
+It reads the `.nci` input like the real programs, writes synthetic cube
+and `.dat` files where they would, and prints matching stdout. The CUDA
+flavour is used with `--cuda` or if the program name contains "cuda".
+
+Environment variables:
+
+    FAKE_NCIPLOT_POINTS     Grid points along each axis (default: 48).
+    FAKE_NCIPLOT_RATE       Simulated throughput, in grid points per second.
+                            If unset, no time is spent besides writing files.
+    FAKE_NCIPLOT_PROGRESS   Number of percentage lines to print (default: 10).
+"""
+
+from __future__ import print_function, division
+# Python stdlib
+import os
+import sys
+import time
+# Additional 3rd parties
+import numpy as np
+# Own
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import synthetic  # noqa
+
+
+def parse_nci_input(path):
+    """
+    Molecule paths and keywords of a `.nci` file.
+
+    Returns
+    -------
+    xyz : list of str
+    options : dict
+        Keyword (upper case) -> list of str values.
+    """
+    with open(path) as f:
+        lines = [line.strip() for line in f if line.strip()]
+    n_files = int(lines[0])
+    xyz = lines[1:1 + n_files]
+    options = {}
+    for line in lines[1 + n_files:]:
+        fields = line.split('#')[0].split()
+        if fields:
+            options[fields[0].upper()] = fields[1:]
+    return xyz, options
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    cuda = '--cuda' in argv or 'cuda' in os.path.basename(sys.argv[0]).lower()
+    args = [a for a in argv if not a.startswith('--')]
+    if not args:
+        print(__doc__)
+        return 1
+    nci_file = os.path.abspath(args[0])
+    xyz, options = parse_nci_input(nci_file)
+    xyz = [os.path.join(os.path.dirname(nci_file), p) for p in xyz]
+    coords = np.concatenate([synthetic.read_xyz(p)[1] for p in xyz])
+    points = int(os.environ.get('FAKE_NCIPLOT_POINTS', 48))
+    shape = (points,) * 3
+    if 'CUBE' in options:  # the grid spans the requested box only
+        box = np.array(options['CUBE'], dtype=float).reshape(2, 3)
+        origin, spacing = synthetic.grid_for(box, points, padding=0.0)
+    else:
+        origin, spacing = synthetic.grid_for(coords, points)
+    name = options.get('ONAME', [os.path.splitext(os.path.basename(nci_file))[0]])[0]
+    dat_cutoffs = [float(x) for x in options.get('CUTOFFS', (0.2, 1.0))]
+    cube_cutoffs = [float(x) for x in options.get('CUTPLOT', (0.07, 0.3))]
+    n_progress = int(os.environ.get('FAKE_NCIPLOT_PROGRESS', 10))
+    rate = float(os.environ.get('FAKE_NCIPLOT_RATE', 0) or 0)
+
+    if cuda:
+        lines = synthetic.cuda_stdout(name, xyz, origin, spacing, shape, cube_cutoffs,
+                                      n_progress)
+        outputs = synthetic.cuda_outputs(name, xyz)
+    else:
+        lines = synthetic.cpu_stdout(name, xyz, origin, spacing, shape, cube_cutoffs,
+                                     n_progress)
+        outputs = [os.path.join(os.getcwd(), name + suffix)
+                   for suffix in ('-grad.cube', '-dens.cube', '.dat')]
+    # Progress lines are printed while the grid is "computed"
+    progress = [i for i, line in enumerate(lines) if '%' in line]
+    first, last = (progress[0], progress[-1] + 1) if progress else (len(lines), len(lines))
+    _emit(lines[:first])
+    seconds = np.prod(shape) / rate if rate else 0.0
+    for line in lines[first:last]:
+        time.sleep(seconds / max(len(progress), 1))
+        _emit([line])
+    if not progress:
+        time.sleep(seconds)
+    synthetic.write_outputs(*outputs, shape=shape, origin=origin, spacing=spacing,
+                            coords=coords, dat_cutoffs=dat_cutoffs, cube_cutoffs=cube_cutoffs)
+    _emit(lines[last:])
+    return 0
+
+
+def _emit(lines):
+    sys.stdout.write(''.join(lines))
+    sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
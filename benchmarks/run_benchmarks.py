@@ -0,0 +1,409 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Time the NCIPlot pipeline across system and grid sizes, without Chimera
+nor the real NCIPlot binaries.
+
+    python benchmarks/run_benchmarks.py [--atoms 100,1000] [--points 32,64]
+                                        [--repeat 3] [--only read_cube,...]
+                                        [--json results.json]
+
+Chimera-free steps (input generation, running and parsing the stand-in
+binaries, cube loading, sparse storage, histograms) run on any Python
+with NumPy. Steps of `nciplot.core` (XYZ export, drawing, coloring,
+plotting, the whole GUI pipeline) use the stand-ins in `stubs/` and need
+the interpreter Chimera ships (Python 2.7) with matplotlib; otherwise,
+they are reported as skipped.
+"""
+
+from __future__ import print_function, division
+# Python stdlib
+import argparse
+import json
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import timeit
+# Additional 3rd parties
+import numpy as np
+# Own
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+os.environ.setdefault('TANGRAM_NCIPLOT_STAGES_LOG', '')  # keep benchmark runs out of the log
+import synthetic  # noqa
+from nciplot.contributions import atom_contributions  # noqa
+from nciplot.cube import read_cube, load_cube, sidecar_path  # noqa
+from nciplot.histogram import dat_histogram, cached_histogram  # noqa
+from nciplot.runner import (create_nci_input, parse_stdout_cpu, parse_stdout_cuda,  # noqa
+                            run_nciplot, ProgressTracker)
+from nciplot.sparse import SparseVolume  # noqa
+from nciplot.xyz import write_xyz as nciplot_write_xyz  # noqa
+
+
+BENCHMARKS = []
+
+
+def benchmark(group, sizes):
+    """
+    Register a benchmark. `sizes` is 'atoms' or 'points': the command
+    line option whose values are passed to the function, which must
+    return a (setup, run) pair of callables or raise `Skip`.
+    """
+    def decorator(f):
+        BENCHMARKS.append((f.__name__, group, sizes, f))
+        return f
+    return decorator
+
+
+class Skip(Exception):
+    pass
+
+
+class Workspace(object):
+
+    """
+    Temporary directory with synthetic molecules and NCIPlot outputs,
+    created on demand and reused across benchmarks.
+    """
+
+    def __init__(self):
+        self.path = tempfile.mkdtemp(prefix='nciplot-bench-')
+        self._molecules = {}
+        self._outputs = {}
+        self._binaries = {}
+
+    def molecule(self, n_atoms):
+        if n_atoms not in self._molecules:
+            elements, coords = synthetic.molecule(n_atoms)
+            path = os.path.join(self.path, 'mol{}.xyz'.format(n_atoms))
+            synthetic.write_xyz(path, elements, coords)
+            self._molecules[n_atoms] = path, elements, coords
+        return self._molecules[n_atoms]
+
+    def outputs(self, points, n_atoms=200):
+        """
+        Paths of the gradient and density cubes and the `.dat` file for a
+        grid of `points`**3 voxels.
+        """
+        if points not in self._outputs:
+            _, _, coords = self.molecule(n_atoms)
+            origin, spacing = synthetic.grid_for(coords, points)
+            prefix = os.path.join(self.path, 'out{}'.format(points))
+            paths = prefix + '-grad.cube', prefix + '-dens.cube', prefix + '.dat'
+            synthetic.write_outputs(*paths, shape=(points,) * 3, origin=origin,
+                                    spacing=spacing, coords=coords)
+            self._outputs[points] = paths
+        return self._outputs[points]
+
+    def binary(self, flavour, points):
+        """
+        Executable wrapper around `fake_nciplot.py`, named like the real
+        binary of `flavour` ('nciplot' or 'cuda_nci').
+        """
+        key = flavour, points
+        if key not in self._binaries:
+            directory = os.path.join(self.path, 'bin{}'.format(points))
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            path = os.path.join(directory, flavour)
+            with open(path, 'w') as f:
+                f.write('#!/bin/sh\nFAKE_NCIPLOT_POINTS={} exec "{}" "{}"{} "$@"\n'.format(
+                        points, sys.executable, os.path.join(HERE, 'fake_nciplot.py'),
+                        ' --cuda' if 'cuda' in flavour else ''))
+            os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+            self._binaries[key] = path
+        return self._binaries[key]
+
+    def workdir(self, name):
+        path = tempfile.mkdtemp(prefix=name + '-', dir=self.path)
+        return path
+
+    def cleanup(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+# Chimera-free benchmarks
+
+@benchmark('input', 'atoms')
+def create_input(ws, n_atoms):
+    path = ws.molecule(n_atoms)[0]
+    paths = [path] * 2
+    return None, lambda: create_nci_input(paths, intermolecular=0.95, radius=(0, 0, 0, 5),
+                                          increments=(0.1, 0.1, 0.1), name='bench').read()
+
+
+@benchmark('input', 'atoms')
+def write_xyz(ws, n_atoms):
+    _, elements, coords = ws.molecule(n_atoms)
+    path = os.path.join(ws.path, 'write.xyz')
+    return None, lambda: nciplot_write_xyz(path, elements, coords)
+
+
+def _stdout(ws, points, flavour):
+    path, _, coords = ws.molecule(200)
+    origin, spacing = synthetic.grid_for(coords, points)
+    make = synthetic.cuda_stdout if flavour == 'cuda' else synthetic.cpu_stdout
+    # one progress line per plane, the worst case for the progress tracker
+    return make('bench', [path], origin, spacing, (points,) * 3, progress_lines=points)
+
+
+@benchmark('parse', 'points')
+def parse_cpu(ws, points):
+    lines = _stdout(ws, points, 'cpu')
+    return None, lambda: parse_stdout_cpu(lines, ws.path)
+
+
+@benchmark('parse', 'points')
+def parse_cuda(ws, points):
+    lines = _stdout(ws, points, 'cuda')
+    return None, lambda: parse_stdout_cuda(lines, ws.path)
+
+
+@benchmark('parse', 'points')
+def progress_tracker(ws, points):
+    lines = _stdout(ws, points, 'cpu')
+
+    def run():
+        tracker = ProgressTracker()
+        for line in lines:
+            tracker.feed(line)
+        return tracker.status()
+    return None, run
+
+
+def _run_binary(ws, points, flavour):
+    binary = ws.binary(flavour, points)
+    xyz = [ws.molecule(200)[0]]
+
+    def run():
+        workdir = ws.workdir(flavour)
+        data = run_nciplot(binary, xyz, workdir, name='bench')
+        assert os.path.isfile(data['grad_cube']) and os.path.isfile(data['xy_data']), data
+        return data
+    return None, run
+
+
+@benchmark('nciplot', 'points')
+def run_nciplot_cpu(ws, points):
+    return _run_binary(ws, points, 'nciplot')
+
+
+@benchmark('nciplot', 'points')
+def run_nciplot_cuda(ws, points):
+    return _run_binary(ws, points, 'cuda_nci')
+
+
+@benchmark('cubes', 'points')
+def read_cube_text(ws, points):
+    grad = ws.outputs(points)[0]
+    return None, lambda: read_cube(grad)
+
+
+@benchmark('cubes', 'points')
+def load_cube_cold(ws, points):
+    grad = ws.outputs(points)[0]
+
+    def setup():
+        if os.path.exists(sidecar_path(grad)):
+            os.remove(sidecar_path(grad))
+    return setup, lambda: load_cube(grad)
+
+
+@benchmark('cubes', 'points')
+def load_cube_sidecar(ws, points):
+    grad = ws.outputs(points)[0]
+    return (lambda: load_cube(grad)), lambda: np.asarray(load_cube(grad).data).sum()
+
+
+@benchmark('sparse', 'points')
+def sparse_save(ws, points):
+    grad, dens, _ = ws.outputs(points)
+    cubes = read_cube(grad), read_cube(dens)
+    path = os.path.join(ws.path, 'sparse{}.npz'.format(points))
+    return None, lambda: SparseVolume.from_cubes(*cubes).save(path)
+
+
+@benchmark('sparse', 'points')
+def sparse_load_dense(ws, points):
+    grad, dens, _ = ws.outputs(points)
+    path = os.path.join(ws.path, 'sparse{}.npz'.format(points))
+    return ((lambda: SparseVolume.from_cubes(read_cube(grad), read_cube(dens)).save(path)),
+            lambda: SparseVolume.load(path).cube('grad'))
+
+
+@benchmark('plot', 'points')
+def histogram_stream(ws, points):
+    dat = ws.outputs(points)[2]
+    return None, lambda: dat_histogram(dat)
+
+
+@benchmark('plot', 'points')
+def histogram_cached(ws, points):
+    dat = ws.outputs(points)[2]
+    return (lambda: cached_histogram(dat)), lambda: cached_histogram(dat)
+
+
+@benchmark('analysis', 'points')
+def contributions(ws, points):
+    grad, dens, _ = ws.outputs(points)
+    cubes = read_cube(grad), read_cube(dens)
+    return None, lambda: atom_contributions(*cubes, isovalue=0.3, n_nearest=2)
+
+
+# Benchmarks of nciplot.core, with the Chimera stand-ins
+
+def _core():
+    sys.path.insert(0, os.path.join(HERE, 'stubs'))
+    try:
+        import nciplot.core as core
+    except ImportError as e:
+        raise Skip('nciplot.core cannot be imported here ({}); it needs Python 2.7, '
+                   'as in Chimera, and matplotlib'.format(e))
+    return core
+
+
+def _atoms(ws, n_atoms):
+    import chimera
+    _, elements, coords = ws.molecule(n_atoms)
+    return chimera.Molecule('bench', elements, coords).atoms
+
+
+class _GUI(object):
+
+    def __init__(self):
+        self.done = False
+
+    def _run_nciplot_cb(self, controller):
+        self.done = True
+
+    _run_nciplot_clear_cb = _run_nciplot_cb
+
+
+@benchmark('core', 'atoms')
+def atoms2xyz(ws, n_atoms):
+    core = _core()
+    atoms = _atoms(ws, n_atoms)
+    path = os.path.join(ws.path, 'atoms.xyz')
+    return None, lambda: core.atoms2xyz(atoms, path)
+
+
+@benchmark('core', 'points')
+def draw_and_style(ws, points):
+    core = _core()
+    grad, dens, _ = ws.outputs(points)
+    controller = core.Controller(gui=_GUI(), nciplot_binary=ws.binary('nciplot', points),
+                                 nciplot_dat=ws.path, cache=False)
+    cubes = load_cube(grad), load_cube(dens)
+
+    def run():
+        values_range = core.surface_value_range(*cubes)
+        controller.surface, controller.density = controller.draw_cubes(*cubes)
+        controller.style_surface(values_range=values_range)
+    return None, run
+
+
+@benchmark('core', 'points')
+def plot(ws, points):
+    core = _core()
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib.figure import Figure
+    controller = core.Controller(gui=_GUI(), nciplot_binary=ws.binary('nciplot', points),
+                                 nciplot_dat=ws.path, cache=False)
+    controller.data = {'xy_data': ws.outputs(points)[2]}
+    return None, lambda: controller.plot(Figure().add_subplot(111))
+
+
+def _pipeline(ws, points, flavour):
+    core = _core()
+    import chimera
+    atoms = _atoms(ws, 200)
+
+    def run():
+        gui = _GUI()
+        controller = core.Controller(gui=gui, nciplot_binary=ws.binary(flavour, points),
+                                     nciplot_dat=ws.path, cache=False)
+        controller.run(atoms=atoms)
+        chimera.tkgui.app.run_until(lambda: gui.done)
+        assert controller.surface is not None, 'NCIPlot results were not drawn'
+    return None, run
+
+
+@benchmark('core', 'points')
+def pipeline_cpu(ws, points):
+    return _pipeline(ws, points, 'nciplot')
+
+
+@benchmark('core', 'points')
+def pipeline_cuda(ws, points):
+    return _pipeline(ws, points, 'cuda_nci')
+
+
+def measure(setup, run, repeat):
+    """
+    Best and mean wall time of `repeat` calls to `run`, each one after
+    calling `setup` (not timed), if given.
+    """
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = timeit.default_timer()
+        run()
+        times.append(timeit.default_timer() - start)
+    return min(times), sum(times) / len(times)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--atoms', default='100,1000,10000',
+                        help='Comma-separated numbers of atoms (default: %(default)s)')
+    parser.add_argument('--points', default='32,64,128',
+                        help='Comma-separated grid points per axis (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', help='Comma-separated benchmark or group names')
+    parser.add_argument('--json', help='Also write the results to this file')
+    parser.add_argument('--keep', action='store_true', help='Keep the temporary files')
+    args = parser.parse_args(argv)
+    sizes = {'atoms': [int(n) for n in args.atoms.split(',')],
+             'points': [int(n) for n in args.points.split(',')]}
+    only = set(args.only.split(',')) if args.only else None
+
+    ws = Workspace()
+    results = []
+    print('{:<20} {:>8} {:>8} {:>12} {:>12}'.format('benchmark', 'size', '', 'best (s)',
+                                                  'mean (s)'))
+    try:
+        for name, group, size_kind, f in BENCHMARKS:
+            if only and name not in only and group not in only:
+                continue
+            for size in sizes[size_kind]:
+                result = {'benchmark': name, 'group': group, size_kind: size}
+                try:
+                    setup, run = f(ws, size)
+                    result['best'], result['mean'] = measure(setup, run, args.repeat)
+                except Skip as e:
+                    result['skipped'] = str(e)
+                    print('{:<20} skipped: {}'.format(name, e))
+                    results.append(result)
+                    break
+                print('{:<20} {:>8} {:<8} {:>12.4f} {:>12.4f}'.format(
+                      name, size, size_kind, result['best'], result['mean']))
+                results.append(result)
+    finally:
+        if args.keep:
+            print('Files kept in', ws.path)
+        else:
+            ws.cleanup()
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'python': sys.version.split()[0], 'numpy': np.__version__,
+                       'repeat': args.repeat, 'results': results}, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,13 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+from __future__ import print_function, division
+# Python stdlib
+import os
+import tempfile
+
+
+def osTemporaryFile(prefix='tmp', suffix=''):
+    fd, path = tempfile.mkstemp(prefix=prefix, suffix=suffix)
+    os.close(fd)
+    return path
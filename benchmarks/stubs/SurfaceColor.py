@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Stand-in for volume coloring. `color_by_volume` maps the values of the
+coloring volume to colors with NumPy, which gives a comparable workload.
+"""
+
+from __future__ import print_function, division
+# Additional 3rd parties
+import numpy as np
+
+standard_color_palettes = {'rainbow': ((0, 0, 1, 1), (0, 1, 0, 1), (1, 0, 0, 1))}
+
+
+class Volume_Color(object):
+
+    def set_volume(self, volume):
+        self.volume = volume
+
+    def value_range(self, surface_piece):
+        values = np.asarray(self.volume.data.array)
+        if not values.size:
+            return None, None
+        return float(values.min()), float(values.max())
+
+
+class Gradient_Color(Volume_Color):
+    pass
+
+
+def color_by_volume(surface, volume, values, palette, auto_update=True):
+    data = np.asarray(volume.data.array).ravel()
+    colors = np.array(palette, dtype=float)
+    positions = np.interp(data, values, np.arange(len(values)))
+    surface.vertex_colors = colors[np.clip(np.rint(positions).astype(int), 0, len(colors) - 1)]
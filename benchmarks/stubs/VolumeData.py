@@ -0,0 +1,18 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+from __future__ import print_function, division
+
+
+class Array_Grid_Data(object):
+
+    """
+    Keeps a reference to a [z, y, x] array, like VolumeData does.
+    """
+
+    def __init__(self, array, origin=(0, 0, 0), step=(1, 1, 1), name=''):
+        self.array = array
+        self.origin = origin
+        self.step = step
+        self.name = name
+        self.size = tuple(reversed(array.shape))
@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Stand-in volume model. Surface pieces only know the value range of the
+grid, which is enough for `SurfaceColor.Volume_Color.value_range`.
+"""
+
+from __future__ import print_function, division
+# Python stdlib
+import chimera
+
+
+class SurfacePiece(object):
+
+    def __init__(self, volume):
+        self.volume = volume
+
+
+class Volume(object):
+
+    def __init__(self, grid, model_id=None):
+        self.data = grid
+        self.model_id = model_id
+        self.surface_levels = []
+        self.surface_colors = [(1, 1, 1, 1), (1, 1, 1, 1)]
+        self.display = True
+        self.shown = False
+        self.region = ((0, 0, 0), tuple(n - 1 for n in grid.size), (1, 1, 1))
+        self.surfacePieces = [SurfacePiece(self)]
+
+    def show(self):
+        self.shown = True
+
+    def unshow(self):
+        self.shown = False
+
+    def new_region(self, ijk_min, ijk_max, ijk_step, adjust_step=True, show=True):
+        self.region = (tuple(ijk_min), tuple(ijk_max), tuple(ijk_step))
+
+
+def volume_from_grid_data(grid, show_dialog=True, model_id=None):
+    volume = Volume(grid, model_id=model_id)
+    chimera.openModels.models.append(volume)
+    return volume
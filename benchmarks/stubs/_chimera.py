@@ -0,0 +1,13 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+from __future__ import print_function, division
+
+
+class MaterialColor(object):
+
+    def __init__(self, *rgba):
+        self._rgba = rgba
+
+    def rgba(self):
+        return self._rgba
@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Stand-in for Chimera's subprocess monitor: `afterCB` is called from the
+stub event loop once the process exits.
+"""
+
+from __future__ import print_function, division
+# Python stdlib
+import subprocess
+from subprocess import PIPE  # noqa
+# Own
+from .tkgui import app
+
+
+class Popen(subprocess.Popen):
+
+    def __init__(self, *args, **kwargs):
+        self.progressCB = kwargs.pop('progressCB', None)
+        super(Popen, self).__init__(*args, **kwargs)
+
+
+def monitor(title, process, task=None, afterCB=None):
+    def poll():
+        if process.poll() is None:
+            app.after(10, poll)
+        elif afterCB is not None:
+            afterCB(False)
+    app.after(10, poll)
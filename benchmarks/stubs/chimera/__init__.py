@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Minimal stand-in for the parts of the `chimera` package used by
+`nciplot.core`, so the pipeline can be timed outside Chimera. Only
+meant for the benchmark suite.
+"""
+
+from __future__ import print_function, division
+# Python stdlib
+import os
+import sys
+
+from . import tkgui, replyobj, selection, triggers, openModels, colorTable  # noqa
+
+
+class UserError(Exception):
+    pass
+
+
+class Molecule(object):
+
+    """
+    Molecule made of `Atom` objects, with a single coordinate set.
+    """
+
+    def __init__(self, name, elements, coords):
+        self.name = name
+        self.atoms = [Atom(self, Element(e), c) for (e, c) in zip(elements, coords)]
+        self.activeCoordSet = CoordSet(1)
+        self.coordSets = {1: self.activeCoordSet}
+
+
+class CoordSet(object):
+
+    def __init__(self, id):
+        self.id = id
+
+
+class Element(object):
+
+    def __init__(self, name):
+        self.name = name
+
+
+class Atom(object):
+
+    def __init__(self, molecule, element, coord):
+        self.molecule = molecule
+        self.element = element
+        self._coord = tuple(float(x) for x in coord)
+
+    def coord(self, coordset=None):
+        return Point(*self._coord)
+
+
+class Point(tuple):
+
+    def __new__(cls, x, y, z):
+        return tuple.__new__(cls, (x, y, z))
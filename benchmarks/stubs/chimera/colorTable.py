@@ -0,0 +1,10 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+from __future__ import print_function, division
+
+colors = {'red': (1, 0, 0, 1), 'green': (0, 1, 0, 1), 'blue': (0, 0, 1, 1)}
+
+
+def getColorByName(name):
+    return colors[name]
@@ -0,0 +1,16 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+from __future__ import print_function, division
+
+models = []
+
+
+def list(modelTypes=None):
+    return models[:]
+
+
+def close(models_to_close):
+    for model in models_to_close:
+        if model in models:
+            models.remove(model)
@@ -0,0 +1,12 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+from __future__ import print_function, division
+import sys
+
+
+def error(msg):
+    sys.stderr.write(msg)
+
+
+warning = info = status = error
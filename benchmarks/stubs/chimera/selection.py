@@ -0,0 +1,10 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+from __future__ import print_function, division
+
+current = []
+
+
+def currentMolecules():
+    return list(current)
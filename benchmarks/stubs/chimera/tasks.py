@@ -0,0 +1,19 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+from __future__ import print_function, division
+
+
+class Task(object):
+
+    def __init__(self, title, cancelCB=None, *args, **kwargs):
+        self.title = title
+        self.cancelCB = cancelCB
+        self.status = None
+        self.done = False
+
+    def updateStatus(self, status):
+        self.status = status
+
+    def finished(self):
+        self.done = True
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Stand-in for Tk's event loop: `app.after` callbacks are queued and run
+by `app.run_until`.
+"""
+
+from __future__ import print_function, division
+# Python stdlib
+import heapq
+import itertools
+import time
+
+
+class _App(object):
+
+    def __init__(self):
+        self._queue = []
+        self._counter = itertools.count()
+
+    def after(self, ms, callback, *args):
+        heapq.heappush(self._queue, (time.time() + ms / 1000.0, next(self._counter),
+                                     callback, args))
+
+    def run_until(self, condition, timeout=600):
+        """
+        Process queued callbacks until `condition()` is true.
+        """
+        deadline = time.time() + timeout
+        while not condition():
+            if time.time() > deadline:
+                raise RuntimeError('Timed out waiting for the event loop')
+            if not self._queue:
+                time.sleep(0.001)
+                continue
+            when, _, callback, args = self._queue[0]
+            delay = when - time.time()
+            if delay > 0:
+                time.sleep(min(delay, 0.01))
+                continue
+            heapq.heappop(self._queue)
+            callback(*args)
+
+
+app = _App()
@@ -0,0 +1,12 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+from __future__ import print_function, division
+
+
+def addHandler(name, callback, data):
+    return (name, callback)
+
+
+def deleteHandler(name, handler):
+    pass
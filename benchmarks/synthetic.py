@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Synthetic inputs and outputs for the benchmarks: molecules, NCIPlot-like
+cube and `.dat` files of any size, and the stdout of both NCIPlot flavours.
+
+Densities are promolecular-like (a sum of exponentials centered on some
+of the atoms) and the RDG is computed from them with the usual formula,
+so cutoffs, sparse storage and histograms behave as with real data.
+"""
+
+from __future__ import print_function, division
+# Python stdlib
+import os
+# Additional 3rd parties
+import numpy as np
+# Own
+from nciplot.cube import write_cube
+from nciplot.promolecular import BOHR
+
+
+ELEMENTS = ('C', 'H', 'H', 'N', 'O', 'H')
+ATOMS_PER_A3 = 0.1  # roughly, that of organic matter
+MAX_CENTERS = 64
+PADDING = 3.0  # Angstrom, around the molecules, as NCIPlot does
+
+
+def molecule(n_atoms, seed=0):
+    """
+    Random atoms at a realistic density, inside a cube.
+
+    Returns
+    -------
+    elements : list of str
+    coords : np.ndarray, shape=(n_atoms, 3)
+        In Angstrom.
+    """
+    rng = np.random.RandomState(seed)
+    side = (n_atoms / ATOMS_PER_A3) ** (1 / 3)
+    coords = rng.uniform(0, side, size=(n_atoms, 3))
+    elements = [ELEMENTS[i % len(ELEMENTS)] for i in range(n_atoms)]
+    return elements, coords
+
+
+def write_xyz(path, elements, coords, name='synthetic'):
+    with open(path, 'w') as f:
+        f.write('{}\n{}\n'.format(len(elements), name))
+        for element, (x, y, z) in zip(elements, coords):
+            f.write('{} {:.6f} {:.6f} {:.6f}\n'.format(element, x, y, z))
+    return path
+
+
+def read_xyz(path):
+    with open(path) as f:
+        n_atoms = int(f.readline())
+        f.readline()
+        elements, coords = [], []
+        for _ in range(n_atoms):
+            fields = f.readline().split()
+            elements.append(fields[0])
+            coords.append([float(x) for x in fields[1:4]])
+    return elements, np.array(coords).reshape(-1, 3)
+
+
+def grid_for(coords, points, padding=PADDING):
+    """
+    Origin and spacing (bohr) of a grid of about `points` voxels along
+    each axis around `coords` (Angstrom).
+    """
+    lo, hi = coords.min(axis=0) - padding, coords.max(axis=0) + padding
+    spacing = (hi - lo) / max(points - 1, 1)
+    return lo / BOHR, spacing / BOHR
+
+
+def nci_fields(shape, origin, spacing, coords, seed=0):
+    """
+    Signed density and RDG on a grid.
+
+    Parameters
+    ----------
+    shape : 3-tuple of int
+    origin, spacing : np.ndarray, shape=(3,)
+        In bohr.
+    coords : np.ndarray, shape=(N, 3)
+        Atoms, in Angstrom. At most `MAX_CENTERS` of them are used.
+
+    Returns
+    -------
+    density, rdg : np.ndarray, shape=shape
+        `density` is sign(lambda2)*rho.
+    """
+    rng = np.random.RandomState(seed)
+    centers = np.asarray(coords) / BOHR
+    if len(centers) > MAX_CENTERS:
+        centers = centers[rng.choice(len(centers), MAX_CENTERS, replace=False)]
+    axes = [origin[i] + spacing[i] * np.arange(shape[i]) for i in range(3)]
+    rho = np.zeros(shape)
+    for center in centers:
+        dx, dy, dz = [(axes[i] - center[i]) ** 2 for i in range(3)]
+        r = np.sqrt(dx[:, None, None] + dy[None, :, None] + dz[None, None, :])
+        rho += 0.3 * np.exp(-1.5 * r)
+    rho = np.maximum(rho, 1e-10)
+    gradient = np.gradient(rho, *spacing)
+    norm = np.sqrt(sum(g * g for g in gradient))
+    rdg = 0.161620459673995 * norm / rho ** (4 / 3)
+    sign = np.sign(np.sin(axes[0] / 2.0))[:, None, None] * np.ones(shape)
+    sign[sign == 0] = 1
+    return sign * rho, rdg
+
+
+def write_outputs(grad_path, dens_path, dat_path, shape, origin, spacing, coords,
+                  dat_cutoffs=(0.2, 1.0), cube_cutoffs=(0.07, 0.3), seed=0):
+    """
+    Write NCIPlot-like output files: the gradient cube (100 where the
+    density is above the cube cutoff), the density cube and the `.dat`
+    points under the dat cutoffs. Like NCIPlot, the density cube holds
+    100*sign(lambda2)*rho.
+
+    Returns
+    -------
+    ranges : dict
+        'rho' and 'rdg' cutoffs, as NCIPlot reports them.
+    """
+    density, rdg = nci_fields(shape, origin, spacing, coords, seed=seed)
+    rho = np.abs(density)
+    grad = np.where(rho > cube_cutoffs[0], 100.0, rdg)
+    numbers = [6] * len(coords)
+    bohr_coords = np.asarray(coords) / BOHR
+    write_cube(grad_path, grad, origin, spacing, numbers, bohr_coords)
+    write_cube(dens_path, 100 * density, origin, spacing, numbers, bohr_coords)
+    keep = (rho < dat_cutoffs[0]) & (rdg < dat_cutoffs[1])
+    write_dat(dat_path, density[keep], rdg[keep])
+    return {'rho': cube_cutoffs[0], 'rdg': cube_cutoffs[1]}
+
+
+def write_dat(path, x, y, batch=2**16):
+    with open(path, 'w') as f:
+        for start in range(0, len(x), batch):
+            chunk = np.column_stack([x[start:start + batch], y[start:start + batch]])
+            f.write(('%17.10E %17.10E\n' * len(chunk)) % tuple(chunk.ravel()))
+    return path
+
+
+def cpu_stdout(name, xyz, origin, spacing, shape, cube_cutoffs=(0.07, 0.3),
+               progress_lines=0):
+    """
+    Lines printed by the CPU NCIPlot for a run named `name`, with
+    `progress_lines` percentage updates while the grid is computed.
+    """
+    far = origin + spacing * (np.array(shape) - 1)
+    lines = [' ' + '-' * 58 + '\n',
+             '      NCIPLOT (benchmark stand-in)\n',
+             ' ' + '-' * 58 + '\n']
+    for i, path in enumerate(xyz):
+        lines.append('  Molecule {}: {}\n'.format(i + 1, path))
+    lines += ['# Operating grid and increments: Grid-1\n',
+              '# x0,y0,z0  = {:12.6f} {:12.6f} {:12.6f}\n'.format(*origin),
+              '# x1,y1,z1  = {:12.6f} {:12.6f} {:12.6f}\n'.format(*far),
+              '# ix,iy,iz  = {:12.6f} {:12.6f} {:12.6f}\n'.format(*spacing),
+              '# nx,ny,nz  = {:6d} {:6d} {:6d}\n'.format(*shape)]
+    for i in range(1, progress_lines + 1):
+        lines.append('  Computing grid ... {:5.1f} %\n'.format(100.0 * i / progress_lines))
+    lines += [' ' + '-' * 58 + '\n',
+              '      Writing output in the following units:\n',
+              '      Molecular positions in bohr, densities in au\n',
+              ' ' + '-' * 58 + '\n',
+              '   LS x RDG                  = {}.dat\n'.format(name),
+              '   Gradient cube file        = {}-grad.cube\n'.format(name),
+              '   Density cube file         = {}-dens.cube\n'.format(name),
+              ' ' + '-' * 58 + '\n',
+              '                      Range of values\n',
+              '   RHO  = {}\n'.format(cube_cutoffs[0]),
+              '   RDG  = {}\n'.format(cube_cutoffs[1]),
+              ' ' + '-' * 58 + '\n']
+    return lines
+
+
+def cuda_stdout(name, xyz, origin, spacing, shape, cube_cutoffs=(0.07, 0.3),
+                progress_lines=0):
+    """
+    Lines printed by cuNCI for a run with output prefix `name`. Like the
+    real program, outputs are written next to the first molecule file.
+    """
+    lines = ['*' * 60 + '\n',
+             '*        cuNCI (benchmark stand-in)\n',
+             '*' * 60 + '\n']
+    for i, path in enumerate(xyz):
+        lines.append('* MoleculeFile[{}]   : {} \n'.format(i, path))
+    lines += ['* OutPut filenam Prefix : {}\n'.format(name),
+              '* Grid : {} {} {} points\n'.format(*shape),
+              '* Increments (bohr) : {:.6f} {:.6f} {:.6f}\n'.format(*spacing)]
+    for i in range(1, progress_lines + 1):
+        lines.append('  kernel {:5.1f} %\n'.format(100.0 * i / progress_lines))
+    lines += ['* .cube rho range : {:.4f} to {:.4f}\n'.format(-cube_cutoffs[0], cube_cutoffs[0]),
+              '* .dat rdg range  : {:.4f} to {:.4f}\n'.format(0.0, cube_cutoffs[1]),
+              '*' * 60 + '\n']
+    return lines
+
+
+def cuda_outputs(name, xyz):
+    """
+    Paths cuNCI writes for output prefix `name`.
+    """
+    basedir = os.path.dirname(xyz[0])
+    return (os.path.join(basedir, name + '-RDG.cube'),
+            os.path.join(basedir, name + '-dens.cube'),
+            os.path.join(basedir, name + '.dat'))
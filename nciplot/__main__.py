@@ -0,0 +1,8 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+from __future__ import print_function, division
+import sys
+from .batch import main
+
+sys.exit(main())
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Headless batch runs, without Chimera.
+
+    python -m nciplot batch INPUT_DIR OUTPUT_DIR [options]
+
+Every XYZ or PDB file in INPUT_DIR is computed in its own subdirectory of
+OUTPUT_DIR, with either the NCIPlot binary or the promolecular NumPy engine,
+using a pool of worker processes. A `summary.tsv` table is written at the end.
+
+With `--receptor`, the input files are ligand poses, screened against a
+single receptor whose promolecular density is computed once (check
+`receptor.ReceptorGrid`).
+"""
+
+from __future__ import print_function, division
+# Python stdlib
+import argparse
+import os
+import time
+from distutils.spawn import find_executable
+from multiprocessing import Pool, cpu_count
+# Additional 3rd parties
+import numpy as np
+# Own
+from .blobs import blob_table, summarize, write_table, KINDS
+from .cube import read_cube
+from .instrument import recorder
+from .promolecular import PromolecularNCI, BOHR
+from .receptor import ReceptorGrid, receptor_grid, evict_receptor_grids
+from .runner import run_nciplot
+from .xyz import read_structure, write_xyz
+
+
+INPUT_EXTENSIONS = ('.xyz', '.pdb', '.ent')
+SUMMARY_COLUMNS = ('name', 'status', 'atoms', 'seconds', 'dat_points',
+                   'grad_cube', 'dens_cube', 'xy_data', 'error')
+BLOB_SUMMARY_COLUMNS = ('blobs',) + sum(((k, k + '_rho') for k in KINDS), ())
+
+
+def find_inputs(directory):
+    """
+    Sorted list of XYZ/PDB files in `directory`.
+    """
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                  if os.path.splitext(name)[1].lower() in INPUT_EXTENSIONS)
+
+
+def run_one(path, output_dir, engine='nciplot', binary=None, blobs=None, receptor=None,
+            **options):
+    """
+    Compute a single structure inside `output_dir/<name>` and summarize it.
+    Errors are reported in the summary instead of raised, so one bad input
+    does not stop the batch.
+
+    If `blobs` is set, the NCI regions under that RDG isovalue are listed
+    in `<name>-blobs.tsv` (check `blobs.blob_table`) and summarized with
+    the `BLOB_SUMMARY_COLUMNS`, to rank structures without drawing them.
+
+    If `receptor` is the directory of a filled `receptor.ReceptorGrid`,
+    the structure is computed as a pose against it (promolecular engine).
+
+    Returns
+    -------
+    summary : dict
+        Keys as in `SUMMARY_COLUMNS`.
+    """
+    name = os.path.splitext(os.path.basename(path))[0]
+    workdir = os.path.join(output_dir, name)
+    summary = {'name': name, 'status': 'failed'}
+    start = time.time()
+    try:
+        if not os.path.isdir(workdir):
+            os.makedirs(workdir)
+        elements, coords = read_structure(path)
+        summary['atoms'] = len(elements)
+        xyz = write_xyz(os.path.join(workdir, name + '.xyz'), elements, coords, title=name)
+        with recorder.stage('compute', job=recorder.new_job(name), engine=engine,
+                            children=engine != 'promolecular'):
+            if engine == 'promolecular':
+                grid = ReceptorGrid(receptor, writable=False) if receptor else None
+                data = PromolecularNCI(receptor=grid).compute([xyz], workdir=workdir, name=name,
+                                                              **options)
+            else:
+                data = run_nciplot(binary, [xyz], workdir, name=name, **options)
+        for key in ('grad_cube', 'dens_cube', 'xy_data'):
+            summary[key] = data.get(key, '')
+        if data.get('xy_data') and os.path.isfile(data['xy_data']):
+            with open(data['xy_data']) as f:
+                summary['dat_points'] = sum(1 for line in f if line.strip())
+        if blobs:
+            # with a receptor, atoms are those in the cube header: receptor, then pose
+            rows = blob_table(read_cube(data['grad_cube']), read_cube(data['dens_cube']),
+                              isovalue=blobs, coords=None if receptor else coords / BOHR)
+            write_table(os.path.join(workdir, name + '-blobs.tsv'), rows)
+            summary['blobs'] = len(rows)
+            summary.update(summarize(rows))
+        summary['status'] = 'ok'
+    except Exception as e:
+        summary['error'] = '{}: {}'.format(type(e).__name__, e)
+    summary['seconds'] = round(time.time() - start, 3)
+    return summary
+
+
+def _run_one_star(args):
+    path, output_dir, kwargs = args
+    return run_one(path, output_dir, **kwargs)
+
+
+def run_batch(paths, output_dir, jobs=None, **kwargs):
+    """
+    Run `run_one` over `paths` in a pool of `jobs` processes and write
+    `summary.tsv` in `output_dir`.
+
+    Returns
+    -------
+    summaries : list of dict
+    """
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    tasks = [(path, output_dir, kwargs) for path in paths]
+    pool = Pool(jobs or cpu_count())
+    try:
+        summaries = pool.map(_run_one_star, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    columns = SUMMARY_COLUMNS + (BLOB_SUMMARY_COLUMNS if kwargs.get('blobs') else ())
+    write_summary(os.path.join(output_dir, 'summary.tsv'), summaries, columns)
+    return summaries
+
+
+def write_summary(path, summaries, columns=SUMMARY_COLUMNS):
+    with open(path, 'w') as f:
+        f.write('\t'.join(columns) + '\n')
+        for summary in summaries:
+            f.write('\t'.join(str(summary.get(c, '')) for c in columns) + '\n')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m nciplot',
+                                     description='Headless NCIPlot runs, without Chimera.')
+    subparsers = parser.add_subparsers(dest='command')
+    batch = subparsers.add_parser('batch', help='Run NCIPlot over a directory of XYZ/PDB files')
+    batch.add_argument('input_dir', help='Directory with XYZ or PDB files')
+    batch.add_argument('output_dir', help='Where results and summary.tsv are written')
+    batch.add_argument('--engine', choices=('nciplot', 'promolecular'), default='nciplot',
+                       help='NCIPlot binary or in-process promolecular engine')
+    batch.add_argument('--binary', help='NCIPlot executable. Defaults to `nciplot` in PATH')
+    batch.add_argument('--dat', help='NCIPlot dat directory. Defaults to $NCIPLOT_HOME/dat')
+    batch.add_argument('-j', '--jobs', type=int, default=None,
+                       help='Number of worker processes. Defaults to the number of CPUs')
+    batch.add_argument('--increments', type=float, nargs=3, metavar=('DX', 'DY', 'DZ'),
+                       help='Grid step, in Angstrom')
+    batch.add_argument('--adaptive', type=int, metavar='FACTOR',
+                       help='Promolecular engine only: sample every FACTOR voxels first and '
+                            'refine only the blocks close to the cube cutoffs')
+    batch.add_argument('--dat-cutoffs', type=float, nargs=2, default=(0.2, 1.0),
+                       metavar=('RHO', 'RDG'), help='Cutoffs for the dat file')
+    batch.add_argument('--cube-cutoffs', type=float, nargs=2, default=(0.07, 0.3),
+                       metavar=('RHO', 'RDG'), help='Cutoffs for the cube files')
+    batch.add_argument('--blobs', type=float, nargs='?', const=0.3, metavar='RDG',
+                       help='List the NCI regions under this RDG isovalue (default: 0.3) '
+                            'in <name>-blobs.tsv and count them in summary.tsv')
+    batch.add_argument('--receptor', metavar='PATH',
+                       help='Promolecular engine only: XYZ/PDB receptor to screen the input '
+                            'poses against. Its density is computed once and cached')
+    batch.add_argument('--site', type=float, nargs=6,
+                       metavar=('X0', 'Y0', 'Z0', 'X1', 'Y1', 'Z1'),
+                       help='Box of the receptor grid, in Angstrom. Defaults to the box '
+                            'around all the poses, with a 3 A margin')
+    return parser.parse_args(argv)
+
+
+def prepare_receptor(path, poses, site=None, increments=None, padding=3.0):
+    """
+    Create (or reuse) the receptor grid for `poses` and fill it, so the
+    workers only have to read it.
+
+    Returns
+    -------
+    directory : str
+        Of the `receptor.ReceptorGrid`.
+    """
+    elements, coords = read_structure(path)
+    if site is None:
+        pose_coords = np.concatenate([read_structure(pose)[1] for pose in poses])
+        site = tuple(pose_coords.min(axis=0) - padding) + tuple(pose_coords.max(axis=0) + padding)
+    grid = receptor_grid(elements, coords, cube=site, increments=increments, padding=padding)
+    with recorder.stage('receptor_grid', points=int(np.prod(grid.shape))) as stage:
+        stage.info['evaluated'] = grid.fill()
+    evict_receptor_grids(os.path.dirname(grid.directory), keep=grid.key)  # now that it is full
+    return grid.directory
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command != 'batch':
+        parse_args(['--help'])
+    kwargs = dict(engine=args.engine, dat_cutoffs=tuple(args.dat_cutoffs),
+                  cube_cutoffs=tuple(args.cube_cutoffs))
+    if args.increments:
+        kwargs['increments'] = tuple(args.increments)
+    if args.blobs:
+        kwargs['blobs'] = args.blobs
+    if args.adaptive:
+        if args.engine != 'promolecular':
+            raise SystemExit('--adaptive requires --engine promolecular')
+        kwargs['adaptive'] = args.adaptive
+    if args.engine == 'nciplot':
+        binary = args.binary or find_executable('nciplot')
+        if not binary or not os.path.isfile(binary):
+            raise SystemExit('NCIPlot binary not found. Use --binary.')
+        kwargs['binary'] = binary
+        if args.dat:
+            os.environ['NCIPLOT_HOME'] = os.path.dirname(os.path.abspath(args.dat))
+    paths = find_inputs(args.input_dir)
+    if not paths:
+        raise SystemExit('No XYZ or PDB files found in {}'.format(args.input_dir))
+    if args.receptor:
+        if args.engine != 'promolecular':
+            raise SystemExit('--receptor requires --engine promolecular')
+        if args.adaptive:
+            raise SystemExit('--receptor and --adaptive cannot be combined')
+        kwargs['receptor'] = prepare_receptor(args.receptor, paths, site=args.site,
+                                              increments=kwargs.get('increments'))
+    summaries = run_batch(paths, args.output_dir, jobs=args.jobs, **kwargs)
+    failed = [s for s in summaries if s['status'] != 'ok']
+    print('{} structures computed, {} failed. Summary: {}'.format(
+          len(summaries) - len(failed), len(failed),
+          os.path.join(args.output_dir, 'summary.tsv')))
+    return 1 if failed else 0
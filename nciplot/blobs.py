@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Segmentation of NCI regions into blobs, and per-blob descriptors.
+
+Voxels of the gradient cube under the RDG isovalue are grouped in
+face-connected components ("blobs"), which correspond to the separate
+isosurface pieces drawn in Chimera. For each blob, the density is
+integrated (as rho^n for several n, like NCIPlot's integration mode), the
+interaction is classified by sign(lambda2)*rho at its RDG minimum, and
+the closest atoms are listed. Everything is vectorized with NumPy, so it
+can run in batch screens over many poses.
+"""
+
+from __future__ import print_function, division
+# Additional 3rd parties
+import numpy as np
+# Own
+from .promolecular import BOHR
+
+
+DEFAULT_ISOVALUE = 0.3
+DENSITY_SCALE = 100.0  # NCIPlot writes 100*sign(lambda2)*rho in the density cube
+POWERS = (1, 1.5, 2, 2.5, 3, 4 / 3, 5 / 3)
+CLASS_THRESHOLD = 0.01  # a.u. of sign(lambda2)*rho separating the classes below
+KINDS = ('attractive', 'vdw', 'repulsive')
+BLOB_COLUMNS = (('blob', 'kind', 'voxels', 'volume', 'sign_rho', 'rdg_min')
+                + tuple('rho^{:.3g}'.format(n) for n in POWERS)
+                + ('x', 'y', 'z', 'atoms', 'distances'))
+
+
+def label_blobs(mask):
+    """
+    Label the face-connected components of a 3D boolean mask.
+
+    Uses a vectorized union-find: every voxel starts as its own root,
+    roots of neighbouring voxels are hooked to the smaller one with
+    `np.minimum.at`, and paths are compressed by pointer jumping, until
+    nothing changes. Each pass at least halves the number of differing
+    roots along any path, so few passes are needed.
+
+    Returns
+    -------
+    labels : np.ndarray of int32, same shape as `mask`
+        0 for background, 1..n for the components, ordered by their first
+        voxel in C order.
+    n : int
+    """
+    mask = np.asarray(mask, dtype=bool)
+    labels = np.zeros(mask.shape, dtype=np.int32)
+    n_voxels = int(mask.sum())
+    if not n_voxels:
+        return labels, 0
+    index = np.full(mask.shape, -1, dtype=np.int64)
+    index[mask] = np.arange(n_voxels)
+    pairs = []
+    for axis in range(3):
+        lead = [slice(None)] * 3
+        trail = [slice(None)] * 3
+        lead[axis], trail[axis] = slice(1, None), slice(None, -1)
+        a, b = index[tuple(trail)], index[tuple(lead)]
+        both = (a >= 0) & (b >= 0)
+        pairs.append((a[both], b[both]))
+    a = np.concatenate([p[0] for p in pairs])
+    b = np.concatenate([p[1] for p in pairs])
+    parent = np.arange(n_voxels, dtype=np.int64)
+    while True:
+        ra, rb = parent[a], parent[b]
+        differ = ra != rb
+        if not differ.any():
+            break
+        ra, rb = ra[differ], rb[differ]
+        low = np.minimum(ra, rb)
+        np.minimum.at(parent, ra, low)
+        np.minimum.at(parent, rb, low)
+        while True:  # pointer jumping
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                break
+            parent = grandparent
+    roots, compact = np.unique(parent, return_inverse=True)
+    labels[mask] = compact + 1
+    return labels, len(roots)
+
+
+def classify(sign_rho, threshold=CLASS_THRESHOLD):
+    """
+    'attractive' (e.g. hydrogen bonds), 'vdw' or 'repulsive' (steric
+    clashes), from sign(lambda2)*rho in atomic units.
+    """
+    if sign_rho < -threshold:
+        return 'attractive'
+    if sign_rho > threshold:
+        return 'repulsive'
+    return 'vdw'
+
+
+def blob_table(gradient, density, isovalue=DEFAULT_ISOVALUE, coords=None, powers=POWERS,
+               n_nearest=2, min_voxels=1, threshold=CLASS_THRESHOLD):
+    """
+    Segment the NCI regions of a result and describe each of them.
+
+    Parameters
+    ----------
+    gradient, density : cube.Cube
+        RDG and density cubes, as written by NCIPlot. Density values are
+        divided by `DENSITY_SCALE` to get sign(lambda2)*rho.
+    isovalue : float, optional
+        RDG isovalue delimiting the regions, as used for the isosurface.
+    coords : np.ndarray, shape=(N, 3), optional
+        Atoms to search for the nearest ones, in bohr. Defaults to the
+        atoms in the header of the gradient cube.
+    powers : sequence of float, optional
+        Exponents n of the integrals of rho^n.
+    n_nearest : int, optional
+        Number of closest atoms reported per blob.
+    min_voxels : int, optional
+        Smaller blobs are dropped, as numerical noise.
+    threshold : float, optional
+        Check `classify`.
+
+    Returns
+    -------
+    rows : list of dict
+        One per blob, sorted by decreasing volume, with the keys in
+        `BLOB_COLUMNS`: `voxels`; `volume` and the `rho^n` integrals, in
+        atomic units; `sign_rho` and `rdg_min` at the RDG minimum of the
+        blob; its density-weighted centroid `x`, `y`, `z` in Angstrom; the
+        indices of the closest `atoms` in `coords` and their `distances`
+        to the blob, in Angstrom.
+    """
+    rdg = np.asarray(gradient.data)
+    signed = np.asarray(density.data) / DENSITY_SCALE
+    if rdg.shape != signed.shape:
+        raise ValueError('Gradient and density cubes must have the same shape.')
+    labels, n = label_blobs(rdg < isovalue)
+    if not n:
+        return []
+    voxel = np.flatnonzero(labels)
+    blob = labels.ravel()[voxel] - 1
+    rho = np.abs(signed.ravel()[voxel]).astype(float)
+    rdg_values = rdg.ravel()[voxel].astype(float)
+    positions = (np.column_stack(np.unravel_index(voxel, labels.shape)) * gradient.spacing
+                 + gradient.origin)
+    dv = float(np.prod(gradient.spacing))
+
+    counts = np.bincount(blob, minlength=n)
+    integrals = [np.bincount(blob, weights=rho ** p, minlength=n) * dv for p in powers]
+    weights = np.bincount(blob, weights=rho, minlength=n)
+    safe = np.where(weights > 0, weights, 1.0)
+    centroids = np.column_stack([np.bincount(blob, weights=rho * positions[:, i], minlength=n)
+                                 for i in range(3)]) / safe[:, None]
+    unweighted = weights <= 0
+    if unweighted.any():
+        for i in range(3):
+            centroids[unweighted, i] = (np.bincount(blob, weights=positions[:, i], minlength=n)
+                                        / np.maximum(counts, 1))[unweighted]
+    order = np.lexsort((rdg_values, blob))  # by blob, then by RDG
+    first = order[np.r_[0, np.flatnonzero(np.diff(blob[order])) + 1]]
+    minima = np.empty(n, dtype=np.int64)
+    minima[blob[first]] = first
+
+    if coords is None:
+        coords = gradient.coords
+    coords = np.asarray(coords, dtype=float).reshape(-1, 3)
+    members = np.split(order, np.flatnonzero(np.diff(blob[order])) + 1)
+
+    rows = []
+    for i in np.argsort(-counts, kind='mergesort'):
+        if counts[i] < min_voxels:
+            continue
+        sign_rho = float(signed.ravel()[voxel[minima[i]]])
+        atoms, distances = nearest_atoms(positions[members[i]], coords, n_nearest)
+        row = {'blob': len(rows) + 1, 'kind': classify(sign_rho, threshold),
+               'voxels': int(counts[i]), 'volume': counts[i] * dv, 'sign_rho': sign_rho,
+               'rdg_min': float(rdg_values[minima[i]]),
+               'x': centroids[i, 0] * BOHR, 'y': centroids[i, 1] * BOHR,
+               'z': centroids[i, 2] * BOHR,
+               'atoms': atoms, 'distances': [d * BOHR for d in distances]}
+        for p, values in zip(powers, integrals):
+            row['rho^{:.3g}'.format(p)] = float(values[i])
+        rows.append(row)
+    return rows
+
+
+def nearest_atoms(points, coords, n=2, chunk_size=2**20):
+    """
+    Indices of the `n` atoms in `coords` closest to any of `points`, and
+    their distances, closest first. Same units for both.
+    """
+    if not len(coords) or not len(points) or n < 1:
+        return [], []
+    best = np.full(len(coords), np.inf)
+    step = max(1, chunk_size // len(coords))
+    for start in range(0, len(points), step):
+        d = points[start:start + step, None, :] - coords[None, :, :]
+        best = np.minimum(best, (d * d).sum(axis=2).min(axis=0))
+    closest = np.argsort(best, kind='mergesort')[:n]
+    return [int(i) for i in closest], [float(np.sqrt(best[i])) for i in closest]
+
+
+def summarize(rows):
+    """
+    Count and total rho^1 integral of the blobs of each kind, e.g. to rank
+    poses: {'attractive': 2, 'attractive_rho': 0.0123, ...}.
+    """
+    summary = {}
+    for kind in KINDS:
+        selected = [row for row in rows if row['kind'] == kind]
+        summary[kind] = len(selected)
+        summary[kind + '_rho'] = sum(row['rho^1'] for row in selected)
+    return summary
+
+
+def format_table(rows, columns=BLOB_COLUMNS, sep='\t'):
+    """
+    Text table of `blob_table` rows, with a header line. Lists are
+    joined with commas.
+    """
+    lines = [sep.join(columns)]
+    for row in rows:
+        lines.append(sep.join(_format_value(row.get(c, '')) for c in columns))
+    return '\n'.join(lines) + '\n'
+
+
+def write_table(path, rows, columns=BLOB_COLUMNS):
+    with open(path, 'w') as f:
+        f.write(format_table(rows, columns))
+    return path
+
+
+def _format_value(value):
+    if isinstance(value, (list, tuple)):
+        return ','.join(_format_value(v) for v in value)
+    if isinstance(value, float):
+        return '{:.6g}'.format(value)
+    return str(value)
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Content-addressed, size-bounded disk cache of NCIPlot results.
+
+Entries are keyed on a hash of the input elements and coordinates plus
+the options used to build the NCIPlot input, so identical systems can be
+drawn again without recomputing them.
+"""
+
+from __future__ import print_function, division
+# Python stdlib
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+# Additional 3rd parties
+import numpy as np
+# Own
+from .cube import sidecar_path, fresh_sidecar, write_stamp
+from .xyz import read_xyz
+
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'tangram_nciplot')
+DEFAULT_MAX_SIZE = 2 * 1024 ** 3  # bytes
+FILE_KEYS = ('grad_cube', 'dens_cube', 'sparse', 'xy_data')
+# Options that do not change the results
+IGNORED_OPTIONS = ('name', 'max_workers')
+
+
+class ResultCache(object):
+
+    """
+    Store NCIPlot outputs (cubes and dat file) under a hash of their
+    inputs, evicting the least recently used entries when the cache grows
+    beyond `max_size` bytes.
+
+    Parameters
+    ----------
+    directory : str, optional
+        Root of the cache. Created on first use.
+    max_size : int, optional
+        Maximum size of the cache, in bytes.
+    """
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_size=DEFAULT_MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+
+    @staticmethod
+    def key(xyz, options, engine='nciplot', decimals=4, structures=None, binary=None):
+        """
+        Hash the elements and coordinates of the given XYZ files, together
+        with the options passed to `create_nci_input` and the engine name.
+        Coordinates are rounded to `decimals` so spurious float noise
+        does not prevent hits.
+
+        If the (elements, coords) of each file are already in memory, pass
+        them as `structures` to skip reading the files back.
+
+        The NCIPlot `binary`, if any, is hashed too (its resolved path, size
+        and modification time), so results of the CPU and CUDA programs, or
+        of different builds, are kept apart.
+        """
+        digest = hashlib.sha1()
+        digest.update(engine.encode('utf-8'))
+        if binary:
+            binary = os.path.realpath(binary)
+            try:
+                stat = os.stat(binary)
+                stamp = [binary, stat.st_size, stat.st_mtime]
+            except OSError:
+                stamp = [binary]
+            digest.update(json.dumps(stamp).encode('utf-8'))
+        if structures is None:
+            structures = [read_xyz(path) for path in xyz]
+        for elements, coords in structures:
+            digest.update(' '.join(elements).encode('utf-8'))
+            digest.update(np.ascontiguousarray(np.round(coords, decimals)).tobytes())
+        relevant = dict((k, v) for (k, v) in options.items() if k not in IGNORED_OPTIONS)
+        digest.update(json.dumps(relevant, sort_keys=True, default=str).encode('utf-8'))
+        return digest.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        """
+        Return the cached `data` dict for `key`, or None if missing.
+        """
+        index = os.path.join(self._entry(key), 'data.json')
+        try:
+            with open(index) as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        for k in FILE_KEYS:
+            if k in data:
+                data[k] = os.path.join(self._entry(key), data[k])
+                if not os.path.isfile(data[k]):
+                    return None
+        os.utime(index, None)  # mark as recently used
+        return data
+
+    def put(self, key, data):
+        """
+        Copy the output files referenced by `data` into the cache, along
+        with the up-to-date `.npy` sidecars of the cubes (check
+        `cube.load_cube`), so cached entries keep their fast path.
+
+        Returns
+        -------
+        data : dict
+            Copy of `data` pointing to the cached files, or the original
+            `data` if it could not be stored.
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        staging = tempfile.mkdtemp(prefix='.tmp_', dir=self.directory)
+        stored = dict(data)
+        try:
+            for k in FILE_KEYS:
+                if k in data:
+                    filename = os.path.basename(data[k])
+                    shutil.copyfile(data[k], os.path.join(staging, filename))
+                    stored[k] = filename
+                    if fresh_sidecar(data[k]):
+                        copied = os.path.join(staging, filename)
+                        shutil.copyfile(sidecar_path(data[k]), sidecar_path(copied))
+                        write_stamp(copied)  # the copy has a new modification time
+            with open(os.path.join(staging, 'data.json'), 'w') as f:
+                json.dump(stored, f)
+            if os.path.isdir(self._entry(key)):
+                shutil.rmtree(self._entry(key))
+            os.rename(staging, self._entry(key))
+        except (IOError, OSError):
+            shutil.rmtree(staging, ignore_errors=True)
+            return data
+        self.evict(keep=key)
+        return self.get(key) or data
+
+    def entries(self):
+        """
+        List (last_used, size, key) for every entry, oldest first.
+        """
+        if not os.path.isdir(self.directory):
+            return []
+        entries = []
+        for key in os.listdir(self.directory):
+            index = os.path.join(self._entry(key), 'data.json')
+            if key.startswith('.') or not os.path.isfile(index):
+                continue
+            size = sum(os.path.getsize(os.path.join(self._entry(key), name))
+                       for name in os.listdir(self._entry(key)))
+            entries.append((os.path.getmtime(index), size, key))
+        return sorted(entries)
+
+    def evict(self, keep=None):
+        """
+        Remove least recently used entries until the cache fits `max_size`.
+        The entry `keep` is never removed.
+        """
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if total <= self.max_size:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self._entry(key), ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
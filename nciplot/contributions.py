@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Per-atom and per-residue decomposition of the NCI regions.
+
+Every voxel under the RDG isovalue is assigned to its nearest atom(s),
+found with the cell list of the promolecular engine (a uniform grid of
+buckets, which for atoms, being evenly spread, does the job of a KD-tree
+without needing SciPy). The integrated density of the voxels is then
+accumulated per atom, split by interaction kind, and can be summed over
+any grouping of the atoms, such as residues. Voxels are processed in
+batches, so memory stays bounded.
+"""
+
+from __future__ import print_function, division
+# Additional 3rd parties
+import numpy as np
+# Own
+from .blobs import DEFAULT_ISOVALUE, DENSITY_SCALE, CLASS_THRESHOLD, KINDS
+from .promolecular import CellList
+
+
+DEFAULT_CELL_SIZE = 4.0  # bohr
+CONTRIBUTION_COLUMNS = ('voxels', 'rho') + KINDS
+KIND_COLORS = ((0, 0, 1, 1), (0, 1, 0, 1), (1, 0, 0, 1))  # as the 'nciplot' palette
+
+
+def atom_contributions(gradient, density, coords=None, isovalue=DEFAULT_ISOVALUE,
+                       n_nearest=1, threshold=CLASS_THRESHOLD, cell_size=DEFAULT_CELL_SIZE,
+                       batch_size=2**21):
+    """
+    Integrate the density of the NCI regions per atom.
+
+    Each voxel with RDG under `isovalue` is assigned to its `n_nearest`
+    atoms, in equal shares.
+
+    Parameters
+    ----------
+    gradient, density : cube.Cube
+        RDG and density cubes, as written by NCIPlot.
+    coords : np.ndarray, shape=(N, 3), optional
+        Atom positions, in bohr. Defaults to the atoms in the header of the
+        gradient cube.
+    isovalue : float, optional
+    n_nearest : int, optional
+    threshold : float, optional
+        sign(lambda2)*rho separating the interaction kinds. Check
+        `blobs.classify`.
+    cell_size : float, optional
+        Edge of the cells of the atom index, in bohr. About the distance to
+        the nearest atoms works best.
+    batch_size : int, optional
+        Voxels assigned at once.
+
+    Returns
+    -------
+    contributions : dict of np.ndarray, shape=(N,)
+        Keys in `CONTRIBUTION_COLUMNS`: the (fractional) number of
+        `voxels`, and the integral of rho over them, in total (`rho`) and
+        for each of the `KINDS`, in atomic units.
+    """
+    rdg = np.asarray(gradient.data)
+    signed = np.asarray(density.data)
+    if rdg.shape != signed.shape:
+        raise ValueError('Gradient and density cubes must have the same shape.')
+    if coords is None:
+        coords = gradient.coords
+    coords = np.asarray(coords, dtype=float).reshape(-1, 3)
+    n = len(coords)
+    contributions = dict((column, np.zeros(n)) for column in CONTRIBUTION_COLUMNS)
+    if not n:
+        return contributions
+    index = CellList(coords, cell_size)
+    dv = float(np.prod(gradient.spacing))
+    voxels = np.flatnonzero(rdg.ravel() < isovalue)
+    for start in range(0, len(voxels), batch_size):
+        voxel = voxels[start:start + batch_size]
+        points = (np.column_stack(np.unravel_index(voxel, rdg.shape)) * gradient.spacing
+                  + gradient.origin)
+        atoms, _ = index.nearest(points, n_nearest)
+        values = signed.ravel()[voxel] / DENSITY_SCALE
+        kinds = np.where(values < -threshold, 0, np.where(values > threshold, 2, 1))
+        share = (atoms >= 0) / np.maximum((atoms >= 0).sum(axis=1), 1)[:, None]
+        atoms, share = atoms.ravel(), share.ravel()
+        valid = atoms >= 0
+        atoms, share = atoms[valid], share[valid]
+        rho = np.repeat(np.abs(values) * dv, n_nearest)[valid] * share
+        kinds = np.repeat(kinds, n_nearest)[valid]
+        contributions['voxels'] += np.bincount(atoms, weights=share, minlength=n)
+        contributions['rho'] += np.bincount(atoms, weights=rho, minlength=n)
+        for i, kind in enumerate(KINDS):
+            selected = kinds == i
+            contributions[kind] += np.bincount(atoms[selected], weights=rho[selected],
+                                               minlength=n)
+    return contributions
+
+
+def group_contributions(contributions, groups, n_groups=None):
+    """
+    Sum per-atom `contributions` over groups of atoms, e.g. residues.
+
+    Parameters
+    ----------
+    contributions : dict of np.ndarray
+        As returned by `atom_contributions`.
+    groups : np.ndarray of int, shape=(N,)
+        Group index of each atom.
+    n_groups : int, optional
+
+    Returns
+    -------
+    contributions : dict of np.ndarray, shape=(n_groups,)
+    """
+    groups = np.asarray(groups, dtype=np.int64)
+    if n_groups is None:
+        n_groups = int(groups.max()) + 1 if len(groups) else 0
+    return dict((key, np.bincount(groups, weights=values, minlength=n_groups))
+                for (key, values) in contributions.items())
+
+
+def contribution_colors(contributions, colors=KIND_COLORS, background=(1, 1, 1, 1)):
+    """
+    RGBA colors for atoms or groups: the `colors` of the `KINDS` are mixed
+    by their share of each contribution, and faded towards `background`
+    the smaller the total is, relative to the largest one.
+
+    Returns
+    -------
+    rgba : np.ndarray, shape=(N, 4)
+    """
+    total = contributions['rho']
+    shares = np.column_stack([contributions[kind] for kind in KINDS])
+    safe = np.where(total > 0, total, 1.0)
+    mixed = (shares / safe[:, None]).dot(np.asarray(colors, dtype=float))
+    weight = (total / total.max() if len(total) and total.max() > 0 else total)[:, None]
+    return weight * mixed + (1 - weight) * np.asarray(background, dtype=float)
+
+
+def format_contributions(names, contributions, columns=CONTRIBUTION_COLUMNS, sep='\t',
+                         top=None):
+    """
+    Text table of `contributions` with a `names` column, sorted by
+    decreasing `rho`. Rows without contribution are left out, and only
+    the first `top` are kept if given.
+    """
+    order = [i for i in np.argsort(-contributions['rho'], kind='mergesort')
+             if contributions['rho'][i] > 0][:top]
+    lines = [sep.join(('name',) + tuple(columns))]
+    for i in order:
+        lines.append(sep.join([str(names[i])] + ['{:.6g}'.format(contributions[c][i])
+                                                 for c in columns]))
+    return '\n'.join(lines) + '\n'
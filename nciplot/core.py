@@ -4,19 +4,46 @@
 
 from __future__ import print_function, division
 # Python stdlib
-from cStringIO import StringIO
+from collections import deque, namedtuple, OrderedDict
+from threading import Thread
+from Queue import Queue, Empty
+import atexit
 import os
+import shutil
 # Chimera stuff
 import chimera, _chimera
 from chimera.SubprocessMonitor import Popen, PIPE, monitor
 from chimera.tasks import Task
 from OpenSave import osTemporaryFile
 from chimera import UserError
-from VolumeViewer import open_volume_file
+from VolumeViewer import volume_from_grid_data
+from VolumeData import Array_Grid_Data
 from SurfaceColor import Volume_Color, Gradient_Color, standard_color_palettes, color_by_volume
+try:  # array access to coordinates, as used by MultiScale
+    from _multiscale import get_atom_coordinates
+except ImportError:
+    get_atom_coordinates = None
 # Additional 3rd parties
 import numpy as np
+from matplotlib.colors import LogNorm
 # Own
+from blobs import blob_table, DEFAULT_ISOVALUE
+from cache import ResultCache
+from contributions import atom_contributions, group_contributions, contribution_colors
+from cube import load_cube, write_cube, volume_order
+from decomposition import DomainDecomposition
+from histogram import cached_histogram, points_histogram
+from instrument import recorder
+from interface import interface_masks, interface_box, DEFAULT_BOX_PADDING
+from promolecular import PromolecularNCI, FieldCache, BOHR
+from receptor import receptor_grid
+from scanning import deletion_scan
+from sparse import SparseVolume, DEFAULT_THRESHOLD
+from scratch import ScratchSpace, estimate_output_size
+from runner import (create_nci_input, parse_stdout_cpu, parse_stdout_cuda, implementation,
+                    ProgressTracker, format_seconds)
+from trajectory import FrameScheduler, CubePrefetcher, frame_calculator, split_xyz_trajectory
+from xyz import write_xyz, DECIMALS as XYZ_DECIMALS
 standard_color_palettes['nciplot'] = ((0,0,1,1), (0,1,0,1), (1,0,0,1))
 
 
@@ -24,55 +51,214 @@ standard_color_palettes['nciplot'] = ((0,0,1,1), (0,1,0,1), (1,0,0,1))
 class Controller(object):
 
     _model_id = [100]
+    poll_interval = 100
 
-    def __init__(self, gui=None, nciplot_binary=None, nciplot_dat=None, *args, **kwargs):
+    def __init__(self, gui=None, nciplot_binary=None, nciplot_dat=None, engine='nciplot',
+                 cache=True, *args, **kwargs):
         self.gui = gui
-        self.nciplot = NCIPlot(nciplot_binary, nciplot_dat, success_callback=self._after_cb,
-            clear_callback=self.gui._run_nciplot_clear_cb)
+        self.engine = engine
+        self.cache = result_cache if cache is True else (cache or None)
+        self._cache_key = None
+        if engine == 'promolecular':
+            # a new run of the same system only recomputes the atoms that moved
+            self.nciplot = QueuedPromolecularNCI(nciplot_dat, success_callback=self._after_cb,
+                clear_callback=self._clear_cb, in_memory=True, fields=field_cache)
+        else:
+            self.nciplot = NCIPlot(nciplot_binary, nciplot_dat, success_callback=self._after_cb,
+                clear_callback=self._clear_cb)
         self.data = {}
+        self.job_id = None  # groups the stages recorded by `instrument.recorder`
+        self.cubes, self.xy = None, None  # in-memory results, if any
+        self.structures = []  # (elements, coords) arrays of the exported XYZ files
+        self.atoms = []  # Chimera atoms in the same order
+        self.receptor_atoms, self._receptor_structure = [], None
         self.surface, self.density = None, None
 
     def run(self, atoms=None, groups=None, **options):
         """
         Convert selected molecules to temporary xyz files, launch NCIPlot
-        and draw the resulting volumetric information
+        and draw the resulting volumetric information.
+
+        With the promolecular engine, the calculation happens in-process,
+        in a worker thread scheduled in the same queue as NCIPlot jobs, and
+        the volumes are drawn straight from memory, without writing any
+        file. If an identical calculation is found in the result cache, the
+        volumes are loaded from it instead.
         """
-        if atoms:
-            xyz = [atoms2xyz(atoms)]
-        elif groups:
-            xyz = [atoms2xyz(group) for group in groups]
-        else:
-            xyz = [molecule2xyz(m) for m in self.selected_molecules]
-        self.nciplot.run(*xyz, **options)
+        self.job_id = recorder.new_job(self.engine)
+        interface = options.pop('interface', None)
+        with recorder.stage('export_xyz', job=self.job_id):
+            if atoms:
+                groups, titles = [atoms], [None]
+            elif groups:
+                if interface and options.get('intermolecular') and len(groups) > 1:
+                    groups = self.interface_groups(groups, interface, options)
+                titles = [None] * len(groups)
+            else:
+                molecules = self.selected_molecules
+                groups, titles = [m.atoms for m in molecules], [m.name for m in molecules]
+            exported = [export_xyz(group, title=title) for group, title in zip(groups, titles)]
+        xyz = [e.path for e in exported]
+        self.structures = [(e.elements, e.coords) for e in exported]
+        self.atoms = [a for group in groups for a in group]
+        if self.receptor_atoms:  # first, like in the cube headers
+            self.structures.insert(0, self._receptor_structure)
+            self.atoms = self.receptor_atoms + self.atoms
+        if self.cache is not None and not getattr(self.nciplot, 'in_memory', False):
+            with recorder.stage('cache_lookup', job=self.job_id) as stage:
+                self._cache_key = self.cache.key(xyz, options, engine=self.engine,
+                                                 structures=self.structures,
+                                                 binary=getattr(self.nciplot, 'binary', None))
+                data = self.cache.get(self._cache_key)
+                stage.info['hit'] = data is not None
+            if data is not None:
+                self._cache_key = None  # already stored, `_prepare` must not put it again
+                self._after_cb(data)
+                return
+        try:
+            self.nciplot.run(*xyz, job_id=self.job_id, **options)
+        except ValueError as e:
+            raise UserError(str(e))
+
+    def use_receptor(self, atoms, **lattice):
+        """
+        Screening mode, for the promolecular engine. The density of the
+        `atoms` (the receptor) is evaluated once on a fixed lattice, stored
+        on disk and added to that of the atoms passed to every following
+        `run`, which should only hold the ligand (pose). Check
+        `receptor.receptor_grid` for the `lattice` options, which should
+        enclose the binding site.
+        """
+        if self.engine != 'promolecular':
+            raise UserError('Receptor grids need the promolecular engine.')
+        elements, coords = atoms_arrays(atoms)
+        try:
+            self.nciplot.receptor = receptor_grid(elements, coords, **lattice)
+        except ValueError as e:
+            raise UserError(str(e))
+        self.receptor_atoms = list(atoms)
+        self._receptor_structure = elements, coords
+
+    @staticmethod
+    def interface_groups(groups, distance, options):
+        """
+        Keep only the atoms of each group within `distance` of another
+        group and, unless a search region was already requested, restrict
+        the grid to a tight box around the interface via `options['cube']`,
+        or `options['domain_box']` if `domains` is set (the box split by
+        `DecomposedNCIPlotJob`). The box is trimmed to the overlap of the
+        groups' boxes, padded by `distance` (at least
+        `interface.DEFAULT_BOX_PADDING`), so NCI regions away from the
+        interface are left out.
+        """
+        coords = [atoms_arrays(group)[1] for group in groups]
+        masks = interface_masks(coords, distance)
+        if not all(mask.any() for mask in masks):
+            raise UserError('Some of the selected groups are not in contact '
+                            '(no atoms within {} A of each other).'.format(distance))
+        if not any(options.get(k) for k in ('ligand', 'radius', 'cube')):
+            box = interface_box(coords, masks, padding=max(distance, DEFAULT_BOX_PADDING))
+            # domain decomposition cannot take search options, but splits this box instead
+            options['domain_box' if options.get('domains', 1) > 1 else 'cube'] = box
+        return [[a for (a, keep) in zip(group, mask) if keep]
+                for (group, mask) in zip(groups, masks)]
 
     def _after_cb(self, data):
         """
-        Called once NCIPlot has run
+        Called once NCIPlot has run. In-memory arrays in `data` are moved
+        to `cubes` and `xy`, so `data` stays JSON-serializable.
+
+        Caching and reading the cubes happen in `_prepare`, in a worker
+        thread, so Chimera stays responsive with big grids. The models are
+        created in `_prepared_cb`, back in Tk's event loop.
+        """
+        self.cubes, self.xy = data.pop('_cubes', None), data.pop('_xy', None)
+        if self.job_id is None:  # e.g. loaded from a file
+            self.job_id = recorder.new_job('load')
+        result = {}
+        thread = Thread(target=self._prepare, args=(data, result))
+        thread.daemon = True
+        thread.start()
+        chimera.tkgui.app.after(self.poll_interval, self._prepared_cb, thread, result)
+
+    def _prepare(self, data, result):
+        """
+        Worker thread part of `_after_cb`. It must not touch Chimera.
+        Fills `result` with the final `data`, the cubes in VolumeViewer
+        layout and the density range over the isosurface.
+        """
+        try:
+            if self.cache is not None and self._cache_key is not None:
+                with recorder.stage('cache_store', job=self.job_id):
+                    data = self.cache.put(self._cache_key, data)
+                self._cache_key = None
+            with recorder.stage('load_cubes', job=self.job_id) as stage:
+                gradient, density = [volume_order(c) for c in self.current_cubes(data)]
+                result['values_range'] = surface_value_range(gradient, density)
+                stage.info['voxels'] = gradient.data.size
+            result['cubes'] = gradient, density
+            result['data'] = data
+        except Exception as e:
+            result['error'] = e
+
+    def _prepared_cb(self, thread, result):
+        if thread.is_alive():
+            chimera.tkgui.app.after(self.poll_interval, self._prepared_cb, thread, result)
+            return
+        if 'error' in result:
+            chimera.replyobj.error('Could not load NCIPlot results: {}\n'.format(result['error']))
+            self._clear_cb()
+            return
+        self.data = result['data']
+        with recorder.stage('draw', job=self.job_id):
+            self.surface, self.density = self.draw_cubes(*result['cubes'],
+                                                         names=self.volume_names())
+        with recorder.stage('style_surface', job=self.job_id):
+            self.style_surface(values_range=result['values_range'])
+        self.gui._run_nciplot_cb(self)
+
+    def style_surface(self, values_range=None):
+        """
+        Apply default levels, smoothing and colors to the current surface
         """
-        self.data = data
-        self.surface, self.density = self.draw()
         self.isosurface()
         self.smoothen()
         self.update_surface()
-        self.colorize_by_volume()
+        self.colorize_by_volume(values_range=values_range)
         self.update_surface()
-        self.gui._run_nciplot_cb()
+
+    def _clear_cb(self):
+        """
+        Called if NCIPlot could not run
+        """
+        self.gui._run_nciplot_clear_cb(self)
 
     def draw(self):
         """
         Research on Chimera's Volume extensions
+
+        Cubes are loaded with `cube.load_cube`, so reopening a result maps
+        its binary sidecar instead of parsing the text files again. Results
+        held in memory are drawn directly, and sparse volumes are densified.
         """
-        try:
-            grad_file, dens_file = self.data['grad_cube'], self.data['dens_cube']
-        except KeyError:
-            raise UserError('NCIPlot has not been run yet!')
-        else:
-            gradient = open_volume_file(grad_file, show_dialog=False,
-                    model_id=(self._model_id[0], 1))[0]
-            density = open_volume_file(dens_file, show_dialog=False,
-                    model_id=(self._model_id[0], 2))[0]
-            density.display = False
-            self._model_id[0] += 1
+        return self.draw_cubes(*self.current_cubes(), names=self.volume_names())
+
+    def volume_names(self):
+        if 'sparse' in self.data:
+            name = os.path.splitext(os.path.basename(self.data['sparse']))[0]
+            return name + '-grad', name + '-dens'
+        if 'grad_cube' in self.data and 'dens_cube' in self.data:
+            return os.path.basename(self.data['grad_cube']), os.path.basename(self.data['dens_cube'])
+        return 'gradient', 'density'
+
+    def draw_cubes(self, gradient, density, names=('gradient', 'density')):
+        """
+        Like `draw`, but from already parsed `cube.Cube` objects.
+        """
+        gradient = volume_from_cube(gradient, names[0], model_id=(self._model_id[0], 1))
+        density = volume_from_cube(density, names[1], model_id=(self._model_id[0], 2))
+        density.display = False
+        self._model_id[0] += 1
         return gradient, density
 
     def colorize_by_color(self, color, surface=None):
@@ -101,7 +287,8 @@ class Controller(object):
         surface.surface_colors = surface.surface_colors[0], rgba
         surface.show()
 
-    def colorize_by_volume(self, surface=None, volume=None, mask=None, palette='nciplot'):
+    def colorize_by_volume(self, surface=None, volume=None, mask=None, palette='nciplot',
+                           values_range=None):
         """
         Apply color to a surface taking the rgb values from an opened volume.
 
@@ -117,6 +304,9 @@ class Controller(object):
         palette : str, default='nciplot'
             Colors that will be used to paint `surface`. Check 
             `SurfaceColor.standard_color_palettes.keys()` for available palettes.
+        values_range : 2-tuple of float, optional
+            Precomputed range of `volume` values over `surface`, as returned by
+            `surface_value_range`. If not given, it is measured on the surface.
         """
         if surface is None:
             surface = self.surface
@@ -130,7 +320,8 @@ class Controller(object):
             mask = Gradient_Color()
             mask.set_volume(volume)
 
-        values_range = mask.value_range(surface.surfacePieces[0])
+        if values_range is None:
+            values_range = mask.value_range(surface.surfacePieces[0])
         if None in values_range:
             print('Warning: Selected molecule has no value range. Coloring will be omitted.')
         else:
@@ -179,19 +370,243 @@ class Controller(object):
 
     def plot(self, figure):
         """
-        Plot density vs rdg in a hexbin plot.
+        Plot density vs rdg in a 2D histogram, with logarithmic colors.
+
+        The dat file is binned in chunks, so memory does not grow with the
+        number of points, and the histogram is cached next to it to make
+        plotting again instant. Check `histogram.cached_histogram`.
         """
         try:
-            xy = np.loadtxt(self.data['xy_data'][:-3] + 'dat')
-        except IOError:
+            with recorder.stage('plot_histogram', job=self.job_id):
+                if self.xy is not None:
+                    counts, xedges, yedges = points_histogram(self.xy)
+                else:
+                    counts, xedges, yedges = cached_histogram(self.data['xy_data'][:-3] + 'dat')
+        except (IOError, OSError):
             raise UserError('DAT file is missing. Please, run NCIPlot again.')
         except KeyError:
             raise UserError('NCIPlot has not been run yet!')
         else:
-            figure.hexbin(xy[:, 0], xy[:, 1], gridsize=250, bins='log', mincnt=1)
+            if counts.any():
+                figure.pcolormesh(xedges, yedges, np.ma.masked_less(counts.T, 1), norm=LogNorm())
+            figure.set_xlim(xedges[0], xedges[-1])
+            figure.set_ylim(yedges[0], yedges[-1])
             figure.set_xlabel('Density')
             figure.set_ylabel('RDG')
 
+    def blob_table(self, isovalue=None, **kwargs):
+        """
+        Segment the current NCI regions into blobs and describe each of
+        them: volume, density integrals, interaction kind and closest atoms.
+        Check `blobs.blob_table` for the columns and `blobs.format_table`
+        to print them.
+
+        Parameters
+        ----------
+        isovalue : float, optional
+            RDG isovalue. Defaults to that of the current isosurface.
+
+        Returns
+        -------
+        rows : list of dict
+            `atoms` holds Chimera atoms if the results were computed in this
+            session, or indices of the atoms in the cube files otherwise.
+        """
+        gradient, density = self.current_cubes()
+        coords = self._atom_coords()
+        rows = blob_table(gradient, density, isovalue=self._isovalue(isovalue), coords=coords,
+                          **kwargs)
+        if self.atoms and coords is not None:
+            for row in rows:
+                row['atoms'] = [self.atoms[i] for i in row['atoms']]
+        return rows
+
+    def atom_contributions(self, isovalue=None, **kwargs):
+        """
+        Integrated density of the current NCI regions assigned to each
+        atom, as in `contributions.atom_contributions`. Atoms are those of
+        `self.atoms` if the results were computed in this session, or the
+        ones in the cube files otherwise.
+
+        Parameters
+        ----------
+        isovalue : float, optional
+            RDG isovalue. Defaults to that of the current isosurface.
+        """
+        gradient, density = self.current_cubes()
+        with recorder.stage('atom_contributions', job=self.job_id):
+            return atom_contributions(gradient, density, coords=self._atom_coords(),
+                                      isovalue=self._isovalue(isovalue), **kwargs)
+
+    def residue_contributions(self, isovalue=None, **kwargs):
+        """
+        Per-residue sum of `atom_contributions`.
+
+        Returns
+        -------
+        residues : list of chimera.Residue
+        contributions : dict of np.ndarray
+            Same keys as `contributions.CONTRIBUTION_COLUMNS`, one value
+            per residue.
+        """
+        if not self.atoms:
+            raise UserError('Residues are only known for results computed in this session.')
+        contributions = self.atom_contributions(isovalue=isovalue, **kwargs)
+        residues, groups = OrderedDict(), []
+        for atom in self.atoms:
+            groups.append(residues.setdefault(atom.residue, len(residues)))
+        return list(residues), group_contributions(contributions, groups, len(residues))
+
+    def color_by_contribution(self, residues, contributions, **kwargs):
+        """
+        Color `residues` (atoms and ribbons) with `contributions.contribution_colors`:
+        blue, green and red for attractive, van der Waals and repulsive
+        contributions, faded to white the smaller they are. The total is
+        also stored in the `nciRho` residue attribute.
+        """
+        for residue, rgba, rho in zip(residues, contribution_colors(contributions, **kwargs),
+                                      contributions['rho']):
+            color = chimera.MaterialColor(*rgba)
+            residue.ribbonColor = color
+            residue.nciRho = float(rho)
+            for atom in residue.atoms:
+                atom.color = color
+
+    def scan_residues(self, residues=None, isovalue=None, **kwargs):
+        """
+        Delete each residue in turn and measure how much of the current NCI
+        regions is lost, as in `scanning.deletion_scan`. Only available
+        with the promolecular engine, whose fields are additive: the grid
+        is not computed again, each residue is subtracted from the fields
+        kept after the last run. The loss of density is also stored in the
+        `nciScanRho` residue attribute.
+
+        Parameters
+        ----------
+        residues : list of chimera.Residue, optional
+            Defaults to all the residues with atoms in the calculation.
+        isovalue : float, optional
+            RDG isovalue. Defaults to that of the current isosurface.
+
+        Returns
+        -------
+        residues : list of chimera.Residue
+        losses : dict of np.ndarray
+            Same keys as `scanning.SCAN_COLUMNS`, one value per residue.
+        """
+        if self.engine != 'promolecular':
+            raise UserError('Residue scanning needs the promolecular engine.')
+        groups = OrderedDict()
+        for i, atom in enumerate(self.atoms):
+            groups.setdefault(atom.residue, []).append(i)
+        if residues is None:
+            residues = list(groups)
+        with self.nciplot.lock:  # queued jobs update the kept fields in place
+            state = self.nciplot.state
+            if (state is None or len(state.coords) != len(self.atoms)
+                    or not np.allclose(state.coords, self._atom_coords(), atol=1e-5)):
+                raise UserError('The fields of this calculation were not kept. Run it again '
+                                'without adaptive grids or receptor, and a smaller grid or '
+                                'more memory for kept fields in the Configure dialog.')
+            with recorder.stage('deletion_scan', job=self.job_id, residues=len(residues)):
+                losses = deletion_scan(state, [groups.get(r, []) for r in residues],
+                                       isovalue=self._isovalue(isovalue),
+                                       rho_cutoff=self.data.get('rho', 0.07),
+                                       block_size=self.nciplot.block_size,
+                                       density_threshold=self.nciplot.density_threshold,
+                                       **kwargs)
+        for residue, rho in zip(residues, losses['rho']):
+            residue.nciScanRho = float(rho)
+        return residues, losses
+
+    def _isovalue(self, isovalue=None):
+        if isovalue is None:
+            isovalue = DEFAULT_ISOVALUE
+            if self.surface is not None and self.surface.surface_levels:
+                isovalue = self.surface.surface_levels[-1]
+        return isovalue
+
+    def _atom_coords(self):
+        """
+        Coordinates of the exported atoms, in bohr, or None if unknown.
+        """
+        if self.structures:
+            return np.concatenate([c for (_, c) in self.structures]) / BOHR
+
+    def current_cubes(self, data=None):
+        """
+        Gradient and density `cube.Cube` objects of the current results
+        (or those described by `data`), wherever they are held.
+        """
+        if data is None:
+            data = self.data
+        if self.cubes is not None:
+            return self.cubes
+        if 'sparse' in data:
+            volume = SparseVolume.load(data['sparse'])
+            return volume.cube('grad'), volume.cube('dens')
+        try:
+            return load_cube(data['grad_cube']), load_cube(data['dens_cube'])
+        except KeyError:
+            raise UserError("NCIPlot has not run yet!")
+
+    def _save_xy(self, xy_path):
+        if self.xy is not None:
+            np.savetxt(xy_path, self.xy, fmt='%16.8E')
+        elif 'xy_data' in self.data:
+            shutil.copyfile(self.data['xy_data'], xy_path)
+        else:
+            raise UserError("NCIPlot has not run yet!")
+
+    def save(self, grad_path, dens_path, xy_path):
+        """
+        Store the current results as cube files in the given locations,
+        copying the output files or writing the in-memory arrays.
+
+        Returns
+        -------
+        data : dict
+            Copy of `data` pointing to the new locations.
+        """
+        data = self.data.copy()
+        data.pop('sparse', None)
+        if self.cubes is None and 'grad_cube' in self.data and 'dens_cube' in self.data:
+            shutil.copyfile(self.data['grad_cube'], grad_path)
+            shutil.copyfile(self.data['dens_cube'], dens_path)
+        else:
+            for path, cube in zip((grad_path, dens_path), self.current_cubes()):
+                write_cube(path, cube.data, cube.origin, cube.spacing, cube.numbers, cube.coords)
+        self._save_xy(xy_path)
+        data['grad_cube'], data['dens_cube'], data['xy_data'] = grad_path, dens_path, xy_path
+        return data
+
+    def save_sparse(self, path, xy_path, threshold=None):
+        """
+        Store the current results as a `sparse.SparseVolume`, which only
+        keeps the regions where the RDG is under `threshold`. By default,
+        that is `sparse.DEFAULT_THRESHOLD` or 1.5 times the highest
+        isovalue currently shown, whichever is larger.
+
+        Returns
+        -------
+        data : dict
+            Copy of `data` pointing to the new locations.
+        """
+        if threshold is None:
+            threshold = DEFAULT_THRESHOLD
+            if self.surface is not None and self.surface.surface_levels:
+                threshold = max(threshold, 1.5 * max(self.surface.surface_levels))
+        data = self.data.copy()
+        for key in ('grad_cube', 'dens_cube'):
+            data.pop(key, None)
+        if self.cubes is None and 'sparse' in self.data:
+            shutil.copyfile(self.data['sparse'], path)
+        else:
+            SparseVolume.from_cubes(*self.current_cubes(), threshold=threshold).save(path)
+        self._save_xy(xy_path)
+        data['sparse'], data['xy_data'] = path, xy_path
+        return data
+
     def update_surface(self):
         """
         Refresh self.surface view
@@ -215,295 +630,670 @@ class Controller(object):
                         'select one of them by selecting any part of it.')
 
 
+class TrajectoryController(Controller):
+
+    """
+    Compute NCIPlot for every frame of a MD Movie ensemble, or of a
+    multi-frame XYZ file, and display the volumes of the active frame.
+
+    Frames are computed by a `trajectory.FrameScheduler`, closest to the
+    active frame first. Volumes of the last `keep` frames stay open (hidden)
+    and the cubes of the next `prefetch` frames are parsed in background
+    threads, so moving through frames does not stall the GUI.
+    """
+
+    def __init__(self, gui=None, nciplot_binary=None, nciplot_dat=None, engine='nciplot',
+                 prefetch=3, keep=4, *args, **kwargs):
+        super(TrajectoryController, self).__init__(gui=gui, nciplot_binary=nciplot_binary,
+                                                   nciplot_dat=nciplot_dat, engine=engine,
+                                                   *args, **kwargs)
+        self.prefetch = prefetch
+        self.keep = keep
+        self.frames = {}
+        self.volumes = OrderedDict()
+        self.prefetcher = CubePrefetcher(capacity=2 * prefetch + 1)
+        self.scheduler = None
+        self.workdir = None
+        self.molecule = None
+        self.current_frame = None
+        self.task = None
+        self._n_frames = 0
+        self._handler = None
+
+    def run(self, atoms=None, groups=None, xyz_trajectory=None, **options):
+        """
+        Schedule all frames. If `xyz_trajectory` is given, its frames are
+        used; otherwise, the coordinate sets of the molecule owning the
+        atoms (or the selected molecule) are exported with `atoms2xyz`.
+        Domain decomposition and interface truncation are not available.
+        """
+        options.pop('domains', None)
+        if options.pop('interface', None):
+            # atoms near the interface change from frame to frame, and so would the boxes
+            chimera.replyobj.warning('Interface truncation is not available for trajectories. '
+                                     'All atoms of the selected groups are computed.\n')
+        self.workdir = workdir = scratch_space.create(prefix='nciplot_traj_')
+        if xyz_trajectory:
+            frames = split_xyz_trajectory(xyz_trajectory, workdir)
+            current = min(frames) if frames else None
+        else:
+            if atoms:
+                groups = [atoms]
+            elif not groups:
+                groups = [m.atoms for m in self.selected_molecules]
+            self.molecule = groups[0][0].molecule
+            frames = OrderedDict()
+            for i, coordset in sorted(self.molecule.coordSets.items()):
+                frames[i] = [atoms2xyz(group, coordset=coordset,
+                                       path=os.path.join(workdir, 'frame_{}_{}.xyz'.format(i, j)))
+                             for j, group in enumerate(groups)]
+            current = self.molecule.activeCoordSet.id
+            self._handler = chimera.triggers.addHandler('Molecule', self._coordset_changed_cb,
+                                                        None)
+        if not frames:
+            raise UserError('No frames found in trajectory')
+        binary = getattr(self.nciplot, 'binary', None)
+        self.scheduler = FrameScheduler(frame_calculator(self.engine, binary=binary), workdir,
+                                        max_workers=job_queue.max_concurrency,
+                                        cache=self.cache, engine=self.engine, binary=binary)
+        self.scheduler.submit(frames, current=current, **options)
+        self.scheduler.close()
+        self._n_frames = len(frames)
+        self.current_frame = current
+        self.task = Task("NCIPlot trajectory ({} frames)".format(self._n_frames),
+                         cancelCB=self.cancel)
+        self.task.updateStatus("Computing frames")
+        chimera.tkgui.app.after(250, self._poll)
+
+    def _poll(self):
+        """
+        Collect finished frames from the scheduler, in Tk's event loop.
+        """
+        if self.scheduler is None:
+            return
+        for frame, data, error in self.scheduler.drain():
+            if error is not None:
+                chimera.replyobj.warning('NCIPlot failed for frame {}: {}\n'.format(frame, error))
+                self.frames[frame] = None
+                continue
+            self.frames[frame] = data
+            if frame == self.current_frame:
+                self.show_frame(frame)
+            elif self._in_window(frame):
+                self.prefetcher.prefetch(frame, data)
+        if self.task is not None:
+            self.task.updateStatus("{}/{} frames computed".format(len(self.frames),
+                                                                 self._n_frames))
+        if len(self.frames) < self._n_frames:
+            chimera.tkgui.app.after(250, self._poll)
+        elif self.task is not None:
+            self.task.finished()
+            self.task = None
+
+    def _in_window(self, frame):
+        return 0 < frame - self.current_frame <= self.prefetch or frame == self.current_frame - 1
+
+    def show_frame(self, frame):
+        """
+        Display the volumes of `frame`, hiding the rest, and start loading
+        the cubes of the following frames.
+        """
+        self.current_frame = frame
+        for surface, _ in self.volumes.values():
+            surface.unshow()
+        data = self.frames.get(frame)
+        if data is None:  # not computed yet; shown by _poll when ready
+            return
+        self.data = data
+        if frame in self.volumes:
+            self.surface, self.density = self.volumes.pop(frame)
+            self.surface.show()
+        else:
+            cubes = self.prefetcher.get(frame)
+            if cubes is not None:
+                self.surface, self.density = self.draw_cubes(*cubes)
+            else:
+                self.surface, self.density = self.draw()
+            self.style_surface()
+        self.volumes[frame] = self.surface, self.density
+        while len(self.volumes) > self.keep:
+            _, models = self.volumes.popitem(last=False)
+            chimera.openModels.close(list(models))
+        for f, data in self.frames.items():
+            if data is not None and self._in_window(f):
+                self.prefetcher.prefetch(f, data)
+        self.gui._run_nciplot_cb(self)
+
+    def _coordset_changed_cb(self, trigger_name, data, changes):
+        if self.molecule is None or self.molecule not in changes.modified:
+            return
+        if 'active coordset changed' in changes.reasons:
+            self.show_frame(self.molecule.activeCoordSet.id)
+
+    def cancel(self):
+        if self.scheduler is not None:
+            self.scheduler.cancel()
+            self.scheduler = None
+        if self._handler is not None:
+            chimera.triggers.deleteHandler('Molecule', self._handler)
+            self._handler = None
+        self.prefetcher.close()
+        if self.workdir is not None:
+            scratch_space.release(self.workdir)
+            self.workdir = None
+
+
 class NCIPlot(object):
 
     """
-    A wrapper around NCIPlot binary interface
+    A wrapper around NCIPlot binary interface.
+
+    Each call to `run` creates a `NCIPlotJob`, which is scheduled in a
+    `JobQueue` shared by all instances, so several calculations can be
+    in flight at the same time.
     """
 
-    def __init__(self, binary, dat_directory, success_callback=None, clear_callback=None):
+    def __init__(self, binary, dat_directory, success_callback=None, clear_callback=None,
+                 queue=None):
         self._check_paths(binary, dat_directory)
         self.binary = binary
         self.dat_directory = dat_directory
         os.environ['NCIPLOT_HOME'] = os.path.dirname(self.dat_directory)
         self.success_callback = success_callback
         self.clear_callback = clear_callback
-        self.task = None
-        self.subprocess = None
-        self.stdout = None
-        self.queue = None
-        self.implementation = 'CUDA' if 'cuda' in os.path.split(self.binary)[1].lower() \
-                                     else 'CPU'
-        self.parse_stdout = self._parse_stdout_cuda if self.implementation == 'CUDA' \
-                                                    else self._parse_stdout_cpu
+        self.queue = job_queue if queue is None else queue
+        self.jobs = []
+        self.implementation = implementation(self.binary)
 
     def run(self, *xyz, **options):
         """
         Launch a NCIPlot essay for specified xyz files and options.
         Read on self.create_nci_method documentation for further info.
 
-        Notes
-        -----
-        This function uses threads, queues, tasks and subprocesses, so it 
-        can be a bit difficult to understand for newcomers.
-
-        `subprocess` is used to launch an external program (nciplot, in this
-        case), and `task` is a Chimera feature to monitor that process in the
-        tasks panels. It also allows to print status updates to the bottom bar.
-        `task` and `subprocess` are synced with Chimera's `monitor`, which
-        includes a very useful `afterCB` parameter: a callable that will be
-        called when the process ends.
-
-        If we needed to get it in realtime, we should add queues and threads.
-        As a workaround, we need to get the stdout to an async queue (in
-        realtime!) with a separate thread. 
-        >>> from threading import Thread
-        >>> from Queue import Queue
-        >>> def enqueue_output(out, queue):
-                for line in iter(out.readline, b''):
-                    queue.put(line)
-                out.close()
-        >>> self.queue = Queue()
-        >>> thread = Thread(target=enqueue_output, args=(self.subprocess.stdout, self.queue))
-        >>> thread.daemon = True  # thread dies with the program
-        >>> thread.start()
-
-        Then, we can read the stdout from the queue:
-
-        >>> self.queue.put(None) # Sentinel value. When iter gets this, it stops.
-        >>> for line in iter(self.queue.get, None):
-        >>>     # do stuff
-
-        Check this SO answer for more info:
-        
-        http://stackoverflow.com/questions/375427/
-        non-blocking-read-on-a-subprocess-pipe-in-python/4896288#4896288
-        
+        If `domains` is greater than 1, the run is split in several NCIPlot
+        processes. Check `DecomposedNCIPlotJob`. `job_id` tags the stages
+        recorded by `instrument.recorder`.
+
+        Returns
+        -------
+        job : NCIPlotJob
+            The scheduled job. It will start as soon as the queue has a free slot.
+        """
+        job_id = options.pop('job_id', None)
+        if options.get('domains', 1) > 1:
+            job = DecomposedNCIPlotJob(self, xyz, options, job_id=job_id)
+        else:
+            options.pop('domains', None)
+            job = NCIPlotJob(self, xyz, options, job_id=job_id)
+        self.jobs.append(job)
+        self.queue.submit(job)
+        return job
+
+    def _job_done(self, job, data=None):
+        """
+        Called by each job when it ends, successfully (with `data`) or not.
+        """
+        if job in self.jobs:
+            self.jobs.remove(job)
+        if data is None:
+            if self.clear_callback is not None:
+                self.clear_callback()
+        elif self.success_callback is not None:
+            self.success_callback(data)
+
+    create_nci_input = staticmethod(create_nci_input)
+
+    def _check_paths(self, binary, dat_directory):
+        """
+        Check if paths are OK, we need to bring up defaults, or if they
+        have been never set
+        """
+        if not os.path.isfile(binary):
+            raise UserError('Specified NCIplot binary path {} does not exist'.format(binary))
+        if not os.path.isdir(dat_directory):
+            raise UserError('Specified NCIplot dat library path {} does not exist'.format(dat_directory))
+
+
+class QueuedPromolecularNCI(PromolecularNCI):
+
+    """
+    `PromolecularNCI` scheduled like `NCIPlot`: each `run` creates a
+    `PromolecularJob`, which takes a slot of the shared `JobQueue` and
+    computes the grids in a worker thread, so Chimera stays responsive.
+    Results are still reported in memory, from Tk's event loop.
+    """
+
+    def __init__(self, *args, **kwargs):
+        queue = kwargs.pop('queue', None)
+        super(QueuedPromolecularNCI, self).__init__(*args, **kwargs)
+        self.queue = job_queue if queue is None else queue
+        self.jobs = []
+
+    def run(self, *xyz, **options):
+        """
+        Schedule the calculation of the specified xyz files and options.
+
+        Returns
+        -------
+        job : PromolecularJob
+            The scheduled job. It will start as soon as the queue has a free slot.
+        """
+        job_id = options.pop('job_id', None)
+        options.pop('domains', None)
+        box = options.pop('domain_box', None)
+        if box is not None:  # no decomposition here, it is just the grid box
+            options['cube'] = box
+        job = PromolecularJob(self, xyz, options, job_id=job_id)
+        self.jobs.append(job)
+        self.queue.submit(job)
+        return job
+
+    def _job_done(self, job, data=None):
         """
-        nci_file = osTemporaryFile(suffix='.nci')
-        oldworkingdir = os.getcwd()
-        tmpdir, tmpfile = os.path.split(nci_file)
-        if 'name' not in options or options['name'] is None:
-            options['name'] = tmpfile[:-4]
-        nci_input = self.create_nci_input(xyz, **options)
-        os.chdir(tmpdir)
+        Called by each job when it ends, successfully (with `data`) or not.
+        """
+        if job in self.jobs:
+            self.jobs.remove(job)
+        if data is None:
+            if self.clear_callback is not None:
+                self.clear_callback()
+        elif self.success_callback is not None:
+            self.success_callback(data)
+
+
+class NCIPlotJob(object):
+
+    """
+    A single NCIPlot process, with its own Chimera task and output location.
+
+    Notes
+    -----
+    `subprocess` is used to launch an external program (nciplot, in this
+    case), and `task` is a Chimera feature to monitor that process in the
+    tasks panels. It also allows to print status updates to the bottom bar.
+    `task` and `subprocess` are synced with Chimera's `monitor`, which
+    includes a very useful `afterCB` parameter: a callable that will be
+    called when the process ends.
+
+    To report progress while the process runs, stdout is consumed by a
+    separate thread (`enqueue_output`) into a queue, which is drained from
+    Tk's event loop every `poll_interval` ms and fed to a
+    `runner.ProgressTracker`. The collected lines are parsed at the end.
+
+    Check this SO answer for more info:
+
+    http://stackoverflow.com/questions/375427/
+    non-blocking-read-on-a-subprocess-pipe-in-python/4896288#4896288
+    """
+
+    poll_interval = 500
+
+    def __init__(self, nciplot, xyz, options, job_id=None):
+        self.nciplot = nciplot
+        self.binary = nciplot.binary
+        self.job_id = job_id
+        self._stage = recorder.start('queued', job=job_id)
+        self.xyz = xyz
+        self.options = options
+        self.subprocess = None
+        self.workdir = None
+        self.cancelled = False
+        self.progress = ProgressTracker()
+        self._stdout = Queue()
+        self._reader = None
+        self.parse_stdout = parse_stdout_cuda if nciplot.implementation == 'CUDA' \
+                                              else parse_stdout_cpu
+        self.name = ', '.join(os.path.basename(f) for f in xyz)
+        self.task = Task(self.title(), cancelCB=self.cancel)
+        self.task.updateStatus("Queued")
+
+    def title(self):
+        return "NCIPlot for {}".format(self.name)
+
+    def start(self):
+        """
+        Launch the process. Called by `JobQueue` when a slot is free.
+
+        The process runs in a new directory from `scratch_space` (as its
+        `cwd`, so the working directory of Chimera is left untouched),
+        which is released when the job finishes. It is RAM-backed if the
+        scratch preferences allow for the expected output size.
+        """
+        self._stage.stop()
+        self._stage = recorder.start('nciplot', job=self.job_id, children=True,
+                                     implementation=self.nciplot.implementation)
+        self.workdir = scratch_space.create(
+            expected_size=estimate_output_size(self.xyz, **self.options))
+        if self.options.get('name') is None:
+            self.options['name'] = os.path.basename(self.workdir)
+        xyz = self.xyz
+        if self.nciplot.implementation == 'CUDA':
+            # cuNCI writes its outputs next to the molecule files
+            xyz = [os.path.join(self.workdir, os.path.basename(path)) for path in self.xyz]
+            for src, dst in zip(self.xyz, xyz):
+                shutil.copyfile(src, dst)
+        nci_file = os.path.join(self.workdir, self.options['name'] + '.nci')
         with open(nci_file, 'w') as f:
-            f.write(nci_input.read())
-        name = ', '.join(os.path.basename(f) for f in xyz)
-        self._tmpdir = tmpdir
-        self.task = Task("NCIPlot for {}".format(name), cancelCB=self._clear_task)
-        self.subprocess = Popen([self.binary, nci_file], stdout=PIPE, progressCB= lambda p: 0)
+            f.write(create_nci_input(xyz, **self.options).read())
+        self.subprocess = Popen([self.binary, nci_file], stdout=PIPE, cwd=self.workdir)
+        self._reader = Thread(target=enqueue_output, args=(self.subprocess.stdout, self._stdout))
+        self._reader.daemon = True
+        self._reader.start()
         monitor("NCIPlot", self.subprocess, task=self.task, afterCB=self._after_cb)
         self.task.updateStatus("Running NCIPlot")
-        os.chdir(oldworkingdir)
+        chimera.tkgui.app.after(self.poll_interval, self._progress_cb)
+
+    def _read_progress(self):
+        for line in iter_queue(self._stdout):
+            self.progress.feed(line)
+
+    def _progress_cb(self):
+        """
+        Report stdout progress in the task status while the process runs.
+        """
+        if self.cancelled or self.subprocess is None or self.subprocess.poll() is not None:
+            return
+        self._read_progress()
+        self.task.updateStatus(self.progress.status())
+        chimera.tkgui.app.after(self.poll_interval, self._progress_cb)
+
+    def cancel(self):
+        """
+        Called from the tasks panel. Queued jobs are simply dropped.
+        """
+        self.cancelled = True
+        if self.subprocess is None:
+            self._finish()
 
     def _after_cb(self, aborted):
         """
         Called after the subprocess ends.
         """
-        if aborted:
-            self._clear_task()
-            self.clear_callback()
+        self._stage.stop(returncode=self.subprocess.returncode, points=self.progress.points)
+        if aborted or self.cancelled:
+            self._finish()
             return
         if self.subprocess.returncode != 0:
             self.task.updateStatus("NCIPlot calculation failed!")
-            self._clear_task()
-            self.clear_callback()
+            self._finish()
             return
         self.task.updateStatus("Parsing NCIPlot output")
-        data = self.parse_stdout(self.subprocess.stdout)
+        with recorder.stage('parse_stdout', job=self.job_id):
+            self._reader.join(5)
+            self._read_progress()
+            self.progress.finished()
+            data = self.parse_stdout(self.progress.lines, self.workdir)
         self.task.updateStatus("Loading volumes")
-        self.success_callback(data)
-        self.task.updateStatus("Done!")
-        self._clear_task()
+        self._finish(data)
 
-    def _clear_task(self):
+    def _finish(self, data=None):
         """
-        House cleaning 
+        House cleaning. Frees the queue slot and reports back to `NCIPlot`.
         """
+        self._stage.stop(cancelled=self.cancelled)
+        if self.subprocess is not None and self._reader is None:
+            self.subprocess.stdout.close()  # otherwise, the reader closes it
+        if self.workdir is not None:
+            scratch_space.release(self.workdir, success=data is not None)
+        self.nciplot.queue.done(self)
+        self.nciplot._job_done(self, data)
+        if data is not None:
+            self.task.updateStatus("Done!")
         self.task.finished()
-        self.subprocess.stdout.close()
-        self.task, self.subprocess, self.queue, self._tmpdir = None, None, None, None
 
-    def _parse_stdout_cpu(self, stdout):
+
+class DecomposedNCIPlotJob(NCIPlotJob):
+
+    """
+    Split the bounding box in `domains` overlapping sub-boxes, compute
+    them concurrently in a pool of `max_workers` NCIPlot processes and
+    stitch the resulting cubes. The pool runs in a separate thread, which
+    is polled from Tk's event loop. It takes a single `JobQueue` slot.
+    """
+
+    def __init__(self, nciplot, xyz, options, job_id=None):
+        self.decomposition = DomainDecomposition(nciplot.binary,
+                                                 domains=options.pop('domains', 4),
+                                                 max_workers=options.pop('max_workers', None),
+                                                 box=options.pop('domain_box', None))
+        try:
+            self.decomposition.check_options(**options)
+        except ValueError:
+            nciplot.clear_callback()
+            raise
+        super(DecomposedNCIPlotJob, self).__init__(nciplot, xyz, options, job_id=job_id)
+        self._result = {}
+
+    def title(self):
+        return "NCIPlot for {} ({} domains)".format(self.name, self.decomposition.domains)
+
+    def start(self):
+        self._stage.stop()
+        self._stage = recorder.start('nciplot', job=self.job_id, children=True,
+                                     implementation=self.nciplot.implementation,
+                                     domains=self.decomposition.domains)
+        self.workdir = scratch_space.create(
+            expected_size=estimate_output_size(self.xyz, **self.options))
+        if self.options.get('name') is None:
+            self.options['name'] = os.path.basename(self.workdir)
+        thread = Thread(target=self._run_thread, args=(self.workdir,))
+        thread.daemon = True
+        thread.start()
+        self.task.updateStatus("Running NCIPlot in {} domains".format(self.decomposition.domains))
+        chimera.tkgui.app.after(250, self._poll, thread)
+
+    def _run_thread(self, workdir):
+        try:
+            self._result['data'] = self.decomposition.run(self.xyz, workdir, **self.options)
+        except Exception as e:
+            self._result['error'] = e
+
+    def _poll(self, thread):
         """
-        Get useful data from NCIPlot stdout, or any file-like object.
+        Wait for the decomposition thread without blocking the GUI.
         """
-        data = {}
-        data['_raw'] = []
-        for line in stdout:
-            if line.startswith('#') or line.startswith('---'):
-                continue
-            elif line.lstrip().startswith('RHO'):
-                data['rho'] = float(line.split()[-1].strip())
-            elif line.lstrip().startswith('RDG'):
-                data['rdg'] = float(line.split()[-1].strip())
-            elif line.rstrip().endswith('-grad.cube'):
-                data['grad_cube'] = os.path.join(self._tmpdir, line.split('=')[-1].strip())
-            elif line.rstrip().endswith('-dens.cube'):
-                data['dens_cube'] = os.path.join(self._tmpdir, line.split('=')[-1].strip())
-            elif 'LS x RDG' in line:
-                data['xy_data'] = os.path.join(self._tmpdir, line.split('=')[-1].strip())
-            data['_raw'].append(line)
-        return data
+        if thread.is_alive():
+            if self.decomposition.total and not self.cancelled:
+                self.task.updateStatus("Running NCIPlot: {}/{} domains done ({} elapsed)".format(
+                    self.decomposition.done, self.decomposition.total,
+                    format_seconds(self.progress.elapsed())))
+            chimera.tkgui.app.after(250, self._poll, thread)
+            return
+        if self.cancelled:
+            self._finish()
+        elif 'error' in self._result:
+            self.task.updateStatus("NCIPlot calculation failed!")
+            chimera.replyobj.error('NCIPlot failed: {}\n'.format(self._result['error']))
+            self._finish()
+        else:
+            self.task.updateStatus("Loading volumes")
+            self._finish(self._result['data'])
 
-    def _parse_stdout_cuda(self, stdout):
-        """
-        Get useful data from CUDA NCIPlot [1] stdout, or any file-like object.
+    def cancel(self):
+        self.cancelled = True
+        self.decomposition.cancel()
 
-        [1] A GPU accelerated implementation of NCI calculations using pro-molecular
-            density. Rubez G, Etancelin JM, Vigouroux X, Krajecki M, Boisson JC, 
-            Henon E., J. Comput. Chem. 2017, 38, 1071
-        """
-        data = {}
-        basedir = None
-        data['_raw'] = []
-        for line in stdout:
-            data['_raw'].append(line)
-            line = line.strip()
-            if not line.startswith('*'):
-                continue
-            line = line.strip('*')
-            if 'MoleculeFile' in line:
-                basedir = os.path.split(line.split(':')[1].split()[0])[0]
-            elif basedir and 'OutPut filenam Prefix' in line:
-                basename = line.split(':')[1].strip()
-                data['grad_cube'] = os.path.join(basedir, basename + '-RDG.cube')
-                data['dens_cube'] = os.path.join(basedir, basename + '-dens.cube')
-                data['xy_data'] = os.path.join(basedir, basename + '.dat')
-            elif '.cube rho range' in line:
-                data['rho'] = float(line.split()[6])
-            elif '.dat rdg range' in line:
-                data['rdg'] = float(line.split()[6])
 
-        return data
+class PromolecularJob(object):
 
-    @staticmethod
-    def create_nci_input(paths, output_level=3, ligand=None,
-                         dat_cutoffs=(0.2, 1.0), cube_cutoffs=(0.07, 0.3), intermolecular=None,
-                         radius=None, cube=None, increments=None, name=None, **kwargs):
-        """
-        Creates a file-like object with NCIPlot input options
+    """
+    A promolecular calculation, with its own Chimera task. Like
+    `DecomposedNCIPlotJob`, it runs in a separate thread, polled from Tk's
+    event loop, and takes a single `JobQueue` slot.
+    """
 
-        Parameters
-        ----------
-        paths : list of str
-            Paths to XYZ molecule files.
-
-        # Output options
-        name : str, optional, default=None
-            If set, replaces the output name, which by default is the molecule name
-            without extension.
-        output_level : int, optional, default=3
-            How many files should NCI plot create. Level 1 is minimum output, level 3
-            creates up to 4 files.
-        dat_cutoffs : 2-tuple of float, optional, default=(0.2, 1.0)
-            Density and RDG cutoffs used in creating the dat file
-        cube_cutoffs : 2-tuple of float, optional, default=(0.07, 0.3)
-            Density (r1) and RDG (r2) cutoffs used when creating the cube files. 
-            r1 will set the cutoff for both the density and the RDG to be registered
-            in the cube files, whereas r2 will be used for isosurfaces depiction.
-
-        # Search options; If set, only a region will be explored. CHOOSE ONLY ONE!
-        ligand : 2-tuple of float, int, optional, default=None
-            If set, which molecule (by index) is working as a ligand, and the search
-            radius to inspect within that molecule.
-        intermolecular: float, optional, default=None
-            If set, the search radius for interactions in between input molecules
-        radius : 4-tuple of float, optional, default=None
-            If set, first three values indicate the origin coordinates of the search
-            sphere, and the fourth value indicates the search radius of such sphere.
-        cube : 6-tuple of float, optional, default=None
-            If set, search within the cube that is drawn between point A (first three
-            floats) and point B (last three floats).
-        increments : 3-tuple of float, optional, default=None
-            ???
+    poll_interval = 100
+
+    def __init__(self, nciplot, xyz, options, job_id=None):
+        self.nciplot = nciplot
+        self.job_id = job_id
+        self._stage = recorder.start('queued', job=job_id)
+        self.xyz = xyz
+        self.options = options
+        self.started = False
+        self.cancelled = False
+        self._result = {}
+        self.name = ', '.join(os.path.basename(f) for f in xyz)
+        self.task = Task(self.title(), cancelCB=self.cancel)
+        self.task.updateStatus("Queued")
+
+    def title(self):
+        return "Promolecular NCI for {}".format(self.name)
+
+    def start(self):
+        self._stage.stop()
+        self._stage = recorder.start('compute', job=self.job_id,
+                                     implementation=self.nciplot.implementation)
+        self.started = True
+        thread = Thread(target=self._run_thread)
+        thread.daemon = True
+        thread.start()
+        self.task.updateStatus("Computing promolecular NCI grids")
+        chimera.tkgui.app.after(self.poll_interval, self._poll, thread)
+
+    def _run_thread(self):
+        try:
+            self._result['data'] = self.nciplot.compute_in_memory(self.xyz, **self.options)
+        except Exception as e:
+            self._result['error'] = e
 
-        Returns
-        -------
-        paths : list of str
-            Collection of output files created by NCIPlot
-
-        Notes
-        -----
-        NCI input files follow this scheme. More info @ 
-        https://github.com/aoterodelaroza/nciplot
-
-            <number of molecule files>
-            <path to molecule file, xyz or wfn>
-            <path to molecule file>...
-            # Optional
-            LIGAND n r #index of molecule in path list, search radius
-            INTERMOLECULAR r # search radius
-            RADIUS x y z r # coordinates center, radius
-            CUBE x0 y0 z0 x1 y1 z1 # draw a cube from a to b
-            INCREMENTS r1 r2 r3 
-            CUTOFFS r1 r2 # density and RDG cutoffs for dat file; defaults: 0.2, 1.0
-            CUTPLOT r1 r2 # density and RDG cutoffs for cube file; defaults: 0.07, 0.3
-            ISORDG r # isosurface level; 0.3 for xyz mols, 0.5 for wfn mols
-            OUTPUT [1-3] # level of output: 1 is minimal, 3 max
-            ONAME str # tag name
-        """
-
-        output = StringIO()
-        output.write('{}\n'.format(len(paths)))
-        for path in paths:
-            output.write('{}\n'.format(path))
-
-        if output_level in (1, 2, 3):
-            output.write('OUTPUT {}\n'.format(output_level))
-        if name:
-            output.write('ONAME {}\n'.format(name))
-        if dat_cutoffs:
-            output.write('CUTOFFS {} {}\n'.format(*dat_cutoffs[:2]))
-        if cube_cutoffs:
-            output.write('CUTPLOT {} {}\n'.format(*cube_cutoffs[:2]))
-
-        if ligand:
-            output.write('LIGAND {} {}\n'.format(*ligand[:2]))
-        elif intermolecular:
-            output.write('INTERMOLECULAR {}\n'.format(intermolecular))
-        elif radius:
-            output.write('RADIUS {} {} {} {}\n'.format(*radius[:4]))
-        elif cube:
-            output.write('CUBE {} {} {} {} {} {}\n'.format(*cube[:6]))
-        elif increments:
-            output.write('INCREMENTS {} {} {}\n'.format(*increments[:3]))
-
-        output.seek(0)
-        return output
+    def _poll(self, thread):
+        """
+        Wait for the calculation thread without blocking the GUI.
+        """
+        if thread.is_alive():
+            chimera.tkgui.app.after(self.poll_interval, self._poll, thread)
+            return
+        if self.cancelled:
+            self._finish()
+        elif 'error' in self._result:
+            self.task.updateStatus("NCI calculation failed!")
+            chimera.replyobj.error('Promolecular NCI failed: {}\n'.format(self._result['error']))
+            self._finish()
+        else:
+            self.task.updateStatus("Loading volumes")
+            self._finish(self._result['data'])
 
-    def _check_paths(self, binary, dat_directory):
+    def cancel(self):
         """
-        Check if paths are OK, we need to bring up defaults, or if they
-        have been never set
+        Called from the tasks panel. Queued jobs are simply dropped. NumPy
+        cannot be interrupted, so running ones are discarded when done.
         """
-        if not os.path.isfile(binary):
-            raise UserError('Specified NCIplot binary path {} does not exist'.format(binary))
-        if not os.path.isdir(dat_directory):
-            raise UserError('Specified NCIplot dat library path {} does not exist'.format(dat_directory))
+        self.cancelled = True
+        if not self.started:
+            self._finish()
+
+    def _finish(self, data=None):
+        """
+        House cleaning. Frees the queue slot and reports back to the engine.
+        """
+        self._stage.stop(cancelled=self.cancelled)
+        self.nciplot.queue.done(self)
+        self.nciplot._job_done(self, data)
+        if data is not None:
+            self.task.updateStatus("Done!")
+        self.task.finished()
 
 
-def molecule2xyz(molecule, path=None):
+class JobQueue(object):
+
     """
-    Saves the given molecule in XYZ format.
+    Schedules NCIPlot jobs so no more than `max_concurrency` run at once.
+    The rest wait, in submission order, in the tasks panel.
+    """
+
+    def __init__(self, max_concurrency=2):
+        self.max_concurrency = max_concurrency
+        self.pending = deque()
+        self.running = []
+
+    def submit(self, job):
+        self.pending.append(job)
+        self._schedule()
+
+    def done(self, job):
+        if job in self.running:
+            self.running.remove(job)
+        elif job in self.pending:
+            self.pending.remove(job)
+        self._schedule()
+
+    def _schedule(self):
+        while self.pending and len(self.running) < max(1, self.max_concurrency):
+            job = self.pending.popleft()
+            self.running.append(job)
+            try:
+                job.start()
+            except Exception:
+                job._finish()
+                raise
+
+
+job_queue = JobQueue()
+result_cache = ResultCache()
+field_cache = FieldCache()
+scratch_space = ScratchSpace()
+atexit.register(scratch_space.cleanup)
+
+
+XYZExport = namedtuple('XYZExport', 'path elements coords')
+
+
+def atoms_arrays(atoms, coordset=None):
+    """
+    Element symbols and coordinates of `atoms`, gathered in one pass.
+
+    Coordinates of the active coordinate set are read in bulk with
+    MultiScale's `get_atom_coordinates` when available. Other frames
+    are read atom by atom.
+
+    Returns
+    -------
+    elements : np.ndarray of str, shape=(N,)
+    coords : np.ndarray of float, shape=(N, 3)
+        Untransformed coordinates, in Angstrom.
+    """
+    elements = np.array([a.element.name for a in atoms])
+    if coordset is None and get_atom_coordinates is not None:
+        coords = np.asarray(get_atom_coordinates(atoms, transformed=False), dtype=float)
+    elif coordset is None:
+        coords = np.array([tuple(a.coord()) for a in atoms], dtype=float)
+    else:
+        coords = np.array([tuple(a.coord(coordset)) for a in atoms], dtype=float)
+    return elements, coords.reshape(-1, 3)
+
+def export_xyz(atoms, path=None, coordset=None, title=None):
+    """
+    Save the given atoms in XYZ format, keeping the exported arrays.
 
     Parameters
     ----------
-    molecule : chimera.Molecule
+    atoms : list of chimera.Atom
     path : str, optional
         Desired output location. If not provided, a temporary one will be used.
+    coordset : chimera.CoordSet, optional
+        Trajectory frame to export. Defaults to the active one.
+    title : str, optional
+        Comment line. Defaults to the name of the molecule of the first atom.
+
+    Returns
+    -------
+    export : XYZExport
+        `path` of the file, plus the `elements` and `coords` arrays written
+        to it (rounded like in the file), for hashing or neighbour searches
+        without reading it back.
     """
     if not path:
-        prefix = '{}__'.format(molecule.name)
+        prefix = '{}__'.format('-'.join(set(a.molecule.name for a in atoms)))
         path = osTemporaryFile(prefix=prefix, suffix='.xyz')
-    with open(path, 'w') as f:
-        f.write('{}\n{}\n'.format(len(molecule.atoms), molecule.name))
-        for atom in molecule.atoms:
-            f.write('{} {} {} {}\n'.format(atom.element.name, *atom.coord()))
-    return path
+    if title is None:
+        title = atoms[0].molecule.name if atoms else ''
+    elements, coords = atoms_arrays(atoms, coordset=coordset)
+    write_xyz(path, elements, coords, title=title)
+    # as written, so hashes match those of the file
+    return XYZExport(path, elements, np.round(coords, XYZ_DECIMALS))
 
-def atoms2xyz(atoms, path=None):
+def molecule2xyz(molecule, path=None):
     """
     Saves the given molecule in XYZ format.
 
@@ -513,14 +1303,45 @@ def atoms2xyz(atoms, path=None):
     path : str, optional
         Desired output location. If not provided, a temporary one will be used.
     """
-    if not path:
-        prefix = '{}__'.format('-'.join(set(a.molecule.name for a in atoms)))
-        path = osTemporaryFile(prefix=prefix, suffix='.xyz')
-    with open(path, 'w') as f:
-        f.write('{}\n{}\n'.format(len(atoms), atoms[0].molecule.name))
-        for atom in atoms:
-            f.write('{} {} {} {}\n'.format(atom.element.name, *atom.coord()))
-    return path
+    return export_xyz(molecule.atoms, path=path, title=molecule.name).path
+
+def atoms2xyz(atoms, path=None, coordset=None):
+    """
+    Saves the given atoms in XYZ format. Check `export_xyz`.
+
+    Parameters
+    ----------
+    atoms : list of chimera.Atom
+    path : str, optional
+        Desired output location. If not provided, a temporary one will be used.
+    coordset : chimera.CoordSet, optional
+        Trajectory frame to export. Defaults to the active one.
+    """
+    return export_xyz(atoms, path=path, coordset=coordset).path
+
+def volume_from_cube(cube, name, model_id=None):
+    """
+    Open a `cube.Cube` (bohr units, [x, y, z] data) as a VolumeViewer
+    volume, without going through a file. Memory-mapped sidecar data
+    from `cube.load_cube` is passed as is, without copies.
+    """
+    data = np.ascontiguousarray(cube.data.transpose(2, 1, 0), dtype=np.float32)
+    grid = Array_Grid_Data(data, origin=tuple(cube.origin * BOHR),
+                           step=tuple(cube.spacing * BOHR), name=name)
+    return volume_from_grid_data(grid, show_dialog=False, model_id=model_id)
+
+def surface_value_range(gradient, density, level=0.3):
+    """
+    Range of `density` values over the voxels where `gradient` is under
+    the isosurface `level`, as an estimate of the range over the surface
+    vertices. Returns (None, None) if there are no such voxels, like
+    `Volume_Color.value_range` does.
+    """
+    inside = np.asarray(gradient.data) < level
+    if not inside.any():
+        return None, None
+    values = np.asarray(density.data)[inside]
+    return float(values.min()), float(values.max())
 
 def enqueue_output(out, queue):
     """
@@ -551,7 +1372,7 @@ def iter_queue(q):
     while True:
         try:
             yield q.get_nowait()
-        except Empty:  # on python 2 use Queue.Empty
+        except Empty:
             break
 
 def interpolate_range_into_n_values(vrange, n):
@@ -564,9 +1385,3 @@ def interpolate_range_into_n_values(vrange, n):
     for i in range(1, n):
         a = a + delta
         yield a
-
-if __name__ == '__main__':
-    path = 'nciplot/src/nciplot'
-    dat = 'nciplot/dat'
-    c = Controller(nciplot_binary=path, nciplot_dat=dat)
-    c.run()
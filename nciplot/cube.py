@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Chimera-free helpers to handle Gaussian cube files, as written by NCIPlot.
+"""
+
+from __future__ import print_function, division
+# Python stdlib
+import os
+from collections import namedtuple
+# Additional 3rd parties
+import numpy as np
+
+
+Cube = namedtuple('Cube', 'data origin spacing numbers coords comments')
+COMMENTS = ('NCIPlot cube file', 'OUTER LOOP: X, MIDDLE LOOP: Y, INNER LOOP: Z')
+
+
+def read_cube(path):
+    """
+    Read a Gaussian cube file with an orthogonal grid.
+
+    Parameters
+    ----------
+    path : str
+        Location of the cube file.
+
+    Returns
+    -------
+    cube : Cube
+        `data` is indexed as [x, y, z]; `origin`, `spacing` and `coords`
+        keep the units of the file (bohr for NCIPlot).
+    """
+    with open(path) as f:
+        header, shape = _read_header(f)
+        data = np.fromstring(f.read(), dtype=float, sep=' ')
+    if data.size != np.prod(shape):
+        raise ValueError('Cube file {} has {} values, expected {}'.format(
+                         path, data.size, np.prod(shape)))
+    return Cube(data.reshape(shape), *header)
+
+
+def _read_header(f):
+    """
+    Parse the header of an open cube file, leaving `f` at the first value.
+
+    Returns
+    -------
+    header : tuple
+        (origin, spacing, numbers, coords, comments), as in `Cube`.
+    shape : tuple of int
+        (nx, ny, nz)
+    """
+    comments = (f.readline().rstrip('\n'), f.readline().rstrip('\n'))
+    fields = f.readline().split()
+    n_atoms, origin = abs(int(fields[0])), np.array(fields[1:4], dtype=float)
+    shape, spacing = [], []
+    for axis in range(3):
+        fields = f.readline().split()
+        shape.append(int(fields[0]))
+        spacing.append(float(fields[1 + axis]))
+    numbers, coords = [], []
+    for _ in range(n_atoms):
+        fields = f.readline().split()
+        numbers.append(int(fields[0]))
+        coords.append([float(x) for x in fields[2:5]])
+    header = (origin, np.array(spacing), numbers, np.array(coords).reshape(-1, 3), comments)
+    return header, tuple(shape)
+
+
+def sidecar_path(path):
+    return path + '.npy'
+
+
+def stamp_path(path):
+    return sidecar_path(path) + '.stamp'
+
+
+def cube_stamp(path):
+    """
+    Size and modification time of the cube at `path`, which its sidecar
+    must have been written for.
+    """
+    stat = os.stat(path)
+    return '{} {!r}'.format(stat.st_size, stat.st_mtime)
+
+
+def fresh_sidecar(path):
+    """
+    Whether the sidecar of the cube at `path` holds its current values.
+    """
+    try:
+        with open(stamp_path(path)) as f:
+            stamp = f.read().strip()
+        return stamp == cube_stamp(path) and os.path.isfile(sidecar_path(path))
+    except (IOError, OSError):
+        return False
+
+
+def write_stamp(path):
+    """
+    Record that the sidecar of the cube at `path` matches its current
+    contents. Silently skipped if it cannot be written.
+    """
+    try:
+        with open(stamp_path(path), 'w') as f:
+            f.write(cube_stamp(path))
+    except (IOError, OSError):
+        return None
+    return stamp_path(path)
+
+
+def load_cube(path, sidecar=True):
+    """
+    Like `read_cube`, but values are cached in a binary `.npy` sidecar next
+    to the cube file, which is memory-mapped in later calls instead of
+    parsing the text again. The sidecar is only used if the size and
+    modification time of the cube match those recorded when it was written
+    (check `fresh_sidecar`), and silently skipped if it cannot be written.
+
+    The sidecar stores float32 values in [z, y, x] order, as VolumeViewer
+    expects, so `data.transpose(2, 1, 0)` is contiguous and needs no copy.
+
+    Returns
+    -------
+    cube : Cube
+        `data` is a float32 [x, y, z] view, as in `volume_order`. It is
+        read-only when the sidecar is used.
+    """
+    npy = sidecar_path(path)
+    if sidecar and fresh_sidecar(path):
+        with open(path) as f:
+            header, shape = _read_header(f)
+        try:
+            zyx = np.load(npy, mmap_mode='r')
+        except (IOError, OSError, ValueError):
+            zyx = None
+        if zyx is not None and zyx.shape == shape[::-1]:
+            return Cube(zyx.transpose(2, 1, 0), *header)
+    cube = volume_order(read_cube(path))
+    if sidecar and write_sidecar(npy, cube.data.transpose(2, 1, 0)):
+        write_stamp(path)
+    return cube
+
+
+def volume_order(cube):
+    """
+    Copy of `cube` whose data is a float32 [x, y, z] view of a contiguous
+    [z, y, x] array, the layout VolumeViewer uses. Cubes already in that
+    layout are returned as is.
+    """
+    zyx = np.asarray(cube.data).transpose(2, 1, 0)
+    if zyx.dtype == np.float32 and zyx.flags['C_CONTIGUOUS']:
+        return cube
+    zyx = np.ascontiguousarray(zyx, dtype=np.float32)
+    return cube._replace(data=zyx.transpose(2, 1, 0))
+
+
+def write_sidecar(path, zyx):
+    """
+    Save a float32 [z, y, x] array as `.npy`. The file is renamed into
+    place once complete, so readers never see partial data.
+    """
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        with open(tmp, 'wb') as f:
+            np.save(f, np.ascontiguousarray(zyx, dtype=np.float32))
+        os.rename(tmp, path)
+    except (IOError, OSError):
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return None
+    return path
+
+
+def write_cube(path, data, origin, spacing, atomic_numbers=(), coords=(), comments=COMMENTS):
+    """
+    Write a 3D array in Gaussian cube format.
+
+    Parameters
+    ----------
+    path : str
+        Output location.
+    data : np.ndarray, shape=(nx, ny, nz)
+        Volumetric values, indexed as [x, y, z].
+    origin : 3-tuple of float
+        Coordinates of the first voxel, in bohr.
+    spacing : 3-tuple of float
+        Voxel size along each axis, in bohr.
+    atomic_numbers : list of int, optional
+        Atomic numbers of the atoms to include in the header.
+    coords : np.ndarray, shape=(N, 3), optional
+        Coordinates of the atoms included in the header, in bohr.
+    comments : 2-tuple of str, optional
+        The two leading comment lines.
+    """
+    data = np.asarray(data)
+    nx, ny, nz = data.shape
+    with open(path, 'w') as f:
+        f.write('{}\n{}\n'.format(*comments[:2]))
+        f.write('{:5d} {:11.6f} {:11.6f} {:11.6f}\n'.format(len(atomic_numbers), *origin))
+        f.write('{:5d} {:11.6f} {:11.6f} {:11.6f}\n'.format(nx, spacing[0], 0, 0))
+        f.write('{:5d} {:11.6f} {:11.6f} {:11.6f}\n'.format(ny, 0, spacing[1], 0))
+        f.write('{:5d} {:11.6f} {:11.6f} {:11.6f}\n'.format(nz, 0, 0, spacing[2]))
+        for z, xyz in zip(atomic_numbers, coords):
+            f.write('{:5d} {:11.6f} {:11.6f} {:11.6f} {:11.6f}\n'.format(z, float(z), *xyz))
+        _write_values(f, data.reshape(-1, nz))
+
+
+def _write_values(f, rows, batch=4096):
+    """
+    Write the (nx*ny, nz) value rows, six values per line and starting a new
+    line for each (x, y) pair, formatting `batch` rows per write call.
+    """
+    nz = rows.shape[1]
+    full, remainder = divmod(nz, 6)
+    row_fmt = ' %12.5E' * 6 + '\n'
+    row_fmt = row_fmt * full
+    if remainder:
+        row_fmt += ' %12.5E' * remainder + '\n'
+    for start in range(0, rows.shape[0], batch):
+        chunk = rows[start:start + batch]
+        f.write((row_fmt * chunk.shape[0]) % tuple(chunk.ravel()))
+
+
+def stitch_cubes(cubes, fill=0.0):
+    """
+    Merge cubes computed on overlapping boxes of the same lattice into a
+    single one. Overlapping voxels are taken from the last cube.
+
+    Parameters
+    ----------
+    cubes : list of Cube
+        All of them must share the same spacing, and their origins must lie
+        on the same lattice.
+    fill : float, optional
+        Value of the voxels not covered by any cube.
+
+    Returns
+    -------
+    cube : Cube
+    """
+    spacing = cubes[0].spacing
+    for cube in cubes[1:]:
+        if not np.allclose(cube.spacing, spacing):
+            raise ValueError('Cubes with different spacings cannot be stitched.')
+    origin = np.min([cube.origin for cube in cubes], axis=0)
+    offsets = [np.rint((cube.origin - origin) / spacing).astype(int) for cube in cubes]
+    shape = np.max([offset + cube.data.shape for offset, cube in zip(offsets, cubes)], axis=0)
+    data = np.full(tuple(shape), fill, dtype=cubes[0].data.dtype)
+    for offset, cube in zip(offsets, cubes):
+        nx, ny, nz = cube.data.shape
+        i, j, k = offset
+        data[i:i + nx, j:j + ny, k:k + nz] = cube.data
+    return Cube(data, origin, spacing, cubes[0].numbers, cubes[0].coords, cubes[0].comments)
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Domain decomposition of a NCIPlot run. The bounding box of the system is
+split in overlapping sub-boxes (NCIPlot `CUBE` keyword) sharing the same
+lattice, which are computed concurrently by separate NCIPlot processes and
+stitched back into a single pair of cubes.
+"""
+
+from __future__ import print_function, division
+# Python stdlib
+import os
+import shutil
+import threading
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+# Additional 3rd parties
+import numpy as np
+# Own
+from .cube import read_cube, write_cube, stitch_cubes
+from .runner import run_nciplot
+from .xyz import read_xyz
+
+
+SEARCH_OPTIONS = ('ligand', 'radius', 'cube')
+
+
+class DomainDecomposition(object):
+
+    """
+    Run NCIPlot over overlapping sub-boxes in a bounded pool of processes.
+
+    Parameters
+    ----------
+    binary : str
+        Path to the NCIPlot executable.
+    domains : int, optional, default=4
+        Minimum number of sub-boxes. The longest axes are split first.
+    max_workers : int, optional
+        Maximum number of concurrent NCIPlot processes. Defaults to the
+        number of CPUs.
+    overlap : int, optional, default=2
+        Extra lattice steps added on each side of every sub-box.
+    padding : float, optional, default=3.0
+        Margin around the atoms for the global box, in Angstrom.
+    increments : 3-tuple of float, optional, default=(0.1, 0.1, 0.1)
+        Lattice step, in Angstrom, unless `run` is given another one. It is
+        the same for all sub-boxes, so they share the same lattice.
+    box : 6-tuple of float, optional
+        Global box to split, (x0, y0, z0, x1, y1, z1) in Angstrom, e.g. a
+        tight box around an interface. Defaults to the box around the
+        atoms, with `padding`.
+    """
+
+    def __init__(self, binary, domains=4, max_workers=None, overlap=2, padding=3.0,
+                 increments=(0.1, 0.1, 0.1), box=None):
+        self.binary = binary
+        self.domains = domains
+        self.max_workers = max_workers
+        self.overlap = overlap
+        self.padding = padding
+        self.increments = increments
+        self.box = box
+        self.processes = []
+        self.cancelled = False
+        self.total = 0
+        self.done = 0  # finished sub-boxes, for progress reports
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def check_options(**options):
+        """
+        Sub-boxes are defined with `CUBE`, so other search options can't be used.
+        """
+        used = [key for key in SEARCH_OPTIONS if options.get(key)]
+        if used:
+            raise ValueError('Domain decomposition cannot be combined with '
+                             'these options: {}'.format(', '.join(used)))
+
+    def boxes(self, xyz, increments=None):
+        """
+        Compute the sub-boxes for the given XYZ files (or `self.box`), in
+        Angstrom, on the lattice of `increments` (defaults to `self.increments`).
+        """
+        if self.box is not None:
+            lo, hi = np.asarray(self.box[:3], dtype=float), np.asarray(self.box[3:], dtype=float)
+        else:
+            coords = np.concatenate([read_xyz(path)[1] for path in xyz])
+            lo = coords.min(axis=0) - self.padding
+            hi = coords.max(axis=0) + self.padding
+        return split_box(lo, hi, self.domains, increments or self.increments,
+                         overlap=self.overlap)
+
+    def run(self, xyz, workdir, name='nciplot', **options):
+        """
+        Compute all the sub-boxes and stitch the results in `workdir`.
+
+        Returns
+        -------
+        data : dict
+            Same keys as `runner.parse_stdout_cpu` output, pointing to the
+            stitched files.
+
+        The lattice step is the `increments` option if given, or
+        `self.increments` otherwise.
+        """
+        increments = options.pop('increments', None) or self.increments
+        self.check_options(**options)
+        xyz = [os.path.abspath(path) for path in xyz]
+        boxes = self.boxes(xyz, increments)
+        self.total, self.done = len(boxes), 0
+
+        def job(args):
+            i, box = args
+            if self.cancelled:
+                return None
+            subdir = os.path.join(workdir, '{}_{}'.format(name, i))
+            if not os.path.isdir(subdir):
+                os.makedirs(subdir)
+            result = run_nciplot(self.binary, xyz, subdir, name='{}_{}'.format(name, i),
+                                 cube=box, increments=increments,
+                                 started_callback=self.processes.append, **options)
+            with self._lock:
+                self.done += 1
+            return result
+
+        pool = ThreadPool(self.max_workers or cpu_count())
+        try:
+            results = pool.map(job, list(enumerate(boxes)))
+        finally:
+            pool.close()
+            pool.join()
+        if self.cancelled:
+            raise RuntimeError('Domain decomposition was cancelled')
+        return merge_results(results, workdir, name)
+
+    def cancel(self):
+        """
+        Stop launching sub-jobs and terminate the running ones.
+        """
+        self.cancelled = True
+        for process in self.processes:
+            if process.poll() is None:
+                process.terminate()
+
+
+def split_box(lo, hi, domains, increments, overlap=2):
+    """
+    Split the box between corners `lo` and `hi` in at least `domains`
+    sub-boxes whose corners lie on the lattice defined by `lo` and
+    `increments`, extended by `overlap` steps on each side.
+
+    Returns
+    -------
+    boxes : list of 6-tuple of float
+        (x0, y0, z0, x1, y1, z1) for each sub-box, as expected by `CUBE`.
+    """
+    lo, hi = np.asarray(lo, dtype=float), np.asarray(hi, dtype=float)
+    step = np.asarray(increments[:3], dtype=float)
+    steps = np.ceil((hi - lo) / step).astype(int)
+    counts = np.ones(3, dtype=int)
+    while counts.prod() < domains:
+        axis = np.argmax(steps / counts)
+        if steps[axis] <= counts[axis]:
+            break
+        counts[axis] += 1
+    edges = [np.rint(np.linspace(0, steps[d], counts[d] + 1)).astype(int) for d in range(3)]
+    boxes = []
+    for i in range(counts[0]):
+        for j in range(counts[1]):
+            for k in range(counts[2]):
+                first = np.array([edges[0][i], edges[1][j], edges[2][k]]) - overlap
+                last = np.array([edges[0][i + 1], edges[1][j + 1], edges[2][k + 1]]) + overlap
+                first, last = np.maximum(first, 0), np.minimum(last, steps)
+                box = np.concatenate([lo + first * step, lo + last * step])
+                boxes.append(tuple(float(x) for x in box))
+    return boxes
+
+
+def merge_results(results, workdir, name):
+    """
+    Stitch the cubes and concatenate the dat files of the sub-jobs.
+
+    Notes
+    -----
+    Points in the overlapping regions appear more than once in the merged
+    dat file. Keep `overlap` small to make this negligible in the plots.
+    """
+    data = {'_raw': []}
+    for key in ('rho', 'rdg'):
+        if key in results[0]:
+            data[key] = results[0][key]
+    for result in results:
+        data['_raw'].extend(result.get('_raw', []))
+
+    for key, suffix, fill in (('grad_cube', '-grad.cube', 100.0),
+                              ('dens_cube', '-dens.cube', 0.0)):
+        if all(key in result for result in results):
+            data[key] = os.path.join(workdir, name + suffix)
+            cube = stitch_cubes([read_cube(result[key]) for result in results], fill=fill)
+            write_cube(data[key], cube.data, cube.origin, cube.spacing, cube.numbers,
+                       cube.coords, cube.comments)
+    if all('xy_data' in result for result in results):
+        data['xy_data'] = os.path.join(workdir, name + '.dat')
+        with open(data['xy_data'], 'w') as out:
+            for result in results:
+                with open(result['xy_data']) as f:
+                    shutil.copyfileobj(f, out)
+    return data
+
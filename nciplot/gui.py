@@ -10,7 +10,6 @@ from itertools import groupby
 from operator import attrgetter
 import os
 import json
-import shutil
 # Chimera stuff
 import chimera
 from chimera.baseDialog import ModelessDialog, ModalDialog
@@ -26,10 +25,18 @@ from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 from matplotlib.figure import Figure
 # Own
 from libtangram.ui import TangramBaseDialog
-from core import Controller, standard_color_palettes
+from blobs import format_table
+from contributions import format_contributions
+from scanning import format_scan
+from core import (Controller, TrajectoryController, standard_color_palettes, job_queue,
+                  scratch_space, field_cache)
 import prefs
 
 
+ENGINES = {'NCIPlot binary': 'nciplot',
+           'Promolecular (NumPy)': 'promolecular'}
+
+
 ui = None
 def showUI():
     global ui
@@ -41,7 +48,7 @@ def showUI():
 class NCIPlotDialog(TangramBaseDialog):
 
 
-    buttons = ('Run', 'Save', 'Load', 'Close')
+    buttons = ('Run', 'Regions', 'Residues', 'Scan', 'Save', 'Load', 'Close')
     configure_dialog = None
     help = "https://github.com/insilichem/tangram_nciplot"
     VERSION = '0.0.1'
@@ -57,6 +64,12 @@ class NCIPlotDialog(TangramBaseDialog):
         self.var_input_intermolecular_enabled = tk.IntVar()
         self.var_input_intermolecular = tk.IntVar()
         self.var_input_intermolecular.set(95)
+        self.var_input_interface = tk.DoubleVar()
+        self.var_input_interface.set(6.0)
+        self.var_input_trajectory = tk.IntVar()
+        self.var_input_domains = tk.IntVar()
+        self.var_input_domains.set(1)
+        self.var_input_adaptive = tk.IntVar()
         self.var_input_summary = tk.StringVar()
         self.var_input_summary.set('Please select your input.')
         self.var_input_choice = tk.StringVar()
@@ -115,6 +128,16 @@ class NCIPlotDialog(TangramBaseDialog):
         self.ui_input_intermolecular_field = tk.Entry(self.ui_input_intermolecular_frame,
                 textvariable=self.var_input_intermolecular, state='disabled', width=3)
         self.ui_input_intermolecular_field.pack(side='left')
+        self.ui_input_interface_lbl = tk.Label(self.ui_input_intermolecular_frame,
+                text='Interface within (A)')
+        self.ui_input_interface_lbl.pack(side='left')
+        self.ui_input_interface_field = tk.Entry(self.ui_input_intermolecular_frame,
+                textvariable=self.var_input_interface, state='disabled', width=4)
+        self.ui_input_interface_field.pack(side='left')
+        self.ui_input_trajectory_check = tk.Checkbutton(
+                self.ui_input_intermolecular_frame, text='All trajectory frames',
+                variable=self.var_input_trajectory)
+        self.ui_input_trajectory_check.pack(side='left')
 
         # Review input data
         self.ui_input_summary_label = tk.Label(self.ui_input_frame,
@@ -128,6 +151,17 @@ class NCIPlotDialog(TangramBaseDialog):
         self.ui_config_btn = tk.Button(self.ui_nciplot_frame, text='Configure',
                 command=self._configure_dialog)
         self.ui_config_btn.pack(side='left')
+        self.ui_engine = OptionMenu(self.ui_nciplot_frame, label_text='Engine: ',
+                labelpos='w', items=sorted(ENGINES.keys()))
+        self.ui_engine.pack(side='left')
+        self.ui_domains_lbl = tk.Label(self.ui_nciplot_frame, text='Domains: ')
+        self.ui_domains_lbl.pack(side='left')
+        self.ui_domains_field = tk.Entry(self.ui_nciplot_frame,
+                textvariable=self.var_input_domains, width=3)
+        self.ui_domains_field.pack(side='left')
+        self.ui_adaptive_check = tk.Checkbutton(self.ui_nciplot_frame,
+                text='Adaptive grid', variable=self.var_input_adaptive)
+        self.ui_adaptive_check.pack(side='left')
 
         # Configure Volume Viewer
         self.ui_settings_frame = tk.LabelFrame(self.canvas,
@@ -182,15 +216,30 @@ class NCIPlotDialog(TangramBaseDialog):
         chimera.triggers.addHandler('selection changed', self._on_selection_changed, None)
         self.nciplot_run = self.buttonWidgets['Run']
         self.buttonWidgets['Save']['state'] = 'disabled'
+        self.buttonWidgets['Regions']['state'] = 'disabled'
+        self.buttonWidgets['Residues']['state'] = 'disabled'
+        self.buttonWidgets['Scan']['state'] = 'disabled'
 
-    def load_controller(self):
+    def load_controller(self, trajectory=False):
         binary, dat = prefs.get_preferences()
-        return Controller(gui=self, nciplot_binary=binary, nciplot_dat=dat)
+        job_queue.max_concurrency = prefs.get_max_jobs()
+        scratch_space.fast_root, scratch_space.quota = prefs.get_scratch()
+        field_cache.resize(prefs.get_field_cache())
+        engine = ENGINES[self.ui_engine.getvalue()]
+        cls = TrajectoryController if trajectory else Controller
+        return cls(gui=self, nciplot_binary=binary, nciplot_dat=dat, engine=engine)
 
     def input_options(self):
         d = {}
         if self.var_input_intermolecular_enabled.get():
             d['intermolecular'] = self.var_input_intermolecular.get() / 100.0
+            if self.var_input_interface.get() > 0:
+                d['interface'] = self.var_input_interface.get()
+        if self.var_input_domains.get() > 1:
+            d['domains'] = self.var_input_domains.get()
+        # Coarse-to-fine refinement is only available in-process
+        if self.var_input_adaptive.get() and ENGINES[self.ui_engine.getvalue()] == 'promolecular':
+            d['adaptive'] = 4
         return d
 
     # All the callbacks
@@ -209,8 +258,10 @@ class NCIPlotDialog(TangramBaseDialog):
     def _intermolecular_cb(self):
         if self.var_input_intermolecular_enabled.get():
             self.ui_input_intermolecular_field.config(state='normal')
+            self.ui_input_interface_field.config(state='normal')
         else:
             self.ui_input_intermolecular_field.config(state='disabled')
+            self.ui_input_interface_field.config(state='disabled')
 
     def _validate_input_data(self, *args):
         atoms = self._on_selection_changed()
@@ -223,7 +274,8 @@ class NCIPlotDialog(TangramBaseDialog):
 
     def Run(self, *args):
         """
-        Called at clicking 'Run' button.
+        Called at clicking 'Run' button. Each run gets its own controller,
+        so the button stays enabled and several jobs can be queued.
         """
         self._run_nciplot_clear_cb()
         atoms = self._validate_input_data()
@@ -231,37 +283,80 @@ class NCIPlotDialog(TangramBaseDialog):
             attr_getter = attrgetter('molecule')
             groups = [list(group) for k, group in groupby(atoms, key=attr_getter)]
             options = self.input_options()
-            self.controller = self.load_controller()
-            self.controller.run(groups=groups, **options)
-            self.nciplot_run.configure(state='disabled', text='Running...')
+            trajectory = bool(self.var_input_trajectory.get())
+            self.controller = self.load_controller(trajectory=trajectory)
             self.ui_settings_frame.pack_forget()
+            self.controller.run(groups=groups, **options)
+            self.status('NCIPlot job submitted. Check the Tasks panel for progress.',
+                        blankAfter=4)
 
     def Save(self, *args):
-        try:
-            grad = self.controller.data['grad_cube']
-            dens = self.controller.data['dens_cube']
-            xy = self.controller.data['xy_data']
-        except KeyError:
+        if not self.controller or not (self.controller.data or self.controller.cubes):
             raise chimera.UserError("NCIPlot has not run yet!")
-        path = tkFileDialog.asksaveasfilename(title='Choose destination (.cube)',
-                                              filetypes=[('Gaussian cube', '*.cube'),
+        path = tkFileDialog.asksaveasfilename(title='Choose destination',
+                                              filetypes=[('Sparse NCI volume', '*.npz'),
+                                                         ('Gaussian cube', '*.cube'),
                                                          ('All', '*')],
-                                              defaultextension='.cube')
+                                              defaultextension='.npz')
         if not path:
             return
-        data = self.controller.data.copy()
         basename, ext = os.path.splitext(path)
-        data['grad_cube'] = newgradpath = '{fn}.grad{ext}'.format(fn=basename, ext=ext)
-        shutil.copyfile(grad, newgradpath)
-        data['dens_cube'] = newdenspath = '{fn}.dens{ext}'.format(fn=basename, ext=ext)
-        shutil.copyfile(dens, newdenspath)
-        data['xy_data'] = newdatpath = '{fn}.dat'.format(fn=basename, ext=ext)
-        shutil.copyfile(xy, newdatpath)
+        if ext.lower() == '.npz':
+            data = self.controller.save_sparse(path, '{fn}.dat'.format(fn=basename))
+        else:
+            data = self.controller.save('{fn}.grad{ext}'.format(fn=basename, ext=ext),
+                                        '{fn}.dens{ext}'.format(fn=basename, ext=ext),
+                                        '{fn}.dat'.format(fn=basename))
         with open('{}.json'.format(basename), 'w') as f:
             json.dump(data, f)
         self.status('Saved at {}!'.format(os.path.dirname(path)), color='blue',
                     blankAfter=4)
 
+    def Regions(self, *args):
+        """
+        List the NCI regions (blobs) of the current surface in the Reply Log.
+        """
+        if not self.controller or not (self.controller.data or self.controller.cubes):
+            raise chimera.UserError("NCIPlot has not run yet!")
+        rows = self.controller.blob_table()
+        for row in rows:
+            row['atoms'] = [a.oslIdent() if hasattr(a, 'oslIdent') else a for a in row['atoms']]
+        chimera.replyobj.info('NCI regions at RDG isovalue {}\n'.format(
+                              self.controller.surface.surface_levels[-1]))
+        chimera.replyobj.info(format_table(rows))
+        self.status('{} NCI regions listed in the Reply Log.'.format(len(rows)), blankAfter=4)
+
+    def Residues(self, *args):
+        """
+        Decompose the current NCI regions per residue, color the residues
+        by their contribution and list them in the Reply Log.
+        """
+        if not self.controller or not (self.controller.data or self.controller.cubes):
+            raise chimera.UserError("NCIPlot has not run yet!")
+        residues, contributions = self.controller.residue_contributions()
+        self.controller.color_by_contribution(residues, contributions)
+        chimera.replyobj.info('NCI density per residue at RDG isovalue {}\n'.format(
+                              self.controller.surface.surface_levels[-1]))
+        chimera.replyobj.info(format_contributions([r.oslIdent() for r in residues],
+                                                   contributions))
+        self.status('Residues colored by NCI contribution. Check the Reply Log.',
+                    blankAfter=4)
+
+    def Scan(self, *args):
+        """
+        Delete each residue of the last run in turn and list, in the Reply
+        Log, how much of the current NCI regions is lost (promolecular
+        engine only).
+        """
+        if not self.controller or not (self.controller.data or self.controller.cubes):
+            raise chimera.UserError("NCIPlot has not run yet!")
+        residues, losses = self.controller.scan_residues()
+        chimera.replyobj.info('NCI regions lost per deleted residue at RDG isovalue {}\n'.format(
+                              self.controller.surface.surface_levels[-1]))
+        chimera.replyobj.info(format_scan([r.oslIdent() for r in residues], losses))
+        self.status('{} residues scanned. Check the Reply Log.'.format(len(residues)),
+                    blankAfter=4)
+
     def Load(self, *args):
         path = tkFileDialog.askopenfilename(title='Choose state file (*.json)',
                                             filetypes=[('JSON file', '*.json'),
@@ -273,28 +368,39 @@ class NCIPlotDialog(TangramBaseDialog):
         self._run_nciplot_clear_cb()
         self.controller = self.load_controller()
         self.controller._after_cb(data)
-        self._run_nciplot_cb()
 
     def Close(self):  # Singleton mode
         global ui
         ui = None
+        field_cache.clear()  # the kept promolecular fields can take hundreds of MB
         super(NCIPlotDialog, self).Close()
 
-    def _run_nciplot_cb(self):
+    def _run_nciplot_cb(self, controller=None):
         """
-        Called after NCIPlot has successfully run
+        Called after NCIPlot has successfully run. The controller of the
+        job that just finished becomes the active one.
         """
+        if controller is not None:
+            self.controller = controller
         self.nciplot_run.configure(state='normal', text='Run')
+        self.ui_plot_button.configure(state='normal')
+        self.ui_plot_widget.get_tk_widget().pack_forget()
         self.var_settings_isovalue_1.set(self.controller.surface.surface_levels[0])
         self.var_settings_isovalue_2.set(self.controller.surface.surface_levels[1])
         self.ui_settings_frame.pack()
         self.ui_plot_frame.pack(expand=True, fill='both')
         self.buttonWidgets['Save']['state'] = 'normal'
+        self.buttonWidgets['Regions']['state'] = 'normal'
+        self.buttonWidgets['Residues']['state'] = 'normal'
+        self.buttonWidgets['Scan']['state'] = 'normal'
 
-    def _run_nciplot_clear_cb(self):
+    def _run_nciplot_clear_cb(self, controller=None):
         """
-        Housecleaning method. Resets everything to original state
+        Housecleaning method. Resets everything to original state, unless
+        the failed job belongs to another controller than the active one.
         """
+        if controller is not None and controller is not self.controller:
+            return
         self.nciplot_run.configure(state='normal', text='Run')
         self.ui_plot_button.configure(state='normal')
         self.ui_settings_frame.pack_forget()
@@ -304,6 +410,9 @@ class NCIPlotDialog(TangramBaseDialog):
         self.ui_plot_widget.get_tk_widget().pack_forget()
         self.controller = None
         self.buttonWidgets['Save']['state'] = 'disabled'
+        self.buttonWidgets['Regions']['state'] = 'disabled'
+        self.buttonWidgets['Residues']['state'] = 'disabled'
+        self.buttonWidgets['Scan']['state'] = 'disabled'
 
     def _update_surface(self):
         """
@@ -404,6 +513,14 @@ class NCIPlotConfigureDialog(TangramBaseDialog):
             dat = ''
         self.binary.set(binary)
         self.dat_dir.set(dat)
+        self.max_jobs = tk.StringVar()
+        self.max_jobs.set(prefs.get_max_jobs())
+        self.scratch_dir, self.scratch_quota = tk.StringVar(), tk.StringVar()
+        scratch_dir, scratch_quota = prefs.get_scratch()
+        self.scratch_dir.set(scratch_dir or '')
+        self.scratch_quota.set(scratch_quota // 1024 ** 2 if scratch_quota else '')
+        self.field_cache = tk.StringVar()
+        self.field_cache.set(prefs.get_field_cache() // 1024 ** 2)
         self.text = tk.StringVar()
         self.text.set("Tip: Click <Help> to get NCIPlot")
 
@@ -426,11 +543,29 @@ class NCIPlotConfigureDialog(TangramBaseDialog):
                                             mode='directory',
                                             title='Select NCIPlot dat directory'))
 
+        self.ui_label_2 = tk.Label(parent, text='Concurrent jobs')
+        self.ui_jobs_entry = tk.Entry(parent, textvariable=self.max_jobs, width=3)
+
+        self.ui_label_3 = tk.Label(parent, text='Fast scratch dir')
+        self.ui_scratch_entry = tk.Entry(parent, textvariable=self.scratch_dir)
+        self.ui_scratch_browse = tk.Button(parent, text='...',
+            command=lambda: self._browse_cb(self.scratch_dir,
+                                            mode='directory',
+                                            title='Select a RAM-backed directory, like /dev/shm'))
+        self.ui_label_4 = tk.Label(parent, text='Scratch quota (MB)')
+        self.ui_quota_entry = tk.Entry(parent, textvariable=self.scratch_quota, width=6)
+        self.ui_label_5 = tk.Label(parent, text='Kept fields (MB)')
+        self.ui_fields_entry = tk.Entry(parent, textvariable=self.field_cache, width=6)
+
         self.ui_label = tk.Label(parent, textvariable=self.text)
-        self.ui_label.grid(row=2, columnspan=3)
+        self.ui_label.grid(row=6, columnspan=3)
 
         grid = [[self.ui_label_0, self.ui_bin_entry, self.ui_bin_browse],
-                [self.ui_label_1, self.ui_dat_entry, self.ui_dat_browse]]
+                [self.ui_label_1, self.ui_dat_entry, self.ui_dat_browse],
+                [self.ui_label_2, self.ui_jobs_entry],
+                [self.ui_label_3, self.ui_scratch_entry, self.ui_scratch_browse],
+                [self.ui_label_4, self.ui_quota_entry],
+                [self.ui_label_5, self.ui_fields_entry]]
         self.auto_grid(parent, grid)
 
 
@@ -441,6 +576,12 @@ class NCIPlotConfigureDialog(TangramBaseDialog):
     def Apply(self):
         try:
             prefs.set_preferences(self.binary.get(), self.dat_dir.get())
+            prefs.set_max_jobs(self.max_jobs.get())
+            job_queue.max_concurrency = prefs.get_max_jobs()
+            prefs.set_scratch(self.scratch_dir.get(), self.scratch_quota.get())
+            scratch_space.fast_root, scratch_space.quota = prefs.get_scratch()
+            prefs.set_field_cache(self.field_cache.get())
+            field_cache.resize(prefs.get_field_cache())
         except ValueError as e:
             self.text.set(str(e))
             self.label.configure(foreground='red')
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Memory-bounded 2D histograms of NCIPlot `.dat` files (sign(lambda2)*rho
+vs RDG), to plot them without loading every point.
+
+The file is parsed in chunks with NumPy, once to find the value ranges and
+once to accumulate the counts, so memory only depends on `chunk_size` and
+the number of bins. The result is cached as a small `.npz` next to the
+`.dat` file and reused while the latter does not change.
+"""
+
+from __future__ import print_function, division
+# Python stdlib
+import os
+# Additional 3rd parties
+import numpy as np
+
+
+DEFAULT_BINS = 250
+
+
+def iter_dat_chunks(path, chunk_size=2**24):
+    """
+    Yield the (N, 2) arrays of values in the `.dat` file at `path`,
+    reading about `chunk_size` bytes each time.
+    """
+    with open(path) as f:
+        remainder = ''
+        while True:
+            text = f.read(chunk_size)
+            if not text:
+                break
+            text = remainder + text
+            cut = text.rfind('\n') + 1
+            text, remainder = text[:cut], text[cut:]
+            if text:
+                values = np.fromstring(text, dtype=float, sep=' ')
+                yield values.reshape(-1, 2)
+        if remainder.strip():
+            yield np.fromstring(remainder, dtype=float, sep=' ').reshape(-1, 2)
+
+
+def dat_ranges(path, chunk_size=2**24):
+    """
+    ((xmin, xmax), (ymin, ymax)) of the values in the `.dat` file, or
+    None if it is empty.
+    """
+    lo, hi = None, None
+    for chunk in iter_dat_chunks(path, chunk_size):
+        if not len(chunk):
+            continue
+        c_lo, c_hi = chunk.min(axis=0), chunk.max(axis=0)
+        lo = c_lo if lo is None else np.minimum(lo, c_lo)
+        hi = c_hi if hi is None else np.maximum(hi, c_hi)
+    if lo is None:
+        return None
+    return (lo[0], hi[0]), (lo[1], hi[1])
+
+
+def dat_histogram(path, bins=DEFAULT_BINS, ranges=None, chunk_size=2**24):
+    """
+    Accumulate the 2D histogram of a `.dat` file chunk by chunk.
+
+    Parameters
+    ----------
+    path : str
+    bins : int, optional
+        Number of bins along each axis.
+    ranges : 2-tuple of 2-tuple of float, optional
+        Histogram limits. Computed in a first pass over the file if not given.
+    chunk_size : int, optional
+        Approximate number of bytes parsed at once.
+
+    Returns
+    -------
+    counts : np.ndarray of int, shape=(bins, bins)
+        Indexed as [x, y].
+    xedges, yedges : np.ndarray, shape=(bins + 1,)
+    """
+    if ranges is None:
+        ranges = dat_ranges(path, chunk_size) or ((0, 1), (0, 1))
+    xedges, yedges = _edges(ranges, bins)
+    counts = np.zeros((bins, bins), dtype=np.int64)
+    for chunk in iter_dat_chunks(path, chunk_size):
+        counts += np.histogram2d(chunk[:, 0], chunk[:, 1], bins=(xedges, yedges))[0].astype(np.int64)
+    return counts, xedges, yedges
+
+
+def points_histogram(xy, bins=DEFAULT_BINS):
+    """
+    Same as `dat_histogram`, for (N, 2) points already in memory.
+    """
+    if len(xy):
+        ranges = (xy[:, 0].min(), xy[:, 0].max()), (xy[:, 1].min(), xy[:, 1].max())
+    else:
+        ranges = (0, 1), (0, 1)
+    xedges, yedges = _edges(ranges, bins)
+    counts = np.histogram2d(xy[:, 0], xy[:, 1], bins=(xedges, yedges))[0].astype(np.int64)
+    return counts, xedges, yedges
+
+
+def cached_histogram(path, bins=DEFAULT_BINS):
+    """
+    `dat_histogram` of `path`, reusing `<path>.hist.npz` if it was built
+    from the current file with the same number of bins. The cache is
+    (re)written when possible; failing to write it is not an error.
+    """
+    cache = path + '.hist.npz'
+    stat = os.stat(path)
+    stamp = np.array([stat.st_size, stat.st_mtime, bins], dtype=float)
+    try:
+        with np.load(cache) as f:
+            if np.array_equal(f['stamp'], stamp):
+                return f['counts'], f['xedges'], f['yedges']
+    except (IOError, OSError, KeyError, ValueError):
+        pass
+    counts, xedges, yedges = dat_histogram(path, bins=bins)
+    try:
+        with open(cache, 'wb') as f:
+            np.savez(f, counts=counts, xedges=xedges, yedges=yedges, stamp=stamp)
+    except (IOError, OSError):
+        pass
+    return counts, xedges, yedges
+
+
+def _edges(ranges, bins):
+    edges = []
+    for lo, hi in ranges:
+        if hi <= lo:
+            lo, hi = lo - 0.5, hi + 0.5
+        edges.append(np.linspace(lo, hi, bins + 1))
+    return edges
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Per-stage instrumentation of NCIPlot jobs.
+
+Every stage of a job (exporting the XYZ files, running NCIPlot, parsing
+its output, loading and drawing the volumes...) is recorded as one JSON
+line with its wall time, CPU time and peak RSS. The log can be queried
+from Python:
+
+    >>> from nciplot.instrument import read_log, summarize
+    >>> summarize(read_log(stage='nciplot'))
+
+Set the environment variable `TANGRAM_NCIPLOT_STAGES_LOG` to change the
+log location, or to an empty string to disable recording.
+"""
+
+from __future__ import print_function, division
+# Python stdlib
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+DEFAULT_LOG = os.path.join(os.path.expanduser('~'), '.local', 'share', 'tangram_nciplot',
+                           'stages.jsonl')
+MAX_LOG_SIZE = 16 * 1024 ** 2  # bytes; the log is rotated to `<log>.1` beyond that
+_process_time = getattr(time, 'process_time', None) or time.clock
+
+
+def _rusage(who):
+    """
+    (cpu seconds, peak RSS in bytes) of this process or its children.
+    """
+    if resource is None:
+        return _process_time() if who == 'self' else 0.0, None
+    usage = resource.getrusage(resource.RUSAGE_SELF if who == 'self'
+                               else resource.RUSAGE_CHILDREN)
+    # ru_maxrss is in kilobytes, except on macOS
+    peak = usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+    return usage.ru_utime + usage.ru_stime, peak
+
+
+class Stage(object):
+
+    """
+    A running stage, created by `StageRecorder.start`. Call `stop` once
+    it is over; extra keyword arguments are stored with the record.
+
+    `cpu` is the CPU time of the whole process (all threads) during the
+    stage. Stages spent in a subprocess (`children=True`) report the CPU
+    time and peak RSS of the child processes reaped meanwhile instead.
+    """
+
+    def __init__(self, recorder, name, job=None, children=False, **info):
+        self.recorder = recorder
+        self.name = name
+        self.job = job
+        self.who = 'children' if children else 'self'
+        self.info = info
+        self.stopped = False
+        self._wall = time.time()
+        self._cpu = _rusage(self.who)[0]
+
+    def stop(self, **info):
+        if self.stopped:
+            return None
+        self.stopped = True
+        cpu, peak = _rusage(self.who)
+        record = {'job': self.job, 'stage': self.name, 'start': self._wall,
+                  'wall': time.time() - self._wall, 'cpu': cpu - self._cpu,
+                  'peak_rss': peak, 'pid': os.getpid()}
+        record.update(self.info)
+        record.update(info)
+        self.recorder.write(record)
+        return record
+
+
+class StageRecorder(object):
+
+    """
+    Thread-safe writer of stage records to a JSON-lines file.
+
+    Parameters
+    ----------
+    path : str, optional
+        Location of the log. If empty or None, nothing is recorded.
+    """
+
+    _ids = itertools.count(1)
+
+    def __init__(self, path=DEFAULT_LOG):
+        self.path = path
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def new_job(self, prefix='job'):
+        """
+        Unique identifier to group the stages of a job.
+        """
+        return '{}-{}-{}-{}'.format(prefix, os.getpid(), int(time.time()), next(self._ids))
+
+    def start(self, name, job=None, children=False, **info):
+        return Stage(self, name, job=job, children=children, **info)
+
+    @contextmanager
+    def stage(self, name, job=None, children=False, **info):
+        """
+        Record the enclosed block as stage `name`. Failures are recorded
+        with an `error` field and re-raised.
+        """
+        stage = self.start(name, job=job, children=children, **info)
+        try:
+            yield stage
+        except Exception as e:
+            stage.stop(error='{}: {}'.format(type(e).__name__, e))
+            raise
+        stage.stop()
+
+    def timed(self, name):
+        """
+        Decorator version of `stage`.
+        """
+        def decorator(f):
+            def wrapper(*args, **kwargs):
+                with self.stage(name):
+                    return f(*args, **kwargs)
+            wrapper.__name__, wrapper.__doc__ = f.__name__, f.__doc__
+            return wrapper
+        return decorator
+
+    def write(self, record):
+        if not self.enabled:
+            return
+        line = json.dumps(record, sort_keys=True, default=str) + '\n'
+        with self._lock:
+            try:
+                directory = os.path.dirname(self.path)
+                if directory and not os.path.isdir(directory):
+                    os.makedirs(directory)
+                if os.path.isfile(self.path) and os.path.getsize(self.path) > MAX_LOG_SIZE:
+                    os.rename(self.path, self.path + '.1')
+                with open(self.path, 'a') as f:
+                    f.write(line)
+            except (IOError, OSError):
+                pass  # instrumentation must never break a job
+
+
+def read_log(path=None, stage=None, job=None, since=None):
+    """
+    Load the records of a stages log.
+
+    Parameters
+    ----------
+    path : str, optional
+        Defaults to the log of the module-level `recorder`.
+    stage, job : str, optional
+        Only keep records of this stage or job.
+    since : float, optional
+        Only keep records started after this UNIX time.
+
+    Returns
+    -------
+    records : list of dict
+    """
+    path = path or recorder.path or DEFAULT_LOG
+    records = []
+    if not os.path.isfile(path):
+        return records
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if stage is not None and record.get('stage') != stage:
+                continue
+            if job is not None and record.get('job') != job:
+                continue
+            if since is not None and record.get('start', 0) < since:
+                continue
+            records.append(record)
+    return records
+
+
+def summarize(records, by='stage'):
+    """
+    Aggregate records by `by` ('stage' or 'job').
+
+    Returns
+    -------
+    summary : dict
+        For each key: count, total and mean wall time, max wall time,
+        total CPU time and max peak RSS (bytes).
+    """
+    summary = {}
+    for record in records:
+        s = summary.setdefault(record.get(by), {'count': 0, 'wall_total': 0.0,
+                                                'wall_max': 0.0, 'cpu_total': 0.0,
+                                                'peak_rss_max': None})
+        s['count'] += 1
+        s['wall_total'] += record.get('wall', 0.0)
+        s['wall_max'] = max(s['wall_max'], record.get('wall', 0.0))
+        s['cpu_total'] += record.get('cpu', 0.0)
+        if record.get('peak_rss') is not None:
+            s['peak_rss_max'] = max(s['peak_rss_max'] or 0, record['peak_rss'])
+    for s in summary.values():
+        s['wall_mean'] = s['wall_total'] / s['count']
+    return summary
+
+
+recorder = StageRecorder(os.environ.get('TANGRAM_NCIPLOT_STAGES_LOG', DEFAULT_LOG))
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Interface extraction for intermolecular runs. Only atoms close to a
+partner group can take part in intermolecular interactions, so the rest
+can be dropped and the grid restricted to a tight box around the interface.
+"""
+
+from __future__ import print_function, division
+# Additional 3rd parties
+import numpy as np
+
+
+DEFAULT_BOX_PADDING = 2.5  # Angstrom
+
+
+def near_atoms(coords, partner, distance, chunk_size=2**20):
+    """
+    Boolean mask of the atoms in `coords` that lie within `distance` of
+    any atom in `partner`.
+
+    Atoms outside the bounding box of `partner` expanded by `distance` are
+    discarded first; the remaining pairs are checked in vectorized chunks.
+
+    Parameters
+    ----------
+    coords : np.ndarray, shape=(N, 3)
+    partner : np.ndarray, shape=(M, 3)
+    distance : float
+    chunk_size : int, optional
+        Maximum number of pairwise distances computed at once.
+    """
+    mask = np.zeros(len(coords), dtype=bool)
+    if not len(coords) or not len(partner):
+        return mask
+    lo, hi = partner.min(axis=0) - distance, partner.max(axis=0) + distance
+    candidates = np.where(((coords >= lo) & (coords <= hi)).all(axis=1))[0]
+    if not len(candidates):
+        return mask
+    # Only partner atoms close to the candidates' box matter, too
+    c_lo = coords[candidates].min(axis=0) - distance
+    c_hi = coords[candidates].max(axis=0) + distance
+    partner = partner[((partner >= c_lo) & (partner <= c_hi)).all(axis=1)]
+    step = max(1, chunk_size // max(len(partner), 1))
+    cutoff = distance * distance
+    for start in range(0, len(candidates), step):
+        idx = candidates[start:start + step]
+        d = coords[idx, None, :] - partner[None, :, :]
+        mask[idx] = ((d * d).sum(axis=2) <= cutoff).any(axis=1)
+    return mask
+
+
+def interface_masks(groups, distance=6.0):
+    """
+    For each group of coordinates, select the atoms within `distance` of
+    any other group.
+
+    Parameters
+    ----------
+    groups : list of np.ndarray, shape=(N_i, 3)
+    distance : float, optional, default=6.0
+        In the same units as the coordinates (Angstrom).
+
+    Returns
+    -------
+    masks : list of np.ndarray of bool
+    """
+    masks = []
+    for i, coords in enumerate(groups):
+        others = [g for j, g in enumerate(groups) if j != i and len(g)]
+        partner = np.concatenate(others) if others else np.zeros((0, 3))
+        masks.append(near_atoms(coords, partner, distance))
+    return masks
+
+
+def interface_box(groups, masks, padding=DEFAULT_BOX_PADDING):
+    """
+    Tight box around the interface: the region where the bounding boxes of
+    the selected atoms of every group, expanded by `padding`, overlap.
+    Falls back to the box of all selected atoms if they do not overlap.
+
+    NCI surfaces lie some 1.5-2.5 A away from the atoms, so `padding`
+    should not be smaller than that, or contacts at the sides of the
+    interface are clipped by the faces of the box.
+
+    Returns
+    -------
+    box : 6-tuple of float
+        (x0, y0, z0, x1, y1, z1), as expected by NCIPlot's CUBE keyword.
+    """
+    selected = [g[m] for g, m in zip(groups, masks) if m.any()]
+    if not selected:
+        raise ValueError('No interface atoms were found.')
+    lows = np.array([s.min(axis=0) for s in selected]) - padding
+    highs = np.array([s.max(axis=0) for s in selected]) + padding
+    lo, hi = lows.max(axis=0), highs.min(axis=0)
+    if (lo >= hi).any():
+        lo, hi = lows.min(axis=0), highs.max(axis=0)
+    return tuple(float(x) for x in np.concatenate([lo, hi]))
@@ -14,6 +14,10 @@ import os
 from chimera import preferences
 
 
+DEFAULT_MAX_JOBS = 2
+DEFAULT_SCRATCH_QUOTA = 1024  # MB
+DEFAULT_FIELD_CACHE = 256  # MB
+
 def assert_preferences():
     insert_defaults = False
     try:
@@ -49,6 +53,100 @@ def get_preferences():
            preferences.get('tangram_nciplot', 'nciplot_dat')
 
 
+def get_max_jobs():
+    """
+    Maximum number of NCIPlot jobs allowed to run at the same time.
+    """
+    try:
+        max_jobs = preferences.get('tangram_nciplot', 'max_jobs')
+    except KeyError:
+        max_jobs = None
+    return int(max_jobs) if max_jobs else DEFAULT_MAX_JOBS
+
+
+def set_max_jobs(max_jobs):
+    try:
+        max_jobs = int(max_jobs)
+    except (TypeError, ValueError):
+        max_jobs = 0
+    if max_jobs < 1:
+        raise ValueError('Number of concurrent jobs must be a positive integer.')
+    preferences.set('tangram_nciplot', 'max_jobs', max_jobs)
+    preferences.save()
+
+
+def get_scratch():
+    """
+    Fast scratch directory for job files (e.g. /dev/shm) and its quota.
+
+    Returns
+    -------
+    directory : str or None
+        None if not set, or if it does not exist anymore.
+    quota : int or None
+        In bytes. None means no limit besides the free space.
+    """
+    try:
+        directory = preferences.get('tangram_nciplot', 'scratch_dir')
+    except KeyError:
+        directory = None
+    try:
+        quota = preferences.get('tangram_nciplot', 'scratch_quota')
+    except KeyError:
+        quota = DEFAULT_SCRATCH_QUOTA
+    if not directory or not os.path.isdir(directory):
+        directory = None
+    return directory, int(float(quota) * 1024 ** 2) if quota else None
+
+
+def set_scratch(directory, quota=DEFAULT_SCRATCH_QUOTA):
+    """
+    Set the fast scratch `directory` (empty to disable it) and its `quota`,
+    in MB (empty or 0 for no limit).
+    """
+    directory = (directory or '').strip()
+    if directory and not os.path.isdir(directory):
+        raise ValueError('Scratch directory {} does not exist.'.format(directory))
+    try:
+        quota = float(quota or 0)
+    except (TypeError, ValueError):
+        quota = -1
+    if quota < 0:
+        raise ValueError('Scratch quota must be a positive number of MB.')
+    preferences.set('tangram_nciplot', 'scratch_dir', directory)
+    preferences.set('tangram_nciplot', 'scratch_quota', quota)
+    preferences.save()
+
+
+def get_field_cache():
+    """
+    Memory kept for the fields of the last promolecular run, in bytes, so
+    the next run of the same system is an incremental update. 0 disables it.
+    """
+    try:
+        size = preferences.get('tangram_nciplot', 'field_cache')
+    except KeyError:
+        size = DEFAULT_FIELD_CACHE
+    try:
+        return int(float(size) * 1024 ** 2)
+    except (TypeError, ValueError):
+        return DEFAULT_FIELD_CACHE * 1024 ** 2
+
+
+def set_field_cache(size=DEFAULT_FIELD_CACHE):
+    """
+    Set the memory kept for promolecular fields, in MB (empty or 0 to disable).
+    """
+    try:
+        size = float(size or 0)
+    except (TypeError, ValueError):
+        size = -1
+    if size < 0:
+        raise ValueError('Kept fields size must be a positive number of MB.')
+    preferences.set('tangram_nciplot', 'field_cache', size)
+    preferences.save()
+
+
 def test_preferences():
     binary, dat = get_preferences()
     return os.path.isfile(binary) and os.path.isdir(dat)
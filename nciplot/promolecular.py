@@ -0,0 +1,1029 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+In-process, vectorized implementation of the promolecular NCI analysis.
+
+The density of each atom is approximated with the same three exponential
+fits that NCIPlot uses for XYZ inputs [1]:
+
+    rho_a(r) = sum_i c_i * exp(-r / zeta_i)
+
+Density, gradient and Hessian are accumulated analytically over blocks of
+the grid, so no subprocess or intermediate text file is needed until the
+cubes are written for VolumeViewer. Each block only visits the atoms whose
+density is still above `density_threshold` somewhere in the block, found
+through a uniform cell list, so the cost grows with the grid size instead
+of grid size times number of atoms.
+
+With `in_memory=True`, no file is written at all: the cubes and the dat
+points are returned as NumPy arrays and handed straight to VolumeViewer.
+
+[1] Revealing Noncovalent Interactions. Johnson ER, Keinan S, Mori-Sanchez P,
+    Contreras-Garcia J, Cohen AJ, Yang W. J. Am. Chem. Soc. 2010, 132, 6498
+"""
+
+from __future__ import print_function, division
+# Python stdlib
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import namedtuple, OrderedDict
+# Additional 3rd parties
+import numpy as np
+# Own
+from .cube import Cube, COMMENTS, write_cube
+from .instrument import recorder
+from .xyz import read_xyz
+
+
+BOHR = 0.52917721067  # Angstrom
+RDG_PREFACTOR = 2 * (3 * np.pi ** 2) ** (1 / 3)
+HESSIAN_COMPONENTS = ((0, 0), (0, 1), (0, 2), (1, 1), (1, 2), (2, 2))  # when packed
+DEFAULT_FIELD_CACHE_SIZE = 256 * 1024 ** 2  # bytes
+ELEMENTS = ('H', 'He', 'Li', 'Be', 'B', 'C', 'N', 'O', 'F', 'Ne',
+            'Na', 'Mg', 'Al', 'Si', 'P', 'S', 'Cl', 'Ar')
+# Grid values in bohr and atomic units, indexed as [x, y, z]
+NCIGrids = namedtuple('NCIGrids',
+                      'origin spacing numbers coords rho sl2rho rdg excluded evaluated')
+# Promolecular fits, in atomic units. One row per element, one column per exponential.
+COEFFICIENTS = np.array([
+    (0.2815, 2.437, 11.84, 31.34, 67.82, 120.2, 190.9, 289.5, 406.3,
+     561.3, 760.8, 1016.0, 1319.0, 1658.0, 2042.0, 2501.0, 3024.0, 3625.0),
+    (0.0, 0.0, 0.06332, 0.3694, 0.8527, 1.172, 2.247, 2.879, 3.049,
+     6.984, 22.42, 37.17, 57.95, 85.55, 115.7, 146.0, 177.9, 217.2),
+    (0.0, 0.0, 0.0, 0.0, 0.0, 0.06358, 0.3779, 0.5547, 1.106,
+     1.412, 2.424, 2.925, 3.541, 4.197, 5.144, 6.036, 7.002, 7.937)]).T
+EXPONENTS = np.array([
+    (0.5288, 0.3379, 0.1912, 0.139, 0.1059, 0.0884, 0.0767, 0.0669, 0.0608,
+     0.0549, 0.0496, 0.0449, 0.0411, 0.0382, 0.0358, 0.0335, 0.0315, 0.0296),
+    (1.0, 1.0, 0.9992, 0.6945, 0.6061, 0.5205, 0.4982, 0.4875, 0.4793,
+     0.4456, 0.4115, 0.3810, 0.3604, 0.3418, 0.3251, 0.3105, 0.2979, 0.2867),
+    (1.0, 1.0, 1.0, 1.0, 1.0, 1.936, 1.679, 1.643, 1.702,
+     1.648, 1.578, 1.5, 1.434, 1.366, 1.302, 1.243, 1.189, 1.139)]).T
+
+
+class PromolecularNCI(object):
+
+    """
+    A drop-in alternative to `core.NCIPlot` that computes promolecular NCI
+    grids with NumPy, in the same process.
+
+    Parameters
+    ----------
+    dat_directory : str, optional
+        NCIPlot dat library. Not needed for the elements covered by the
+        built-in fits (H-Ar); kept for interface parity with `NCIPlot`.
+    success_callback : callable, optional
+        Called with the resulting `data` dict, like `NCIPlot` does.
+    clear_callback : callable, optional
+        Called if the calculation cannot be performed.
+    padding : float, optional, default=3.0
+        Margin added around the atoms when building the default box, in Angstrom.
+    block_size : int, optional, default=16
+        Edge, in voxels, of the grid blocks evaluated at once.
+    chunk_size : int, optional, default=2**21
+        Maximum number of (point, atom) pairs held in memory at once.
+    density_threshold : float, optional, default=1e-5
+        Atomic densities below this value (a.u.) are neglected, which sets
+        the cutoff radius of each element.
+    in_memory : bool, optional, default=False
+        If True, `run` reports the results with `memory_outputs` instead
+        of writing files.
+    receptor : receptor.ReceptorGrid, optional
+        Screening mode: the xyz files only hold the ligand (pose), and the
+        precomputed receptor contribution is added to theirs on its lattice.
+        Check `pose_grids`.
+    fields : FieldCache, optional
+        Keep the additive fields of each run there, so the next run of the
+        same system only recomputes the surroundings of the atoms that moved.
+        The `FieldState` of the last run, while kept there, is also
+        available as `state` (e.g. for `scanning.deletion_scan`).
+    """
+
+    implementation = 'NumPy'
+
+    def __init__(self, dat_directory=None, success_callback=None, clear_callback=None,
+                 padding=3.0, block_size=16, chunk_size=2**21, density_threshold=1e-5,
+                 in_memory=False, receptor=None, fields=None):
+        self.dat_directory = dat_directory
+        self.receptor = receptor
+        self.fields = fields
+        self.in_memory = in_memory
+        self.success_callback = success_callback
+        self.clear_callback = clear_callback
+        self.padding = padding
+        self.block_size = block_size
+        self.chunk_size = chunk_size
+        self.density_threshold = density_threshold
+        self._state_key = None
+        # runs sharing a FieldCache update its states in place, so they take turns
+        self.lock = fields.lock if fields is not None else threading.RLock()
+
+    @property
+    def state(self):
+        """
+        `FieldState` of the last run, or None if it was not kept or has
+        been evicted from `fields` since.
+        """
+        if self.fields is not None and self._state_key is not None:
+            return self.fields.get(self._state_key)
+
+    def run(self, *xyz, **options):
+        """
+        Compute the NCI grids for the specified xyz files and options, and
+        report them through `success_callback`. Options follow the signature
+        of `NCIPlot.create_nci_input`. `job_id` tags the recorded stage.
+        """
+        job_id = options.pop('job_id', None)
+        try:
+            with recorder.stage('compute', job=job_id, implementation=self.implementation):
+                if self.in_memory:
+                    data = self.compute_in_memory(xyz, **options)
+                else:
+                    data = self.compute(xyz, **options)
+        except ValueError:
+            if self.clear_callback is not None:
+                self.clear_callback()
+            raise
+        if self.success_callback is not None:
+            self.success_callback(data)
+        return data
+
+    def compute(self, paths, workdir=None, name=None, dat_cutoffs=(0.2, 1.0),
+                cube_cutoffs=(0.07, 0.3), **options):
+        """
+        Evaluate sign(lambda2)*rho and RDG on a grid and write NCIPlot-like
+        output files (`-grad.cube`, `-dens.cube` and `.dat`).
+
+        Parameters
+        ----------
+        paths : list of str
+            Paths to XYZ molecule files. Each file is considered a separate
+            fragment for `ligand` and `intermolecular` purposes.
+        workdir : str, optional
+            Where to write the output files. A temporary directory is
+            created if not provided.
+
+        Other parameters have the same meaning as in `NCIPlot.create_nci_input`.
+
+        Returns
+        -------
+        data : dict
+            Same keys as `NCIPlot.parse_stdout` output.
+        """
+        if workdir is None:
+            workdir = tempfile.mkdtemp(prefix='nciplot_')
+        if name is None:
+            name = os.path.splitext(os.path.basename(paths[0]))[0]
+        with self.lock:
+            grids = self.compute_grids(paths, cube_cutoffs=cube_cutoffs, **options)
+            return write_outputs(workdir, name, grids, dat_cutoffs=dat_cutoffs,
+                                 cube_cutoffs=cube_cutoffs)
+
+    def compute_in_memory(self, paths, dat_cutoffs=(0.2, 1.0), cube_cutoffs=(0.07, 0.3),
+                          **options):
+        """
+        Like `compute`, but nothing is written to disk. Check `memory_outputs`.
+        """
+        with self.lock:
+            grids = self.compute_grids(paths, cube_cutoffs=cube_cutoffs, **options)
+            return memory_outputs(grids, dat_cutoffs=dat_cutoffs, cube_cutoffs=cube_cutoffs)
+
+    def compute_grids(self, paths, ligand=None, intermolecular=None, radius=None,
+                      cube=None, increments=None, cube_cutoffs=(0.07, 0.3), adaptive=None,
+                      refine_margin=0.5, **kwargs):
+        """
+        Evaluate the NCI descriptors on the grid defined by the search options.
+
+        Parameters
+        ----------
+        adaptive : int, optional
+            If set, each block is first sampled every `adaptive` voxels. Only
+            blocks with a sample below the `cube_cutoffs` (RDG and density)
+            relaxed by `refine_margin` are evaluated at full resolution,
+            reusing their samples, so no more points are evaluated than with
+            a plain grid. The rest are filled in with the nearest sample and
+            excluded from the gradient cube and dat points, like NCIPlot's
+            cutoffs would do.
+        refine_margin : float, optional, default=0.5
+            Relative tolerance of the refinement criterion. Larger values
+            refine more blocks, and miss fewer minima between samples.
+
+        Other parameters have the same meaning as in `NCIPlot.create_nci_input`.
+
+        Returns
+        -------
+        grids : NCIGrids
+        """
+        self._state_key = None
+        if self.receptor is not None:
+            if adaptive and adaptive > 1:
+                raise ValueError('Adaptive grids are not available with a receptor grid.')
+            return self.pose_grids(paths, ligand=ligand, intermolecular=intermolecular)
+        elements, coords, fragments = [], [], []
+        for i, path in enumerate(paths):
+            e, c = read_xyz(path)
+            elements.extend(e)
+            coords.append(c)
+            fragments.extend([i] * len(e))
+        coords = np.concatenate(coords) / BOHR
+        fragments = np.array(fragments, dtype=int)
+        numbers = atomic_numbers(elements)
+
+        origin, spacing, shape = self._grid(coords, fragments, ligand=ligand,
+                                            radius=radius, cube=cube, increments=increments)
+        cutoffs = cutoff_radii(numbers, self.density_threshold)
+        center = None if not radius else np.asarray(radius[:3], dtype=float) / BOHR
+        exclusion = dict(intermolecular=intermolecular if len(paths) > 1 else None,
+                         center=center, radius=None if not radius else radius[3] / BOHR)
+        state, key = None, None
+        if self.fields is not None and not (adaptive and adaptive > 1):
+            key = self.fields.key(numbers, fragments, ligand=ligand, radius=radius, cube=cube,
+                                  increments=increments, intermolecular=intermolecular,
+                                  density_threshold=self.density_threshold,
+                                  block_size=self.block_size)
+            previous = self.fields.get(key)
+            if previous is not None and previous.contains(origin, spacing, shape):
+                with recorder.stage('incremental_update') as stage:
+                    grids = previous.update(coords, cutoffs, self.block_size,
+                                            max_moved=self.fields.max_moved,
+                                            chunk_size=self.chunk_size)
+                    stage.info['updated'] = grids is not None
+                if grids is not None:
+                    self._state_key = key
+                    return grids
+            state = self.fields.allocate(key, origin, spacing, shape, numbers, coords,
+                                         fragments, len(paths), exclusion=exclusion)
+        if state is not None:
+            rho, sl2rho, rdg, excluded = state.rho, state.sl2rho, state.rdg, state.excluded
+        else:
+            rho = np.empty(shape)
+            sl2rho = np.empty(shape)
+            rdg = np.empty(shape)
+            excluded = np.zeros(shape, dtype=bool)
+        cells = CellList(coords, cutoffs.max())
+        rho_limit, rdg_limit = [c * (1 + refine_margin) for c in cube_cutoffs[:2]]
+        evaluated = 0
+
+        def descriptors(points, block=None):
+            near = cells.query_box(points.min(axis=0), points.max(axis=0), cutoffs)
+            b_rho, b_grad, b_hess, b_frags = evaluate(
+                points, coords[near], numbers[near], fragments=fragments[near],
+                n_fragments=len(paths), chunk_size=self.chunk_size)
+            if state is not None and block is not None:
+                state.store(block, b_rho, b_grad, b_hess, b_frags)
+            b_sl2rho, b_rdg = nci_descriptors(b_rho, b_grad, b_hess)
+            b_excluded = excluded_points(points, b_rho, b_frags, **exclusion)
+            return b_rho, b_sl2rho, b_rdg, b_excluded
+
+        for block in iter_blocks(shape, self.block_size):
+            block_shape = tuple(s.stop - s.start for s in block)
+            points = block_points(block, origin, spacing)
+            if adaptive and adaptive > 1:
+                samples = [coarse_indices(b, adaptive) for b in block]
+                values = descriptors(index_points(samples, origin, spacing))
+                evaluated += len(values[0])
+                c_rho, c_sl2rho, c_rdg, c_excluded = values
+                if not (~c_excluded & (c_rdg < rdg_limit) & (c_rho < rho_limit)).any():
+                    sample_shape = tuple(len(i) for i in samples)
+                    nearest = np.ix_(*[nearest_sample(b, i) for (b, i) in zip(block, samples)])
+                    rho[block] = c_rho.reshape(sample_shape)[nearest]
+                    sl2rho[block] = c_sl2rho.reshape(sample_shape)[nearest]
+                    rdg[block] = c_rdg.reshape(sample_shape)[nearest]
+                    excluded[block] = True
+                    continue
+                # The samples are voxels of the block too: only the rest is evaluated,
+                # so refining every block costs no more than a plain grid
+                sampled = np.zeros(block_shape, dtype=bool)
+                sampled[np.ix_(*[i - b.start for (i, b) in zip(samples, block)])] = True
+                sampled = sampled.ravel()
+                rest = descriptors(points[~sampled])
+                evaluated += len(rest[0])
+                merged = []
+                for c_values, r_values in zip(values, rest):
+                    full = np.empty(len(points), dtype=c_values.dtype)
+                    full[sampled], full[~sampled] = c_values, r_values
+                    merged.append(full)
+                b_rho, b_sl2rho, b_rdg, b_excluded = merged
+            else:
+                b_rho, b_sl2rho, b_rdg, b_excluded = descriptors(points, block)
+                evaluated += len(b_rho)
+            rho[block] = b_rho.reshape(block_shape)
+            sl2rho[block] = b_sl2rho.reshape(block_shape)
+            rdg[block] = b_rdg.reshape(block_shape)
+            excluded[block] = b_excluded.reshape(block_shape)
+        if state is not None:
+            self.fields.put(key, state)
+            self._state_key = key
+        return NCIGrids(origin, spacing, numbers, coords, rho, sl2rho, rdg, excluded, evaluated)
+
+    def pose_grids(self, paths, ligand=None, intermolecular=None):
+        """
+        Evaluate the NCI descriptors of the ligand files in `paths` together
+        with `self.receptor`, on the receptor lattice around the ligand
+        atoms. The margin is the radius of the `ligand` option, or `padding`.
+
+        Only the ligand atoms are evaluated here: the receptor density,
+        gradient and Hessian are read from its grid and added, since they
+        are additive. For `intermolecular`, the receptor is the first
+        fragment and each file is another one.
+
+        Returns
+        -------
+        grids : NCIGrids
+            With the receptor atoms first in `numbers` and `coords`.
+        """
+        receptor = self.receptor
+        elements, coords, fragments = [], [], []
+        for i, path in enumerate(paths):
+            e, c = read_xyz(path)
+            elements.extend(e)
+            coords.append(c)
+            fragments.extend([i + 1] * len(e))
+        coords = np.concatenate(coords) / BOHR
+        fragments = np.array(fragments, dtype=int)
+        numbers = atomic_numbers(elements)
+
+        margin = (ligand[1] if ligand else self.padding) / BOHR
+        region = receptor.region(coords.min(axis=0) - margin, coords.max(axis=0) + margin)
+        origin = receptor.region_origin(region)
+        r_rho, r_grad, r_hess = receptor.fields(region)
+        shape = r_rho.shape
+        rho = np.empty(shape)
+        sl2rho = np.empty(shape)
+        rdg = np.empty(shape)
+        excluded = np.zeros(shape, dtype=bool)
+        cutoffs = cutoff_radii(numbers, self.density_threshold)
+        cells = CellList(coords, cutoffs.max())
+        for block in iter_blocks(shape, self.block_size):
+            block_shape = tuple(s.stop - s.start for s in block)
+            points = block_points(block, origin, receptor.spacing)
+            near = cells.query_box(points.min(axis=0), points.max(axis=0), cutoffs)
+            b_rho, b_grad, b_hess, b_frags = evaluate(
+                points, coords[near], numbers[near], fragments=fragments[near],
+                n_fragments=len(paths) + 1, chunk_size=self.chunk_size)
+            b_frags[:, 0] = r_rho[block].ravel()
+            b_rho += b_frags[:, 0]
+            b_grad += r_grad[block].reshape(-1, 3)
+            b_hess += r_hess[block].reshape(-1, 3, 3)
+            b_sl2rho, b_rdg = nci_descriptors(b_rho, b_grad, b_hess)
+            rho[block] = b_rho.reshape(block_shape)
+            sl2rho[block] = b_sl2rho.reshape(block_shape)
+            rdg[block] = b_rdg.reshape(block_shape)
+            excluded[block] = excluded_points(points, b_rho, b_frags,
+                                              intermolecular=intermolecular).reshape(block_shape)
+        return NCIGrids(origin, receptor.spacing,
+                        np.concatenate([receptor.numbers, numbers]),
+                        np.concatenate([receptor.coords, coords]),
+                        rho, sl2rho, rdg, excluded, rho.size)
+
+    def _grid(self, coords, fragments, ligand=None, radius=None, cube=None, increments=None):
+        """
+        Build the grid box following NCIPlot search options, in bohr.
+        """
+        return grid_box(coords, fragments, padding=self.padding, ligand=ligand, radius=radius,
+                        cube=cube, increments=increments)
+
+
+def grid_box(coords, fragments, padding=3.0, ligand=None, radius=None, cube=None,
+             increments=None):
+    """
+    Origin, spacing (bohr) and shape of the grid NCIPlot search options
+    define around `coords` (bohr). `fragments` holds the index of the
+    molecule file of each atom, for `ligand`; `padding` is in Angstrom.
+    """
+    if ligand:
+        index, r = int(ligand[0]), ligand[1] / BOHR
+        selected = coords[fragments == index - 1]
+        lo, hi = selected.min(axis=0) - r, selected.max(axis=0) + r
+    elif radius:
+        center, r = np.asarray(radius[:3], dtype=float) / BOHR, radius[3] / BOHR
+        lo, hi = center - r, center + r
+    elif cube:
+        lo = np.asarray(cube[:3], dtype=float) / BOHR
+        hi = np.asarray(cube[3:6], dtype=float) / BOHR
+    else:
+        lo, hi = coords.min(axis=0) - padding / BOHR, coords.max(axis=0) + padding / BOHR
+    if increments is None:
+        increments = (0.1, 0.1, 0.1)
+    spacing = np.asarray(increments[:3], dtype=float) / BOHR
+    shape = tuple(int(n) for n in np.floor((hi - lo) / spacing + 1e-6).astype(int) + 1)
+    return lo, spacing, shape
+
+
+def atomic_numbers(elements):
+    """
+    Convert element symbols to atomic numbers supported by the promolecular fits.
+    """
+    numbers = []
+    for element in elements:
+        symbol = element.strip().capitalize()
+        if symbol not in ELEMENTS:
+            raise ValueError('Element {} is not supported by the promolecular '
+                             'engine. Use the NCIPlot binary instead.'.format(element))
+        numbers.append(ELEMENTS.index(symbol) + 1)
+    return np.array(numbers, dtype=int)
+
+
+def cutoff_radii(numbers, threshold=1e-5):
+    """
+    Distance (bohr) beyond which the density of each atom is below `threshold`.
+    Each exponential is bounded separately by a third of the threshold, so
+    the returned radii are conservative.
+    """
+    c = COEFFICIENTS[numbers - 1]
+    zeta = EXPONENTS[numbers - 1]
+    with np.errstate(divide='ignore'):
+        radii = zeta * np.log(3 * c / threshold)
+    radii[c <= 0] = 0
+    return np.maximum(radii.max(axis=1), 0)
+
+
+class FieldState(object):
+
+    """
+    Additive fields (density, gradient, packed Hessian and per-fragment
+    density) of the last full evaluation of a system on its lattice, with
+    the NCI descriptors derived from them, so they can be updated in place
+    when some atoms move. Check `FieldCache`.
+    """
+
+    def __init__(self, origin, spacing, shape, numbers, coords, fragments, n_fragments,
+                 exclusion=None):
+        shape = tuple(shape)
+        self.origin, self.spacing, self.shape = origin, spacing, shape
+        self.numbers, self.coords = numbers, coords.copy()
+        self.fragments, self.n_fragments = fragments, n_fragments
+        self.exclusion = exclusion or {}
+        self.rho = np.zeros(shape)
+        self.grad = np.zeros(shape + (3,))
+        self.hess = np.zeros(shape + (6,))
+        self.rho_fragments = np.zeros(shape + (n_fragments,)) if n_fragments > 1 else None
+        self.sl2rho = np.zeros(shape)
+        self.rdg = np.zeros(shape)
+        self.excluded = np.zeros(shape, dtype=bool)
+
+    @staticmethod
+    def nbytes(shape, n_fragments):
+        floats = 12 + (n_fragments if n_fragments > 1 else 0)
+        return int(np.prod(shape, dtype=float)) * (8 * floats + 1)
+
+    def store(self, block, rho, grad, hess, rho_fragments):
+        """
+        Keep the fields of a freshly evaluated `block`. `rho` is written by
+        the caller, along with the descriptors.
+        """
+        block_shape = tuple(s.stop - s.start for s in block)
+        self.grad[block] = grad.reshape(block_shape + (3,))
+        self.hess[block] = pack_hessian(hess).reshape(block_shape + (6,))
+        if self.rho_fragments is not None:
+            self.rho_fragments[block] = rho_fragments.reshape(block_shape + (-1,))
+
+    def contains(self, origin, spacing, shape):
+        """
+        Whether the lattice of a new run is part of this one, which can
+        then be kept.
+        """
+        if not np.allclose(spacing, self.spacing):
+            return False
+        hi = origin + spacing * (np.array(shape) - 1)
+        own_hi = self.origin + self.spacing * (np.array(self.shape) - 1)
+        return bool((origin >= self.origin - 1e-6).all() and (hi <= own_hi + 1e-6).all())
+
+    def changes(self, atoms, coords=None, cutoffs=None, block_size=16, chunk_size=2**21):
+        """
+        Fields and descriptors that the blocks within the `cutoffs` of
+        `atoms` (indices) would have if those atoms were moved to `coords`
+        (bohr), or deleted if `coords` is None. The old contributions are
+        subtracted and the new ones added, only in the blocks a full
+        evaluation (tiled in the same way) would visit for them, and the
+        descriptors and `exclusion` (check `excluded_points`) are derived
+        again there. The state itself is not modified.
+
+        Yields
+        ------
+        block : tuple of slice
+        rho, grad, hess, rho_fragments, sl2rho, rdg, excluded : np.ndarray
+            Flattened over the points of the block. `hess` is packed and
+            `rho_fragments` is None for a single fragment.
+        """
+        atoms = np.asarray(atoms, dtype=int)
+        if not len(atoms):
+            return
+        old = self.coords[atoms]
+        new = old[:0] if coords is None else np.asarray(coords, dtype=float).reshape(-1, 3)
+        numbers, fragments, radii = self.numbers[atoms], self.fragments[atoms], cutoffs[atoms]
+        reach = radii.max()
+        before = CellList(old, reach)
+        after = CellList(new, reach) if len(new) else None
+        both = np.concatenate([old, new])
+        lo, hi = both.min(axis=0) - reach, both.max(axis=0) + reach
+        first = np.maximum(np.floor((lo - self.origin) / self.spacing).astype(int), 0)
+        last = np.minimum(np.floor((hi - self.origin) / self.spacing).astype(int),
+                          np.array(self.shape) - 1)
+        blocks = [] if (first > last).any() else np.ndindex(
+            *(last // block_size - first // block_size + 1))
+        for offset in blocks:
+            index = first // block_size + offset
+            block = tuple(slice(i * block_size, min((i + 1) * block_size, n))
+                          for (i, n) in zip(index, self.shape))
+            points = block_points(block, self.origin, self.spacing)
+            lo_b, hi_b = points.min(axis=0), points.max(axis=0)
+            gone = before.query_box(lo_b, hi_b, radii)
+            came = after.query_box(lo_b, hi_b, radii) if after is not None else gone[:0]
+            if not len(gone) and not len(came):
+                continue
+            o_rho, o_grad, o_hess, o_frags = evaluate(
+                points, old[gone], numbers[gone], fragments=fragments[gone],
+                n_fragments=self.n_fragments, chunk_size=chunk_size)
+            n_rho, n_grad, n_hess, n_frags = evaluate(
+                points, new[came], numbers[came], fragments=fragments[came],
+                n_fragments=self.n_fragments, chunk_size=chunk_size)
+            rho = self.rho[block].ravel() - o_rho + n_rho
+            grad = self.grad[block].reshape(-1, 3) - o_grad + n_grad
+            hess = self.hess[block].reshape(-1, 6) - pack_hessian(o_hess) + pack_hessian(n_hess)
+            rho_fragments = None
+            if self.rho_fragments is not None:
+                rho_fragments = (self.rho_fragments[block].reshape(-1, self.n_fragments)
+                                 - o_frags + n_frags)
+            sl2rho, rdg = nci_descriptors(rho, grad, unpack_hessian(hess))
+            excluded = excluded_points(points, rho, rho_fragments, **self.exclusion)
+            yield block, rho, grad, hess, rho_fragments, sl2rho, rdg, excluded
+
+    def update(self, coords, cutoffs, block_size, max_moved=0.25, chunk_size=2**21):
+        """
+        Move the atoms to `coords` (bohr), applying their `changes` in place.
+
+        Returns
+        -------
+        grids : NCIGrids or None
+            None if more than a `max_moved` fraction of the atoms moved,
+            in which case a full evaluation is cheaper.
+        """
+        moved = np.flatnonzero((np.abs(coords - self.coords) > 1e-9).any(axis=1))
+        if len(moved) > max_moved * len(coords):
+            return None
+        evaluated = 0
+        for block, rho, grad, hess, rho_fragments, sl2rho, rdg, excluded in self.changes(
+                moved, coords[moved], cutoffs, block_size, chunk_size=chunk_size):
+            block_shape = tuple(s.stop - s.start for s in block)
+            self.rho[block] = rho.reshape(block_shape)
+            self.grad[block] = grad.reshape(block_shape + (3,))
+            self.hess[block] = hess.reshape(block_shape + (6,))
+            if rho_fragments is not None:
+                self.rho_fragments[block] = rho_fragments.reshape(block_shape + (-1,))
+            self.sl2rho[block] = sl2rho.reshape(block_shape)
+            self.rdg[block] = rdg.reshape(block_shape)
+            self.excluded[block] = excluded.reshape(block_shape)
+            evaluated += len(rho)
+        self.coords = coords.copy()
+        return NCIGrids(self.origin, self.spacing, self.numbers, coords, self.rho,
+                        self.sl2rho, self.rdg, self.excluded, evaluated)
+
+
+class FieldCache(object):
+
+    """
+    `FieldState` of the last promolecular runs, keyed on everything but
+    the coordinates: a new run of the same system is then an incremental
+    update of the atoms that moved, as long as its lattice fits in the
+    previous one.
+
+    The grids returned share their arrays with the kept state, which later
+    updates modify in place, so they must be turned into cubes (which
+    copies them) before running again. `PromolecularNCI.compute` and
+    `compute_in_memory` do so while holding `lock`, so runs in several
+    threads take turns.
+
+    Parameters
+    ----------
+    max_entries : int, optional
+        Number of systems kept.
+    max_bytes : int, optional
+        Memory budget. Larger grids are not kept at all.
+    max_moved : float, optional
+        Fraction of moved atoms above which a full run is done instead.
+    """
+
+    def __init__(self, max_entries=1, max_bytes=DEFAULT_FIELD_CACHE_SIZE, max_moved=0.25):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_moved = max_moved
+        self.entries = OrderedDict()
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def key(numbers, fragments, **options):
+        digest = hashlib.sha1()
+        digest.update(np.ascontiguousarray(numbers, dtype=np.int64).tobytes())
+        digest.update(np.ascontiguousarray(fragments, dtype=np.int64).tobytes())
+        digest.update(json.dumps(options, sort_keys=True, default=str).encode('utf-8'))
+        return digest.hexdigest()
+
+    def get(self, key):
+        state = self.entries.pop(key, None)
+        if state is not None:
+            self.entries[key] = state  # most recently used
+        return state
+
+    def allocate(self, key, origin, spacing, shape, numbers, coords, fragments, n_fragments,
+                 exclusion=None):
+        """
+        New empty `FieldState`, replacing the one under `key` and evicting
+        others to make room. None if it does not fit in `max_bytes`.
+        """
+        self.entries.pop(key, None)
+        size = FieldState.nbytes(shape, n_fragments)
+        if size > self.max_bytes or self.max_entries < 1:
+            return None
+        while self.entries and (len(self.entries) >= self.max_entries
+                                or self.size() + size > self.max_bytes):
+            self.entries.popitem(last=False)
+        return FieldState(origin, spacing, shape, numbers, coords, fragments, n_fragments,
+                          exclusion=exclusion)
+
+    def put(self, key, state):
+        self.entries[key] = state
+
+    def size(self):
+        return sum(FieldState.nbytes(s.shape, s.n_fragments) for s in self.entries.values())
+
+    def resize(self, max_bytes):
+        """
+        Change `max_bytes`, evicting the least recently used states that
+        do not fit anymore.
+        """
+        with self.lock:
+            self.max_bytes = max_bytes
+            while self.entries and self.size() > max_bytes:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class CellList(object):
+
+    """
+    Uniform cell list over atom coordinates, used to find the atoms whose
+    cutoff sphere overlaps a grid block.
+
+    Parameters
+    ----------
+    coords : np.ndarray, shape=(N, 3)
+        Atom coordinates.
+    cell_size : float
+        Cell edge. Using the largest cutoff radius keeps queries within a few
+        neighbouring cells.
+    """
+
+    def __init__(self, coords, cell_size):
+        self.coords = coords
+        self.cell_size = max(cell_size, 1e-6)
+        self.origin = coords.min(axis=0)
+        cells = np.floor((coords - self.origin) / self.cell_size).astype(int)
+        self.shape = cells.max(axis=0) + 1
+        flat = np.ravel_multi_index(cells.T, self.shape)
+        self.order = np.argsort(flat, kind='mergesort')
+        self.bounds = np.searchsorted(flat[self.order], np.arange(np.prod(self.shape) + 1))
+
+    def query_box(self, lo, hi, radii):
+        """
+        Indices of the atoms whose sphere of radius `radii` (one per atom)
+        intersects the axis-aligned box defined by corners `lo` and `hi`.
+        """
+        reach = radii.max() if len(radii) else 0
+        first = np.floor((lo - reach - self.origin) / self.cell_size).astype(int)
+        last = np.floor((hi + reach - self.origin) / self.cell_size).astype(int)
+        first = np.maximum(first, 0)
+        last = np.minimum(last, self.shape - 1)
+        if (first > last).any():
+            return np.zeros(0, dtype=int)
+        ranges = [np.arange(a, b + 1) for a, b in zip(first, last)]
+        grid = np.meshgrid(*ranges, indexing='ij')
+        flat = np.ravel_multi_index([g.ravel() for g in grid], self.shape)
+        candidates = np.concatenate([self.order[self.bounds[i]:self.bounds[i + 1]]
+                                     for i in flat])
+        gap = np.maximum(np.maximum(lo - self.coords[candidates],
+                                    self.coords[candidates] - hi), 0)
+        inside = (gap * gap).sum(axis=1) <= radii[candidates] ** 2
+        return np.sort(candidates[inside])
+
+    def cells(self, points):
+        """
+        Cell indices of `points`. Points outside the grid get the closest cell.
+        """
+        ijk = np.floor((points - self.origin) / self.cell_size).astype(int)
+        return np.clip(ijk, 0, self.shape - 1)
+
+    def ring(self, cell, width):
+        """
+        Indices of the atoms in the cells within `width` cells of `cell`.
+        """
+        neighbours = cell + ring_offsets(width)
+        neighbours = neighbours[((neighbours >= 0) & (neighbours < self.shape)).all(axis=1)]
+        flat = np.ravel_multi_index(neighbours.T, self.shape)
+        return self.order[concatenated_ranges(self.bounds[flat], self.bounds[flat + 1])]
+
+    def nearest(self, points, k=1, chunk_size=2**22):
+        """
+        The `k` nearest atoms to each of `points`.
+
+        Points are grouped by cell, and compared to the atoms in a ring of
+        cells around it, which is exact for the atoms closer than the ring
+        width. The points whose k-th atom lies farther are searched again
+        with a ring twice as wide.
+
+        Returns
+        -------
+        indices : np.ndarray of int, shape=(M, k)
+            Closest first. -1 where there are less than `k` atoms.
+        distances : np.ndarray of float, shape=(M, k)
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        indices = np.full((len(points), k), -1, dtype=np.int64)
+        distances = np.full((len(points), k), np.inf)
+        if not len(points) or not len(self.coords):
+            return indices, distances
+        cells = self.cells(points)
+        flat = np.ravel_multi_index(cells.T, self.shape)
+        pending = np.argsort(flat)  # grouped by cell, and stays so
+        width, widest = 1, int(self.shape.max())
+        while len(pending):
+            # gather and scatter once per pass; groups are slices in between
+            subset, subset_cells = points[pending], cells[pending]
+            found = np.full((len(pending), k), -1, dtype=np.int64)
+            found_distances = np.full((len(pending), k), np.inf)
+            bounds = np.r_[0, np.flatnonzero(np.diff(flat[pending])) + 1, len(pending)]
+            for lo, hi in zip(bounds[:-1], bounds[1:]):
+                atoms = self.ring(subset_cells[lo], width)
+                if not len(atoms):
+                    continue
+                lookup = np.append(atoms, -1)  # so that -1 stays -1
+                step = max(1, chunk_size // len(atoms))
+                for start in range(lo, hi, step):
+                    end = min(start + step, hi)
+                    idx, found_distances[start:end] = brute_force_nearest(
+                        subset[start:end], self.coords[atoms], k)
+                    found[start:end] = lookup[idx]
+            indices[pending], distances[pending] = found, found_distances
+            if width >= widest:  # every cell was searched
+                break
+            # farther than the ring width: there may be closer ones outside it
+            pending = pending[found_distances[:, -1] > width * self.cell_size]
+            width *= 2
+        return indices, distances
+
+
+def ring_offsets(width, _cache={}):
+    """
+    Offsets of the (2 * `width` + 1)**3 cells around a cell, cached.
+    """
+    if width not in _cache:
+        span = np.arange(-width, width + 1)
+        _cache[width] = np.column_stack([g.ravel() for g in np.meshgrid(span, span, span)])
+    return _cache[width]
+
+
+def concatenated_ranges(starts, ends):
+    """
+    Concatenation of `np.arange(s, e)` for every pair, without a loop.
+    """
+    lengths = ends - starts
+    offsets = np.cumsum(lengths) - lengths
+    return np.arange(lengths.sum(), dtype=np.int64) + np.repeat(starts - offsets, lengths)
+
+
+def brute_force_nearest(points, coords, k=1):
+    """
+    The `k` nearest `coords` to each of `points`, like `CellList.nearest`.
+    Atoms are ranked by |a|^2 - 2 p.a, which orders them like their
+    distance to p, with a single matrix product; only the distances of the
+    best are computed.
+    """
+    p, a = points - coords[0], coords - coords[0]  # small values, for precision
+    scores = p.dot(a.T * -2)
+    scores += (a * a).sum(axis=1)
+    rows = np.arange(len(points))
+    idx = np.full((len(points), k), -1, dtype=np.int64)
+    dist = np.full((len(points), k), np.inf)
+    for j in range(min(k, len(coords))):
+        best = scores.argmin(axis=1)
+        d = p - a[best]
+        idx[:, j], dist[:, j] = best, np.sqrt((d * d).sum(axis=1))
+        scores[rows, best] = np.inf
+    return idx, dist
+
+
+def iter_blocks(shape, size):
+    """
+    Yield 3-tuples of slices that tile a grid of the given `shape` in cubic
+    blocks with edge `size` (smaller at the borders).
+    """
+    nx, ny, nz = shape
+    for i in range(0, nx, size):
+        for j in range(0, ny, size):
+            for k in range(0, nz, size):
+                yield (slice(i, min(i + size, nx)), slice(j, min(j + size, ny)),
+                       slice(k, min(k + size, nz)))
+
+
+def block_points(block, origin, spacing):
+    """
+    Cartesian coordinates of the voxels in `block`, in [x, y, z] C order.
+    """
+    return index_points([np.arange(b.start, b.stop) for b in block], origin, spacing)
+
+
+def index_points(indices, origin, spacing):
+    """
+    Cartesian coordinates of the voxels in the outer product of the three
+    arrays of grid `indices`, in [x, y, z] C order.
+    """
+    axes = [origin[d] + spacing[d] * np.asarray(indices[d]) for d in range(3)]
+    grid = np.meshgrid(*axes, indexing='ij')
+    return np.stack([g.ravel() for g in grid], axis=1)
+
+
+def coarse_indices(axis_slice, factor):
+    """
+    Every `factor`-th index of `axis_slice`, always including the last one,
+    so neighbouring blocks share their boundary samples.
+    """
+    indices = np.arange(axis_slice.start, axis_slice.stop, factor)
+    if indices[-1] != axis_slice.stop - 1:
+        indices = np.append(indices, axis_slice.stop - 1)
+    return indices
+
+
+def nearest_sample(axis_slice, samples):
+    """
+    For each index of `axis_slice`, position in `samples` of the closest one.
+    """
+    indices = np.arange(axis_slice.start, axis_slice.stop)
+    return np.abs(indices[:, None] - samples[None, :]).argmin(axis=1)
+
+
+def evaluate(points, coords, numbers, fragments=None, n_fragments=1, chunk_size=2**21):
+    """
+    Accumulate promolecular density, gradient and Hessian of the given atoms.
+
+    Parameters
+    ----------
+    points : np.ndarray, shape=(P, 3)
+        Evaluation points, in bohr.
+    coords : np.ndarray, shape=(N, 3)
+        Atom coordinates, in bohr.
+    numbers : np.ndarray, shape=(N,)
+        Atomic numbers.
+    fragments : np.ndarray, shape=(N,), optional
+        Fragment index of each atom, used to report per-fragment densities.
+    n_fragments : int, optional
+        Number of fragments.
+    chunk_size : int, optional
+        Maximum number of (point, atom) pairs evaluated at once.
+
+    Returns
+    -------
+    rho : np.ndarray, shape=(P,)
+    grad : np.ndarray, shape=(P, 3)
+    hess : np.ndarray, shape=(P, 3, 3)
+    rho_fragments : np.ndarray, shape=(P, n_fragments)
+    """
+    n_points = len(points)
+    rho = np.zeros(n_points)
+    grad = np.zeros((n_points, 3))
+    hess = np.zeros((n_points, 3, 3))
+    rho_fragments = np.zeros((n_points, n_fragments))
+    if fragments is None:
+        fragments = np.zeros(len(coords), dtype=int)
+    step = max(1, chunk_size // max(n_points, 1))
+    for start in range(0, len(coords), step):
+        end = start + step
+        c = COEFFICIENTS[numbers[start:end] - 1]
+        zeta = EXPONENTS[numbers[start:end] - 1]
+        d = points[:, None, :] - coords[None, start:end, :]
+        r = np.sqrt((d * d).sum(axis=2))
+        np.maximum(r, 1e-10, out=r)
+        u = d / r[..., None]
+        e = c * np.exp(-r[..., None] / zeta)
+        f = e.sum(axis=2)
+        fp = -(e / zeta).sum(axis=2)
+        fpp = (e / zeta ** 2).sum(axis=2)
+        fp_r = fp / r
+        rho += f.sum(axis=1)
+        grad += np.einsum('pn,pni->pi', fp, u)
+        hess += np.einsum('pn,pni,pnj->pij', fpp - fp_r, u, u)
+        hess += fp_r.sum(axis=1)[:, None, None] * np.eye(3)
+        owners = fragments[start:end]
+        onehot = np.zeros((len(owners), n_fragments))
+        onehot[np.arange(len(owners)), owners] = 1
+        rho_fragments += f.dot(onehot)
+    return rho, grad, hess, rho_fragments
+
+
+def nci_descriptors(rho, grad, hess):
+    """
+    Compute sign(lambda2)*rho and the reduced density gradient. Points
+    without any density get the RDG sentinel used by NCIPlot, 100.
+    """
+    safe_rho = np.maximum(rho, 1e-30)
+    rdg = np.sqrt((grad * grad).sum(axis=1)) / (RDG_PREFACTOR * safe_rho ** (4 / 3))
+    rdg[rho <= 1e-30] = 100.0
+    lambda2 = np.linalg.eigvalsh(hess)[:, 1]
+    return np.sign(lambda2) * rho, rdg
+
+
+def excluded_points(points, rho, rho_fragments, intermolecular=None, center=None,
+                    radius=None):
+    """
+    Points left out of the cubes and dat file: those dominated by a single
+    fragment (`intermolecular`) or outside the sphere of `radius` (bohr)
+    around `center`.
+    """
+    excluded = np.zeros(len(points), dtype=bool)
+    if intermolecular:
+        excluded |= rho_fragments.max(axis=1) > intermolecular * rho
+    if center is not None:
+        excluded |= ((points - center) ** 2).sum(axis=1) > radius ** 2
+    return excluded
+
+
+def pack_hessian(hess):
+    """
+    (P, 3, 3) symmetric Hessians to their (P, 6) `HESSIAN_COMPONENTS`.
+    """
+    return np.stack([hess[:, i, j] for (i, j) in HESSIAN_COMPONENTS], axis=1)
+
+
+def unpack_hessian(packed):
+    """
+    Inverse of `pack_hessian`.
+    """
+    hess = np.empty((len(packed), 3, 3))
+    for n, (i, j) in enumerate(HESSIAN_COMPONENTS):
+        hess[:, i, j] = hess[:, j, i] = packed[:, n]
+    return hess
+
+
+def output_cubes(grids, cube_cutoffs=(0.07, 0.3)):
+    """
+    Build the gradient and density cubes NCIPlot would write, in memory.
+
+    Returns
+    -------
+    gradient, density : cube.Cube
+    """
+    rdg_cube = np.where(grids.excluded | (grids.rho > cube_cutoffs[0]), 100.0, grids.rdg)
+    header = grids.origin, grids.spacing, list(grids.numbers), grids.coords, COMMENTS
+    return Cube(rdg_cube, *header), Cube(100 * grids.sl2rho, *header)
+
+
+def dat_points(grids, dat_cutoffs=(0.2, 1.0)):
+    """
+    (sign(lambda2)*rho, RDG) pairs that NCIPlot would write in the dat file.
+    """
+    selected = ~grids.excluded & (grids.rho < dat_cutoffs[0]) & (grids.rdg < dat_cutoffs[1])
+    return np.column_stack((grids.sl2rho[selected], grids.rdg[selected]))
+
+
+def summary(grids):
+    """
+    Output lines reporting the grid size and the points actually evaluated.
+    """
+    total = grids.rho.size
+    return ['Grid points: {}\n'.format(total),
+            'Evaluated points: {} ({:.1%})\n'.format(grids.evaluated, grids.evaluated / total)]
+
+
+def write_outputs(workdir, name, grids, dat_cutoffs=(0.2, 1.0), cube_cutoffs=(0.07, 0.3)):
+    """
+    Write `-grad.cube`, `-dens.cube` and `.dat` files like NCIPlot does and
+    return the corresponding `data` dict.
+    """
+    grad_cube = os.path.join(workdir, name + '-grad.cube')
+    dens_cube = os.path.join(workdir, name + '-dens.cube')
+    xy_data = os.path.join(workdir, name + '.dat')
+
+    for path, cube in zip((grad_cube, dens_cube), output_cubes(grids, cube_cutoffs)):
+        write_cube(path, cube.data, cube.origin, cube.spacing, cube.numbers, cube.coords)
+    np.savetxt(xy_data, dat_points(grids, dat_cutoffs), fmt='%16.8E')
+
+    return {'grad_cube': grad_cube, 'dens_cube': dens_cube, 'xy_data': xy_data,
+            'rho': cube_cutoffs[0], 'rdg': cube_cutoffs[1], '_raw': summary(grids)}
+
+
+def memory_outputs(grids, dat_cutoffs=(0.2, 1.0), cube_cutoffs=(0.07, 0.3)):
+    """
+    Like `write_outputs`, without files. The `data` dict carries the arrays
+    under two private keys, which must be popped before serializing it:
+
+    - `_cubes`: (gradient, density) `cube.Cube` objects.
+    - `_xy`: the dat file contents, as returned by `dat_points`.
+    """
+    return {'rho': cube_cutoffs[0], 'rdg': cube_cutoffs[1], '_raw': summary(grids),
+            '_cubes': output_cubes(grids, cube_cutoffs), '_xy': dat_points(grids, dat_cutoffs)}
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Receptor grids for screening many ligand poses with the promolecular engine.
+
+Promolecular densities are additive, and so are their gradients and
+Hessians. The contribution of a receptor can be evaluated once on a fixed
+lattice around its binding site and stored in memory-mapped `.npy` files.
+Each pose then only needs the contribution of its own atoms on the part of
+the lattice around it, before deriving sign(lambda2)*rho and the RDG.
+
+The lattice is filled lazily, block by block, the first time a pose needs
+it, and kept on disk under a hash of the receptor and the lattice, so other
+sessions (or the worker processes of a batch run, which share the mapped
+pages) reuse it. The least recently used grids are evicted when they take
+more than `DEFAULT_RECEPTOR_CACHE_SIZE` on disk.
+"""
+
+from __future__ import print_function, division
+# Python stdlib
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+# Additional 3rd parties
+import numpy as np
+# Own
+from .cache import DEFAULT_CACHE_DIR
+from .promolecular import (CellList, atomic_numbers, cutoff_radii, evaluate, grid_box,
+                           block_points, pack_hessian, unpack_hessian, BOHR)
+
+
+DEFAULT_RECEPTOR_DIR = os.path.join(DEFAULT_CACHE_DIR, 'receptors')
+DEFAULT_RECEPTOR_CACHE_SIZE = 4 * 1024 ** 3  # bytes
+
+
+class ReceptorGrid(object):
+
+    """
+    Memory-mapped promolecular density, gradient and Hessian of a receptor
+    on a fixed lattice. Use `receptor_grid` to get one.
+
+    Parameters
+    ----------
+    directory : str
+        Where the grid was created with `ReceptorGrid.create`.
+    writable : bool, optional
+        Open the maps for writing, so missing blocks can be filled in.
+        Otherwise, `fields` fails on regions that are not filled yet.
+    """
+
+    def __init__(self, directory, writable=True):
+        self.directory = directory
+        self.writable = writable
+        with open(os.path.join(directory, 'header.json')) as f:
+            header = json.load(f)
+        self.key = header['key']
+        self.origin = np.array(header['origin'], dtype=float)
+        self.spacing = np.array(header['spacing'], dtype=float)
+        self.shape = tuple(header['shape'])
+        self.block_size = header['block_size']
+        self.density_threshold = header['density_threshold']
+        with np.load(os.path.join(directory, 'atoms.npz')) as atoms:
+            self.numbers, self.coords = atoms['numbers'], atoms['coords']
+        mode = 'r+' if writable else 'r'
+        self.rho, self.grad, self.hess, self.filled = [
+            np.load(os.path.join(directory, name + '.npy'), mmap_mode=mode)
+            for name in ('rho', 'grad', 'hess', 'filled')]
+        self._cells = None
+
+    @classmethod
+    def create(cls, directory, numbers, coords, origin, spacing, shape, key='',
+               block_size=16, density_threshold=1e-5):
+        """
+        Allocate an empty grid in `directory`, which must not exist.
+        Arrays are written as sparse files, so unfilled blocks take no space.
+        """
+        staging = tempfile.mkdtemp(prefix='.tmp_', dir=os.path.dirname(directory))
+        try:
+            np.savez(os.path.join(staging, 'atoms.npz'), numbers=numbers, coords=coords)
+            blocks = tuple(-(-n // block_size) for n in shape)
+            for name, dtype, full_shape in (('rho', float, shape), ('grad', float, shape + (3,)),
+                                            ('hess', float, shape + (6,)),
+                                            ('filled', bool, blocks)):
+                array = np.lib.format.open_memmap(os.path.join(staging, name + '.npy'),
+                                                  mode='w+', dtype=dtype, shape=full_shape)
+                del array
+            header = {'key': key, 'origin': list(map(float, origin)),
+                      'spacing': list(map(float, spacing)), 'shape': list(map(int, shape)),
+                      'block_size': block_size, 'density_threshold': density_threshold}
+            with open(os.path.join(staging, 'header.json'), 'w') as f:
+                json.dump(header, f)
+            os.rename(staging, directory)
+        except OSError:
+            shutil.rmtree(staging, ignore_errors=True)
+            if not os.path.isfile(os.path.join(directory, 'header.json')):
+                raise  # else, created concurrently by someone else
+        return cls(directory)
+
+    def region(self, lo, hi):
+        """
+        Slices of the lattice covering the box between `lo` and `hi` (bohr),
+        clipped to the grid.
+
+        Raises
+        ------
+        ValueError, if the box does not overlap the grid.
+        """
+        first = np.ceil((np.asarray(lo) - self.origin) / self.spacing - 1e-6).astype(int)
+        last = np.floor((np.asarray(hi) - self.origin) / self.spacing + 1e-6).astype(int)
+        first, last = np.maximum(first, 0), np.minimum(last, np.array(self.shape) - 1)
+        if (first > last).any():
+            raise ValueError('The ligand lies outside of the receptor grid.')
+        return tuple(slice(int(a), int(b) + 1) for (a, b) in zip(first, last))
+
+    def region_origin(self, region):
+        return self.origin + self.spacing * np.array([s.start for s in region])
+
+    def fill(self, region=None, chunk_size=2**21):
+        """
+        Evaluate the receptor on the blocks of `region` (the whole lattice by
+        default) that were not filled yet.
+
+        Returns
+        -------
+        evaluated : int
+            Number of grid points evaluated.
+        """
+        if region is None:
+            region = tuple(slice(0, n) for n in self.shape)
+        b = self.block_size
+        first = np.array([s.start // b for s in region])
+        missing = first + np.argwhere(~self.filled[tuple(slice(i, (s.stop - 1) // b + 1)
+                                                         for (i, s) in zip(first, region))])
+        if not len(missing):
+            return 0
+        if not self.writable:
+            raise ValueError('The receptor grid is not filled for this region yet.')
+        if self._cells is None:
+            self._cutoffs = cutoff_radii(self.numbers, self.density_threshold)
+            self._cells = CellList(self.coords, self._cutoffs.max())
+        evaluated = 0
+        for index in missing:
+            block = tuple(slice(i * b, min((i + 1) * b, n)) for (i, n) in zip(index, self.shape))
+            points = block_points(block, self.origin, self.spacing)
+            near = self._cells.query_box(points.min(axis=0), points.max(axis=0), self._cutoffs)
+            rho, grad, hess, _ = evaluate(points, self.coords[near], self.numbers[near],
+                                          chunk_size=chunk_size)
+            block_shape = tuple(s.stop - s.start for s in block)
+            self.rho[block] = rho.reshape(block_shape)
+            self.grad[block] = grad.reshape(block_shape + (3,))
+            self.hess[block] = pack_hessian(hess).reshape(block_shape + (6,))
+            self.filled[tuple(index)] = True  # only once the values are in
+            evaluated += len(points)
+        for array in (self.rho, self.grad, self.hess, self.filled):
+            array.flush()
+        return evaluated
+
+    def fields(self, region):
+        """
+        Receptor density, gradient and Hessian over `region`, in [x, y, z]
+        order. Missing blocks are filled first.
+
+        Returns
+        -------
+        rho : np.ndarray, shape=(X, Y, Z)
+        grad : np.ndarray, shape=(X, Y, Z, 3)
+        hess : np.ndarray, shape=(X, Y, Z, 3, 3)
+        """
+        self.fill(region)
+        packed = np.array(self.hess[region])
+        hess = unpack_hessian(packed.reshape(-1, 6)).reshape(packed.shape[:3] + (3, 3))
+        return np.array(self.rho[region]), np.array(self.grad[region]), hess
+
+    def size(self):
+        """
+        Bytes used on disk.
+        """
+        return sum(os.stat(os.path.join(self.directory, name)).st_blocks * 512
+                   for name in os.listdir(self.directory))
+
+
+def receptor_grid(elements, coords, cube=None, radius=None, increments=None, padding=3.0,
+                  root=DEFAULT_RECEPTOR_DIR, block_size=16, density_threshold=1e-5,
+                  max_size=DEFAULT_RECEPTOR_CACHE_SIZE):
+    """
+    Open the cached grid of a receptor, or create it.
+
+    Parameters
+    ----------
+    elements : list of str
+    coords : np.ndarray, shape=(N, 3)
+        Receptor coordinates, in Angstrom.
+    cube, radius, increments : optional
+        Lattice, with the same meaning as in `NCIPlot.create_nci_input`.
+        It should enclose the binding site and the poses to screen, since
+        only the poses' surroundings inside it are computed. Defaults to
+        the box around the whole receptor, with `padding` Angstrom.
+    root : str, optional
+        Directory where receptor grids are stored.
+    max_size : int, optional
+        Bytes the grids in `root` may take on disk. Least recently used
+        ones are removed to make room, but never the one returned.
+
+    Returns
+    -------
+    grid : ReceptorGrid
+    """
+    numbers = atomic_numbers(elements)
+    coords = np.asarray(coords, dtype=float).reshape(-1, 3) / BOHR
+    origin, spacing, shape = grid_box(coords, np.zeros(len(coords), dtype=int),
+                                      padding=padding, cube=cube, radius=radius,
+                                      increments=increments)
+    digest = hashlib.sha1()
+    digest.update(np.ascontiguousarray(numbers, dtype=np.int64).tobytes())
+    digest.update(np.ascontiguousarray(np.round(coords, 5)).tobytes())
+    digest.update(json.dumps([list(np.round(origin, 6)), list(np.round(spacing, 6)),
+                              list(shape), block_size, density_threshold]).encode('utf-8'))
+    key = digest.hexdigest()
+    directory = os.path.join(root, key)
+    if os.path.isfile(os.path.join(directory, 'header.json')):
+        grid = ReceptorGrid(directory)
+        os.utime(os.path.join(directory, 'header.json'), None)  # mark as recently used
+    else:
+        if not os.path.isdir(root):
+            os.makedirs(root)
+        grid = ReceptorGrid.create(directory, numbers, coords, origin, spacing, shape, key=key,
+                                   block_size=block_size, density_threshold=density_threshold)
+    evict_receptor_grids(root, max_size, keep=key)
+    return grid
+
+
+def receptor_grids(root=DEFAULT_RECEPTOR_DIR):
+    """
+    List (last_used, size, key) for every grid in `root`, oldest first.
+    """
+    if not os.path.isdir(root):
+        return []
+    entries = []
+    for key in os.listdir(root):
+        header = os.path.join(root, key, 'header.json')
+        if key.startswith('.') or not os.path.isfile(header):
+            continue
+        size = sum(os.stat(os.path.join(root, key, name)).st_blocks * 512
+                   for name in os.listdir(os.path.join(root, key)))
+        entries.append((os.path.getmtime(header), size, key))
+    return sorted(entries)
+
+
+def evict_receptor_grids(root=DEFAULT_RECEPTOR_DIR, max_size=DEFAULT_RECEPTOR_CACHE_SIZE,
+                         keep=None):
+    """
+    Remove least recently used grids until those in `root` fit in
+    `max_size` bytes. The grid `keep` is never removed. Sessions that still
+    map a removed grid keep reading it; it is freed once they close it.
+    """
+    entries = receptor_grids(root)
+    total = sum(size for _, size, _ in entries)
+    for _, size, key in entries:
+        if total <= max_size:
+            break
+        if key == keep:
+            continue
+        shutil.rmtree(os.path.join(root, key), ignore_errors=True)
+        total -= size
@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Chimera-free helpers to prepare NCIPlot inputs, launch the binary and
+parse its output. `core.NCIPlot` builds on these for the GUI, and they can
+also be used from worker threads or processes.
+"""
+
+from __future__ import print_function, division
+# Python stdlib
+import os
+import re
+import subprocess
+import time
+try:
+    from cStringIO import StringIO
+except ImportError:  # Python 3
+    from io import StringIO
+
+
+PERCENT_RE = re.compile(r'(\d+(?:\.\d+)?)\s*%')
+GRID_RE = re.compile(r'nx\s*,\s*ny\s*,\s*nz\s*=\s*(\d+)\s+(\d+)\s+(\d+)')
+STAGES = (
+    # (substring in stdout line, stage name); checked in order
+    ('MoleculeFile', 'Reading molecules'),
+    ('Operating grid', 'Computing density and RDG'),
+    ('Writing output', 'Writing output files'),
+    ('OutPut filenam Prefix', 'Computing density and RDG'),
+    ('Range of values', 'Writing output files'),
+    ('.cube rho range', 'Writing output files'),
+)
+
+
+def implementation(binary):
+    """
+    Guess the NCIPlot flavour ('CUDA' or 'CPU') from the binary name.
+    """
+    return 'CUDA' if 'cuda' in os.path.split(binary)[1].lower() else 'CPU'
+
+
+def create_nci_input(paths, output_level=3, ligand=None,
+                     dat_cutoffs=(0.2, 1.0), cube_cutoffs=(0.07, 0.3), intermolecular=None,
+                     radius=None, cube=None, increments=None, name=None, **kwargs):
+    """
+    Creates a file-like object with NCIPlot input options
+
+    Parameters
+    ----------
+    paths : list of str
+        Paths to XYZ molecule files.
+
+    # Output options
+    name : str, optional, default=None
+        If set, replaces the output name, which by default is the molecule name
+        without extension.
+    output_level : int, optional, default=3
+        How many files should NCI plot create. Level 1 is minimum output, level 3
+        creates up to 4 files.
+    dat_cutoffs : 2-tuple of float, optional, default=(0.2, 1.0)
+        Density and RDG cutoffs used in creating the dat file
+    cube_cutoffs : 2-tuple of float, optional, default=(0.07, 0.3)
+        Density (r1) and RDG (r2) cutoffs used when creating the cube files.
+        r1 will set the cutoff for both the density and the RDG to be registered
+        in the cube files, whereas r2 will be used for isosurfaces depiction.
+
+    # Filter options
+    intermolecular: float, optional, default=None
+        If set, points where a single molecule contributes more than this
+        fraction of the density are considered intramolecular and discarded.
+        Can be combined with any search option.
+
+    # Search options; If set, only a region will be explored. CHOOSE ONLY ONE!
+    ligand : 2-tuple of float, int, optional, default=None
+        If set, which molecule (by index) is working as a ligand, and the search
+        radius to inspect within that molecule.
+    radius : 4-tuple of float, optional, default=None
+        If set, first three values indicate the origin coordinates of the search
+        sphere, and the fourth value indicates the search radius of such sphere.
+    cube : 6-tuple of float, optional, default=None
+        If set, search within the cube that is drawn between point A (first three
+        floats) and point B (last three floats).
+
+    # Grid options
+    increments : 3-tuple of float, optional, default=None
+        Grid step along each axis, in Angstrom. Can be combined with any
+        search option.
+
+    Returns
+    -------
+    paths : list of str
+        Collection of output files created by NCIPlot
+
+    Notes
+    -----
+    NCI input files follow this scheme. More info @
+    https://github.com/aoterodelaroza/nciplot
+
+        <number of molecule files>
+        <path to molecule file, xyz or wfn>
+        <path to molecule file>...
+        # Optional
+        LIGAND n r #index of molecule in path list, search radius
+        INTERMOLECULAR r # max fraction of density from a single molecule
+        RADIUS x y z r # coordinates center, radius
+        CUBE x0 y0 z0 x1 y1 z1 # draw a cube from a to b
+        INCREMENTS r1 r2 r3
+        CUTOFFS r1 r2 # density and RDG cutoffs for dat file; defaults: 0.2, 1.0
+        CUTPLOT r1 r2 # density and RDG cutoffs for cube file; defaults: 0.07, 0.3
+        ISORDG r # isosurface level; 0.3 for xyz mols, 0.5 for wfn mols
+        OUTPUT [1-3] # level of output: 1 is minimal, 3 max
+        ONAME str # tag name
+    """
+
+    output = StringIO()
+    output.write('{}\n'.format(len(paths)))
+    for path in paths:
+        output.write('{}\n'.format(path))
+
+    if output_level in (1, 2, 3):
+        output.write('OUTPUT {}\n'.format(output_level))
+    if name:
+        output.write('ONAME {}\n'.format(name))
+    if dat_cutoffs:
+        output.write('CUTOFFS {} {}\n'.format(*dat_cutoffs[:2]))
+    if cube_cutoffs:
+        output.write('CUTPLOT {} {}\n'.format(*cube_cutoffs[:2]))
+
+    if intermolecular:
+        output.write('INTERMOLECULAR {}\n'.format(intermolecular))
+    if ligand:
+        output.write('LIGAND {} {}\n'.format(*ligand[:2]))
+    elif radius:
+        output.write('RADIUS {} {} {} {}\n'.format(*radius[:4]))
+    elif cube:
+        output.write('CUBE {} {} {} {} {} {}\n'.format(*cube[:6]))
+    if increments:
+        output.write('INCREMENTS {} {} {}\n'.format(*increments[:3]))
+
+    output.seek(0)
+    return output
+
+
+def parse_stdout_cpu(stdout, basedir):
+    """
+    Get useful data from NCIPlot stdout, or any file-like object.
+
+    Parameters
+    ----------
+    stdout : iterable of str
+        NCIPlot output lines.
+    basedir : str
+        Working directory of the run, where output files are written.
+    """
+    data = {}
+    data['_raw'] = []
+    for line in stdout:
+        if line.startswith('#') or line.startswith('---'):
+            continue
+        elif line.lstrip().startswith('RHO'):
+            data['rho'] = float(line.split()[-1].strip())
+        elif line.lstrip().startswith('RDG'):
+            data['rdg'] = float(line.split()[-1].strip())
+        elif line.rstrip().endswith('-grad.cube'):
+            data['grad_cube'] = os.path.join(basedir, line.split('=')[-1].strip())
+        elif line.rstrip().endswith('-dens.cube'):
+            data['dens_cube'] = os.path.join(basedir, line.split('=')[-1].strip())
+        elif 'LS x RDG' in line:
+            data['xy_data'] = os.path.join(basedir, line.split('=')[-1].strip())
+        data['_raw'].append(line)
+    return data
+
+
+def parse_stdout_cuda(stdout, basedir=None):
+    """
+    Get useful data from CUDA NCIPlot [1] stdout, or any file-like object.
+    Output locations are reported by the program itself, so `basedir` is
+    only accepted for signature parity with `parse_stdout_cpu`.
+
+    [1] A GPU accelerated implementation of NCI calculations using pro-molecular
+        density. Rubez G, Etancelin JM, Vigouroux X, Krajecki M, Boisson JC,
+        Henon E., J. Comput. Chem. 2017, 38, 1071
+    """
+    data = {}
+    basedir = None
+    data['_raw'] = []
+    for line in stdout:
+        data['_raw'].append(line)
+        line = line.strip()
+        if not line.startswith('*'):
+            continue
+        line = line.strip('*')
+        if 'MoleculeFile' in line:
+            basedir = os.path.split(line.split(':')[1].split()[0])[0]
+        elif basedir and 'OutPut filenam Prefix' in line:
+            basename = line.split(':')[1].strip()
+            data['grad_cube'] = os.path.join(basedir, basename + '-RDG.cube')
+            data['dens_cube'] = os.path.join(basedir, basename + '-dens.cube')
+            data['xy_data'] = os.path.join(basedir, basename + '.dat')
+        elif '.cube rho range' in line:
+            data['rho'] = float(line.split()[6])
+        elif '.dat rdg range' in line:
+            data['rdg'] = float(line.split()[6])
+
+    return data
+
+
+def parse_stdout(binary, stdout, basedir):
+    """
+    Dispatch to the stdout parser matching the `binary` implementation.
+    """
+    if implementation(binary) == 'CUDA':
+        return parse_stdout_cuda(stdout, basedir)
+    return parse_stdout_cpu(stdout, basedir)
+
+
+def run_nciplot(binary, xyz, workdir, name='nciplot', started_callback=None, **options):
+    """
+    Launch NCIPlot synchronously inside `workdir` and parse its output.
+
+    Parameters
+    ----------
+    binary : str
+        Path to the NCIPlot (or cuNCI) executable.
+    xyz : list of str
+        Paths to XYZ molecule files.
+    workdir : str
+        Existing directory where the input and output files are written.
+    name : str, optional
+        Output name (ONAME) of the run.
+    started_callback : callable, optional
+        Called with the `subprocess.Popen` object right after launching it,
+        so the caller can terminate it if needed.
+    options :
+        Passed to `create_nci_input`.
+
+    Returns
+    -------
+    data : dict
+        Parsed output, as in `parse_stdout_cpu`.
+    """
+    nci_file = os.path.join(workdir, name + '.nci')
+    with open(nci_file, 'w') as f:
+        f.write(create_nci_input(xyz, name=name, **options).read())
+    process = subprocess.Popen([binary, nci_file], stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT, cwd=workdir,
+                               universal_newlines=True)
+    if started_callback is not None:
+        started_callback(process)
+    stdout, _ = process.communicate()
+    if process.returncode != 0:
+        raise RuntimeError('NCIPlot failed with exit code {} in {}'.format(
+                           process.returncode, workdir))
+    return parse_stdout(binary, stdout.splitlines(True), workdir)
+
+
+class ProgressTracker(object):
+
+    """
+    Incremental parser of NCIPlot stdout, fed one line at a time while the
+    process runs. It keeps track of the current stage, the grid size and,
+    if the binary prints percentages, the completed fraction.
+
+    The ETA is extrapolated from the elapsed time when a fraction is known.
+    Otherwise, it is estimated from the grid size and the throughput
+    (grid points per second) measured in previous runs of this session.
+
+    Attributes
+    ----------
+    lines : list of str
+        Every line fed so far, to be parsed by `parse_stdout` at the end.
+    stage : str
+    fraction : float or None
+    points : int or None
+        Number of grid points, once reported.
+    """
+
+    points_per_second = None  # shared by all trackers; updated in `finished`
+
+    def __init__(self):
+        self.lines = []
+        self.stage = 'Starting'
+        self.fraction = None
+        self.points = None
+        self.started = time.time()
+        self._grid_started = None
+
+    def feed(self, line):
+        self.lines.append(line)
+        for marker, stage in STAGES:
+            if marker in line:
+                self.stage = stage
+                break
+        grid = GRID_RE.search(line)
+        if grid:
+            nx, ny, nz = (int(n) for n in grid.groups())
+            self.points = nx * ny * nz
+            self._grid_started = time.time()
+            self.stage = 'Computing density and RDG'
+        percent = PERCENT_RE.search(line)
+        if percent and not line.lstrip().startswith('#'):
+            self.fraction = min(1.0, float(percent.group(1)) / 100.0)
+
+    def elapsed(self):
+        return time.time() - self.started
+
+    def eta(self):
+        """
+        Estimated seconds left, or None if there is no basis for a guess.
+        """
+        if self.fraction:
+            return self.elapsed() * (1.0 - self.fraction) / self.fraction
+        if self.points and self.points_per_second and self._grid_started:
+            expected = self.points / self.points_per_second
+            return max(0.0, expected - (time.time() - self._grid_started))
+
+    def finished(self):
+        """
+        Record the throughput of this run to improve later estimates.
+        """
+        if self.points and self._grid_started:
+            seconds = time.time() - self._grid_started
+            if seconds > 0:
+                ProgressTracker.points_per_second = self.points / seconds
+
+    def status(self):
+        """
+        One-line summary, e.g. 'Computing density and RDG (1.2M points,
+        42%, ETA 1m05s)'.
+        """
+        details = []
+        if self.points:
+            details.append('{:.1f}M points'.format(self.points / 1e6))
+        if self.fraction is not None:
+            details.append('{:.0f}%'.format(100 * self.fraction))
+        eta = self.eta()
+        if eta is not None:
+            details.append('ETA {}'.format(format_seconds(eta)))
+        else:
+            details.append('{} elapsed'.format(format_seconds(self.elapsed())))
+        return '{} ({})'.format(self.stage, ', '.join(details))
+
+
+def format_seconds(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    if minutes:
+        return '{}m{:02d}s'.format(minutes, seconds)
+    return '{}s'.format(seconds)
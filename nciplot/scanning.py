@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Residue deletion scanning with the promolecular engine.
+
+Promolecular fields are sums of atomic terms, so the grids of a system
+without some of its atoms (e.g. a residue, as in an alanine or deletion
+scan) are those of the full system minus their contributions. Starting
+from the `FieldState` of a full run, each group of atoms is subtracted
+only in the blocks within its cutoff radii, the descriptors are derived
+again there, and the NCI regions drawn at the RDG isovalue are compared
+before and after: the volume and integrated density lost tell how much
+each group takes part in the interactions. Groups are independent and
+the state is only read, so they are scanned in a pool of threads.
+"""
+
+from __future__ import print_function, division
+# Python stdlib
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+# Additional 3rd parties
+import numpy as np
+# Own
+from .blobs import label_blobs, DEFAULT_ISOVALUE, CLASS_THRESHOLD, KINDS
+from .promolecular import cutoff_radii
+
+
+SCAN_COLUMNS = ('voxels', 'volume', 'rho') + KINDS + ('blobs',)
+
+
+def nci_mask(rho, rdg, excluded, isovalue=DEFAULT_ISOVALUE, rho_cutoff=0.07):
+    """
+    Voxels inside the NCI isosurface, as drawn from the gradient cube
+    (check `promolecular.output_cubes`).
+    """
+    return ~excluded & (rho <= rho_cutoff) & (rdg < isovalue)
+
+
+def deletion_scan(state, groups, isovalue=DEFAULT_ISOVALUE, rho_cutoff=0.07,
+                  threshold=CLASS_THRESHOLD, block_size=16, density_threshold=1e-5,
+                  max_workers=None, chunk_size=2**21):
+    """
+    Loss of NCI regions when each group of atoms is deleted.
+
+    Parameters
+    ----------
+    state : promolecular.FieldState
+        Fields of the full system, as kept by a `promolecular.FieldCache`.
+    groups : list of sequence of int
+        Indices of the atoms deleted together, e.g. those of a residue.
+    isovalue, rho_cutoff : float, optional
+        RDG isovalue and density cutoff of the cubes delimiting the regions.
+    threshold : float, optional
+        sign(lambda2)*rho separating the interaction kinds. Check
+        `blobs.classify`.
+    block_size, density_threshold : optional
+        As used in the full run, so the same blocks and atoms are visited.
+    max_workers : int, optional
+        Groups scanned at once. Defaults to the number of CPUs.
+
+    Returns
+    -------
+    losses : dict of np.ndarray, shape=(len(groups),)
+        Keys in `SCAN_COLUMNS`, all as before minus after the deletion: the
+        number of `voxels` and the `volume` of the NCI regions, the
+        integral of rho over them in total (`rho`) and for each of the
+        `KINDS`, in atomic units, and the number of `blobs`. Blobs are
+        counted in the box around the deleted group only, so a blob
+        crossing its edge counts once, and a split blob is a negative loss.
+    """
+    cutoffs = cutoff_radii(state.numbers, density_threshold)
+    dv = float(np.prod(state.spacing))
+
+    def scan(atoms):
+        return _scan_group(state, atoms, cutoffs, isovalue, rho_cutoff, threshold, dv,
+                           block_size, chunk_size)
+
+    pool = ThreadPool(max_workers or cpu_count())
+    try:
+        rows = pool.map(scan, [np.asarray(g, dtype=int) for g in groups], chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    return dict((column, np.array([row[column] for row in rows], dtype=float))
+                for column in SCAN_COLUMNS)
+
+
+def _scan_group(state, atoms, cutoffs, isovalue, rho_cutoff, threshold, dv, block_size,
+                chunk_size):
+    """
+    `deletion_scan` of a single group of `atoms`.
+    """
+    changed = []
+    for block, rho, _, _, _, sl2rho, rdg, excluded in state.changes(
+            atoms, None, cutoffs, block_size, chunk_size=chunk_size):
+        changed.append((block, nci_mask(rho, rdg, excluded, isovalue, rho_cutoff), sl2rho))
+    losses = dict((column, 0.0) for column in SCAN_COLUMNS)
+    if not changed:
+        return losses
+    box = tuple(slice(min(c[0][i].start for c in changed), max(c[0][i].stop for c in changed))
+                for i in range(3))
+    before = nci_mask(state.rho[box], state.rdg[box], state.excluded[box], isovalue,
+                      rho_cutoff)
+    after = before.copy()
+    for block, mask, sl2rho in changed:
+        local = tuple(slice(s.start - b.start, s.stop - b.start) for (s, b) in zip(block, box))
+        old_mask = before[local].ravel()
+        old_sl2rho = state.sl2rho[block].ravel()
+        for sign, selected, values in ((1, old_mask, old_sl2rho), (-1, mask, sl2rho)):
+            values = values[selected]
+            losses['voxels'] += sign * len(values)
+            losses['rho'] += sign * np.abs(values).sum() * dv
+            kinds = np.where(values < -threshold, 0, np.where(values > threshold, 2, 1))
+            for i, kind in enumerate(KINDS):
+                losses[kind] += sign * np.abs(values[kinds == i]).sum() * dv
+        after[local] = mask.reshape(after[local].shape)
+    losses['volume'] = losses['voxels'] * dv
+    losses['blobs'] = label_blobs(before)[1] - label_blobs(after)[1]
+    return losses
+
+
+def format_scan(names, losses, columns=SCAN_COLUMNS, sep='\t', top=None):
+    """
+    Text table of `deletion_scan` results with a `names` column, sorted by
+    decreasing `rho` lost. Only the first `top` rows are kept if given.
+    """
+    order = np.argsort(-losses['rho'], kind='mergesort')[:top]
+    lines = [sep.join(('name',) + tuple(columns))]
+    for i in order:
+        lines.append(sep.join([str(names[i])] + ['{:.6g}'.format(losses[c][i])
+                                                 for c in columns]))
+    return '\n'.join(lines) + '\n'
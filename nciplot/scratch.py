@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Per-job scratch directories.
+
+Every NCIPlot job runs in a directory of its own, passed to the process
+as its working directory, so jobs never share output names nor depend on
+the working directory of the (Chimera) process. Finished directories are
+removed according to a simple policy: outputs of failed or cancelled jobs
+go away at once, while those of the last `keep` successful jobs are kept,
+since their cubes may still be in use (drawn, saved or plotted).
+
+Directories can be placed in a fast, RAM-backed `fast_root` (such as
+`/dev/shm`) instead. Each job states its expected output size (see
+`estimate_output_size`), and goes to `fast_root` only if that fits both
+the free space there and the `quota` shared by all the directories this
+instance keeps in it. Otherwise, it falls back to `root`, on disk.
+"""
+
+from __future__ import print_function, division
+# Python stdlib
+import os
+import shutil
+import tempfile
+import threading
+from collections import deque
+# Additional 3rd parties
+import numpy as np
+# Own
+from .promolecular import grid_box, BOHR
+from .xyz import read_xyz
+
+
+DEFAULT_KEEP = 4
+# Bytes written per grid point: two text cubes (~13 B per value), their
+# float32 sidecars and a generous share of `.dat` lines
+BYTES_PER_POINT = 2 * 13 + 2 * 4 + 12
+MIN_FREE = 64 * 1024 ** 2  # bytes always left free in `fast_root`
+
+
+class ScratchSpace(object):
+
+    """
+    Creates and cleans up job directories under `root`.
+
+    Parameters
+    ----------
+    root : str, optional
+        Parent of the job directories. Defaults to the system temporary
+        directory. Created if needed.
+    keep : int or None, optional
+        How many directories of successful jobs are kept once released.
+        None keeps all of them until `cleanup`.
+    fast_root : str, optional
+        Preferred parent directory, usually RAM-backed. It must exist.
+    quota : int, optional
+        Maximum bytes used in `fast_root` by this instance. Unlimited if
+        None, but the free space is always checked.
+    """
+
+    def __init__(self, root=None, keep=DEFAULT_KEEP, fast_root=None, quota=None):
+        self.root = root
+        self.keep = keep
+        self.fast_root = fast_root
+        self.quota = quota
+        self.active = set()
+        self.finished = deque()
+        self._usage = {}  # directory in fast_root -> reserved or measured bytes
+        self._lock = threading.Lock()
+
+    def create(self, prefix='nciplot_', expected_size=None):
+        """
+        New empty directory for a job. Release it with `release`.
+
+        Parameters
+        ----------
+        prefix : str, optional
+        expected_size : int, optional
+            Bytes the job is expected to write. Unknown sizes only go to
+            `fast_root` if there is no quota.
+        """
+        with self._lock:
+            fast = self._fits(expected_size)
+            root = self.fast_root if fast else (self.root or tempfile.gettempdir())
+            if not os.path.isdir(root):
+                os.makedirs(root)
+            path = tempfile.mkdtemp(prefix=prefix, dir=root)
+            self.active.add(path)
+            if fast:
+                self._usage[path] = expected_size or 0
+        return path
+
+    def is_fast(self, path):
+        return path in self._usage
+
+    def usage(self):
+        """
+        Bytes reserved or used in `fast_root` by this instance.
+        """
+        return sum(self._usage.values())
+
+    def _fits(self, expected_size):
+        if not self.fast_root or not os.path.isdir(self.fast_root):
+            return False
+        if expected_size is None:
+            return self.quota is None
+        if self.quota is not None and self.usage() + expected_size > self.quota:
+            return False
+        return free_space(self.fast_root) - expected_size >= MIN_FREE
+
+    def release(self, path, success=True):
+        """
+        Mark the job using `path` as finished. Its directory is removed
+        now if it failed, or once `keep` newer successful jobs finish.
+        """
+        with self._lock:
+            self.active.discard(path)
+            if success:
+                self.finished.append(path)
+                if path in self._usage:  # the estimate is replaced by the real size
+                    self._usage[path] = directory_size(path)
+                expired = []
+                while self.keep is not None and len(self.finished) > self.keep:
+                    expired.append(self.finished.popleft())
+            else:
+                expired = [path]
+            for directory in expired:
+                self._usage.pop(directory, None)
+        for directory in expired:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def cleanup(self):
+        """
+        Remove every directory created by this instance. Meant for exit time.
+        """
+        with self._lock:
+            paths = list(self.active) + list(self.finished)
+            self.active.clear()
+            self.finished.clear()
+            self._usage.clear()
+        for path in paths:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def free_space(path):
+    """
+    Bytes available to unprivileged users in the filesystem of `path`.
+    """
+    try:
+        stat = os.statvfs(path)
+    except (AttributeError, OSError):  # Windows, or gone
+        return 0
+    return stat.f_bavail * stat.f_frsize
+
+
+def directory_size(path):
+    size = 0
+    for parent, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                size += os.path.getsize(os.path.join(parent, filename))
+            except OSError:
+                pass
+    return size
+
+
+def estimate_output_size(xyz, ligand=None, radius=None, cube=None, increments=None,
+                         **kwargs):
+    """
+    Rough size in bytes of the files a NCIPlot run on the `xyz` files with
+    these `create_nci_input` options writes, from its number of grid points.
+    Returns None if it cannot be estimated.
+    """
+    try:
+        coords, fragments = [], []
+        for i, path in enumerate(xyz):
+            c = read_xyz(path)[1]
+            coords.append(c)
+            fragments.extend([i] * len(c))
+        coords = np.concatenate(coords) / BOHR
+        shape = grid_box(coords, np.array(fragments), ligand=ligand, radius=radius, cube=cube,
+                         increments=increments)[2]
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+    return int(np.prod(shape, dtype=float) * BYTES_PER_POINT)
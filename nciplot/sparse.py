@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Block-sparse storage of NCIPlot volumes.
+
+After the `CUTPLOT` filtering, most voxels of the gradient cube hold the
+sentinel value 100 or an RDG far above any useful isovalue. Only the
+blocks containing voxels under `threshold` (plus a one voxel margin, so
+isosurfaces are not clipped at block borders) are kept, as float32, for
+both the gradient and the density. The rest is rebuilt with fill values
+when the volume is densified, which only happens when it is drawn.
+
+On disk, a sparse volume is a single uncompressed `.npz` file.
+"""
+
+from __future__ import print_function, division
+# Additional 3rd parties
+import numpy as np
+# Own
+from .cube import Cube, COMMENTS
+
+
+DEFAULT_THRESHOLD = 0.5  # RDG, above the default isovalue (0.3)
+DEFAULT_BLOCK_SIZE = 8
+FILLS = {'grad': 100.0, 'dens': 0.0}
+
+
+class SparseVolume(object):
+
+    """
+    Gradient and density grids of a NCIPlot run, stored block-sparse.
+
+    Parameters
+    ----------
+    shape : 3-tuple of int
+        Dense grid shape, [x, y, z].
+    blocks : np.ndarray of int, shape=(B,)
+        Flat indices of the stored blocks in the grid of blocks.
+    grad, dens : np.ndarray of float32, shape=(B, b, b, b)
+        Values of the stored blocks.
+    origin, spacing : np.ndarray, shape=(3,)
+        In bohr, as in the cube files.
+    numbers, coords :
+        Atoms included in the cube headers.
+    block_size : int
+    """
+
+    def __init__(self, shape, blocks, grad, dens, origin, spacing, numbers=(), coords=(),
+                 block_size=DEFAULT_BLOCK_SIZE):
+        self.shape = tuple(int(n) for n in shape)
+        self.blocks = np.asarray(blocks, dtype=np.int64)
+        self.values = {'grad': grad, 'dens': dens}
+        self.origin = np.asarray(origin, dtype=float)
+        self.spacing = np.asarray(spacing, dtype=float)
+        self.numbers = list(numbers)
+        self.coords = np.asarray(coords, dtype=float).reshape(-1, 3)
+        self.block_size = int(block_size)
+        self._dense = {}
+
+    @classmethod
+    def from_cubes(cls, gradient, density, threshold=DEFAULT_THRESHOLD,
+                   block_size=DEFAULT_BLOCK_SIZE):
+        """
+        Build a sparse volume from the gradient and density `cube.Cube`
+        objects, keeping the blocks where the gradient is under `threshold`.
+        """
+        if gradient.data.shape != density.data.shape:
+            raise ValueError('Gradient and density cubes must have the same shape.')
+        keep = _dilate(np.asarray(gradient.data) < threshold)
+        keep = _to_blocks(keep, block_size, False).reshape(-1, block_size ** 3).any(axis=1)
+        blocks = np.flatnonzero(keep)
+        grad = _to_blocks(gradient.data, block_size, FILLS['grad'])[blocks]
+        dens = _to_blocks(density.data, block_size, FILLS['dens'])[blocks]
+        return cls(gradient.data.shape, blocks, grad, dens, gradient.origin, gradient.spacing,
+                   gradient.numbers, gradient.coords, block_size=block_size)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(f['shape'], f['blocks'], f['grad'], f['dens'], f['origin'],
+                       f['spacing'], f['numbers'], f['coords'], int(f['block_size']))
+
+    def save(self, path):
+        """
+        Write the volume as an uncompressed `.npz` file. Returns `path`.
+        """
+        with open(path, 'wb') as f:
+            np.savez(f, shape=np.array(self.shape), blocks=self.blocks,
+                     grad=self.values['grad'], dens=self.values['dens'],
+                     origin=self.origin, spacing=self.spacing,
+                     numbers=np.array(self.numbers, dtype=int), coords=self.coords,
+                     block_size=np.array(self.block_size))
+        return path
+
+    @property
+    def fraction(self):
+        """
+        Fraction of the dense grid actually stored.
+        """
+        n_blocks = np.prod([-(-n // self.block_size) for n in self.shape])
+        return len(self.blocks) / n_blocks if n_blocks else 0.0
+
+    def dense(self, which='grad'):
+        """
+        Dense float32 [x, y, z] array of `which` ('grad' or 'dens'). It is
+        built on first use and kept for later calls.
+        """
+        if which not in self._dense:
+            self._dense[which] = _from_blocks(self.values[which], self.blocks, self.shape,
+                                              self.block_size, FILLS[which])
+        return self._dense[which]
+
+    def cube(self, which='grad'):
+        """
+        Densified `cube.Cube`, ready for `core.volume_from_cube` or `write_cube`.
+        """
+        return Cube(self.dense(which), self.origin, self.spacing, self.numbers,
+                    self.coords, COMMENTS)
+
+
+def _dilate(mask):
+    """
+    Grow a boolean 3D mask by one voxel along every axis and diagonal.
+    """
+    for axis in range(3):
+        grown = mask.copy()
+        lead = [slice(None)] * 3
+        trail = [slice(None)] * 3
+        lead[axis], trail[axis] = slice(1, None), slice(None, -1)
+        grown[tuple(lead)] |= mask[tuple(trail)]
+        grown[tuple(trail)] |= mask[tuple(lead)]
+        mask = grown
+    return mask
+
+
+def _to_blocks(data, size, fill):
+    """
+    Split a [x, y, z] array in (B, size, size, size) blocks, in C order
+    of the grid of blocks, padding the borders with `fill`.
+    """
+    data = np.asarray(data)
+    counts = [-(-n // size) for n in data.shape]
+    dtype = bool if data.dtype == bool else np.float32
+    padded = np.full([c * size for c in counts], fill, dtype=dtype)
+    padded[:data.shape[0], :data.shape[1], :data.shape[2]] = data
+    blocks = padded.reshape(counts[0], size, counts[1], size, counts[2], size)
+    return blocks.transpose(0, 2, 4, 1, 3, 5).reshape(-1, size, size, size)
+
+
+def _from_blocks(values, blocks, shape, size, fill):
+    """
+    Inverse of `_to_blocks` for the selected `blocks`; missing ones get `fill`.
+    """
+    counts = [-(-n // size) for n in shape]
+    grid = np.full((int(np.prod(counts)), size, size, size), fill, dtype=np.float32)
+    grid[blocks] = values
+    grid = grid.reshape(counts[0], counts[1], counts[2], size, size, size)
+    dense = grid.transpose(0, 3, 1, 4, 2, 5).reshape([c * size for c in counts])
+    return np.ascontiguousarray(dense[:shape[0], :shape[1], :shape[2]])
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+NCI analysis along trajectories. Frames are computed in a bounded pool of
+workers, closest to the playback position first, and their cubes are
+loaded ahead of time so moving through frames does not wait on disk.
+
+This module does not depend on Chimera; `core.TrajectoryController`
+connects it to MD Movie ensembles.
+"""
+
+from __future__ import print_function, division
+# Python stdlib
+import os
+import threading
+from collections import OrderedDict
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+try:
+    from Queue import Queue, Empty
+except ImportError:  # Python 3
+    from queue import Queue, Empty
+# Own
+from .cube import load_cube
+from .promolecular import PromolecularNCI
+from .runner import run_nciplot
+from .xyz import read_xyz_frames, write_xyz
+
+
+def split_xyz_trajectory(path, directory):
+    """
+    Write each frame of a multi-frame XYZ file as a separate XYZ file.
+
+    Returns
+    -------
+    frames : OrderedDict
+        Frame number (starting at 1, like MD Movie) -> list with one XYZ path.
+    """
+    name = os.path.splitext(os.path.basename(path))[0]
+    frames = OrderedDict()
+    for i, (elements, coords) in enumerate(read_xyz_frames(path), 1):
+        frames[i] = [write_xyz(os.path.join(directory, '{}_{}.xyz'.format(name, i)),
+                               elements, coords, title='{} frame {}'.format(name, i))]
+    return frames
+
+
+def frame_calculator(engine='nciplot', binary=None):
+    """
+    Build a `compute(xyz, workdir, name, **options)` callable for the
+    selected engine, suitable for `FrameScheduler`. `xyz` is a list of paths.
+    """
+    if engine == 'promolecular':
+        def compute(xyz, workdir, name, **options):
+            return PromolecularNCI().compute(xyz, workdir=workdir, name=name, **options)
+    else:
+        def compute(xyz, workdir, name, **options):
+            return run_nciplot(binary, xyz, workdir, name=name, **options)
+    return compute
+
+
+class FrameScheduler(object):
+
+    """
+    Compute NCI grids for many frames with at most `max_workers` running
+    at once. Finished frames are pushed to `results`, a thread-safe queue
+    of (frame, data, error) tuples that the GUI can drain from its event loop.
+
+    Parameters
+    ----------
+    compute : callable
+        `compute(xyz, workdir, name, **options)` returning a `data` dict.
+    workdir : str
+        Each frame is computed in `workdir/frame_<n>`.
+    max_workers : int, optional
+        Defaults to the number of CPUs.
+    cache : cache.ResultCache, optional
+        If set, frames already computed with the same options are reused.
+    engine : str, optional
+        Engine name, used in the cache key.
+    binary : str, optional
+        NCIPlot executable, also used in the cache key.
+    """
+
+    def __init__(self, compute, workdir, max_workers=None, cache=None, engine='nciplot',
+                 binary=None):
+        self.compute = compute
+        self.workdir = workdir
+        self.cache = cache
+        self.engine = engine
+        self.binary = binary
+        self.results = Queue()
+        self.cancelled = False
+        self._pool = ThreadPool(max_workers or cpu_count())
+
+    def submit(self, frames, current=1, **options):
+        """
+        Schedule all `frames` (frame -> list of XYZ paths), closest to
+        `current` first.
+        """
+        for frame in sorted(frames, key=lambda f: (abs(f - current), f)):
+            self._pool.apply_async(self._work, (frame, frames[frame], options))
+
+    def _work(self, frame, xyz, options):
+        if self.cancelled:
+            return
+        try:
+            key = None
+            if self.cache is not None:
+                key = self.cache.key(xyz, options, engine=self.engine, binary=self.binary)
+                data = self.cache.get(key)
+                if data is not None:
+                    self.results.put((frame, data, None))
+                    return
+            workdir = os.path.join(self.workdir, 'frame_{}'.format(frame))
+            if not os.path.isdir(workdir):
+                os.makedirs(workdir)
+            data = self.compute(xyz, workdir, 'frame_{}'.format(frame), **options)
+            if key is not None:
+                data = self.cache.put(key, data)
+            self.results.put((frame, data, None))
+        except Exception as e:
+            self.results.put((frame, None, e))
+
+    def drain(self):
+        """
+        Yield the (frame, data, error) tuples available right now.
+        """
+        while True:
+            try:
+                yield self.results.get_nowait()
+            except Empty:
+                break
+
+    def cancel(self):
+        self.cancelled = True
+        self._pool.terminate()
+
+    def close(self):
+        self._pool.close()
+
+
+class CubePrefetcher(object):
+
+    """
+    Keep the parsed cubes of recently used and upcoming frames in memory.
+    Loading happens in background threads; `get` never blocks.
+
+    Parameters
+    ----------
+    capacity : int, optional, default=8
+        Maximum number of frames held in memory.
+    max_workers : int, optional, default=2
+        Threads used to read cubes.
+    loader : callable, optional
+        Function that parses a cube path, `cube.load_cube` by default.
+    """
+
+    def __init__(self, capacity=8, max_workers=2, loader=load_cube):
+        self.capacity = capacity
+        self.loader = loader
+        self._frames = OrderedDict()
+        self._loading = set()
+        self._lock = threading.Lock()
+        self._pool = ThreadPool(max_workers)
+
+    def prefetch(self, frame, data):
+        """
+        Start loading the cubes in `data` for `frame`, unless already done.
+        """
+        with self._lock:
+            if frame in self._frames or frame in self._loading:
+                return
+            self._loading.add(frame)
+        self._pool.apply_async(self._load, (frame, data))
+
+    def _load(self, frame, data):
+        try:
+            cubes = self.loader(data['grad_cube']), self.loader(data['dens_cube'])
+        except (IOError, OSError, KeyError, ValueError):
+            cubes = None
+        with self._lock:
+            self._loading.discard(frame)
+            if cubes is None:
+                return
+            self._frames[frame] = cubes
+            while len(self._frames) > self.capacity:
+                self._frames.popitem(last=False)
+
+    def get(self, frame):
+        """
+        Return the (gradient, density) cubes of `frame`, or None if they
+        are not loaded yet.
+        """
+        with self._lock:
+            cubes = self._frames.pop(frame, None)
+            if cubes is not None:
+                self._frames[frame] = cubes  # most recently used
+            return cubes
+
+    def close(self):
+        self._pool.close()
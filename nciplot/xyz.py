@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Chimera-free helpers to read and write XYZ molecule files, and to load
+simple PDB files for headless runs.
+"""
+
+from __future__ import print_function, division
+# Python stdlib
+import os
+# Additional 3rd parties
+import numpy as np
+
+
+DECIMALS = 6  # of the coordinates written by `write_xyz`
+
+
+def read_xyz(path):
+    """
+    Parse a XYZ file.
+
+    Parameters
+    ----------
+    path : str
+        Location of the XYZ file.
+
+    Returns
+    -------
+    elements : list of str
+        Element symbols, as written in the file.
+    coords : np.ndarray, shape=(N, 3)
+        Cartesian coordinates, in Angstrom.
+    """
+    with open(path) as f:
+        n_atoms = int(f.readline().split()[0])
+        f.readline()  # title
+        elements, coords = [], []
+        for _ in range(n_atoms):
+            fields = f.readline().split()
+            elements.append(fields[0])
+            coords.append([float(x) for x in fields[1:4]])
+    return elements, np.array(coords, dtype=float).reshape(-1, 3)
+
+
+def read_xyz_frames(path):
+    """
+    Iterate over the frames of a multi-frame XYZ file.
+
+    Yields
+    ------
+    elements : list of str
+    coords : np.ndarray, shape=(N, 3)
+    """
+    with open(path) as f:
+        while True:
+            header = f.readline()
+            if not header.strip():
+                return
+            n_atoms = int(header.split()[0])
+            f.readline()  # title
+            elements, coords = [], []
+            for _ in range(n_atoms):
+                fields = f.readline().split()
+                elements.append(fields[0])
+                coords.append([float(x) for x in fields[1:4]])
+            yield elements, np.array(coords, dtype=float).reshape(-1, 3)
+
+
+def write_xyz(path, elements, coords, title='', batch=4096):
+    """
+    Write elements and coordinates (Angstrom) in XYZ format.
+
+    Lines are formatted `batch` atoms at a time with a single `%`
+    operation and written in one call each, instead of once per atom.
+    Coordinates are written with `DECIMALS` decimals.
+
+    Parameters
+    ----------
+    path : str
+    elements : sequence of str
+    coords : np.ndarray, shape=(N, 3)
+    title : str, optional
+        Contents of the comment line.
+    batch : int, optional
+        Number of atoms formatted at once.
+    """
+    coords = np.asarray(coords, dtype=float).reshape(-1, 3)
+    if len(elements) != len(coords):
+        raise ValueError('Got {} elements for {} coordinates.'.format(len(elements),
+                                                                      len(coords)))
+    line = '%s' + ' %.{}f'.format(DECIMALS) * 3 + '\n'
+    rows = np.empty((len(coords), 4), dtype=object)
+    rows[:, 0] = list(elements)
+    rows[:, 1:] = coords
+    with open(path, 'w') as f:
+        f.write('{}\n{}\n'.format(len(coords), title))
+        for start in range(0, len(rows), batch):
+            chunk = rows[start:start + batch]
+            f.write((line * len(chunk)) % tuple(chunk.ravel()))
+    return path
+
+
+def read_pdb(path):
+    """
+    Parse ATOM and HETATM records of a PDB file. Elements are taken from
+    columns 77-78, or guessed from the atom name if those are empty.
+
+    Returns
+    -------
+    elements : list of str
+    coords : np.ndarray, shape=(N, 3)
+    """
+    elements, coords = [], []
+    with open(path) as f:
+        for line in f:
+            if line.startswith('ENDMDL'):
+                break
+            if not line.startswith(('ATOM', 'HETATM')):
+                continue
+            element = line[76:78].strip()
+            if not element:
+                element = ''.join(c for c in line[12:16] if c.isalpha())[:1]
+            elements.append(element.capitalize())
+            coords.append([float(line[30:38]), float(line[38:46]), float(line[46:54])])
+    return elements, np.array(coords, dtype=float).reshape(-1, 3)
+
+
+def read_structure(path):
+    """
+    Read a XYZ or PDB file, depending on its extension.
+    """
+    if os.path.splitext(path)[1].lower() in ('.pdb', '.ent'):
+        return read_pdb(path)
+    return read_xyz(path)
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Shared fixtures: a water dimer, small enough to compare the promolecular
+engine against brute force and full recomputations on coarse grids.
+"""
+
+from __future__ import print_function, division
+# Additional 3rd parties
+import numpy as np
+import pytest
+# Own
+from nciplot.xyz import write_xyz
+
+
+WATER = np.array([[0.0, 0.0, 0.0], [0.96, 0.0, 0.0], [-0.24, 0.93, 0.0]])  # Angstrom
+SHIFT = np.array([2.9, 0.3, 0.2])
+
+
+@pytest.fixture
+def water():
+    """
+    Elements and coordinates (Angstrom) of the two molecules of the dimer.
+    """
+    return [(['O', 'H', 'H'], WATER.copy()), (['O', 'H', 'H'], WATER + SHIFT)]
+
+
+@pytest.fixture
+def dimer(tmp_path, water):
+    """
+    Paths of the two molecules of the dimer, as xyz files.
+    """
+    return [write_xyz(str(tmp_path / 'w{}.xyz'.format(i + 1)), elements, coords)
+            for i, (elements, coords) in enumerate(water)]
+
+
+@pytest.fixture
+def box(water):
+    """
+    `cube` search option (Angstrom) around the dimer, so that runs of
+    moved or deleted atoms share the lattice of the full one.
+    """
+    coords = np.concatenate([c for _, c in water])
+    return tuple(coords.min(axis=0) - 2.0) + tuple(coords.max(axis=0) + 2.0)
+
+
+@pytest.fixture
+def options():
+    """
+    Search options of the dimer runs: a coarse grid and the
+    intermolecular filter, so fragments matter.
+    """
+    return dict(intermolecular=0.95, increments=(0.25, 0.25, 0.25))
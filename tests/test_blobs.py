@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+from __future__ import print_function, division
+# Additional 3rd parties
+import numpy as np
+# Own
+from nciplot.blobs import (label_blobs, classify, blob_table, summarize, format_table,
+                           nearest_atoms, BLOB_COLUMNS, DENSITY_SCALE, KINDS)
+from nciplot.cube import Cube, COMMENTS
+from nciplot.promolecular import PromolecularNCI, BOHR, output_cubes
+
+
+def flood_fill_count(mask):
+    """
+    Reference count of face-connected components, by breadth-first search.
+    """
+    seen = np.zeros(mask.shape, dtype=bool)
+    count = 0
+    for start in map(tuple, np.argwhere(mask)):
+        if seen[start]:
+            continue
+        count += 1
+        seen[start] = True
+        queue = [start]
+        while queue:
+            voxel = queue.pop()
+            for axis in range(3):
+                for step in (-1, 1):
+                    n = list(voxel)
+                    n[axis] += step
+                    n = tuple(n)
+                    if (0 <= n[axis] < mask.shape[axis]) and mask[n] and not seen[n]:
+                        seen[n] = True
+                        queue.append(n)
+    return count
+
+
+def test_label_blobs_matches_flood_fill():
+    rng = np.random.RandomState(0)
+    for density in (0.2, 0.3, 0.5):
+        mask = rng.uniform(size=(12, 10, 8)) < density
+        labels, n = label_blobs(mask)
+        assert n == flood_fill_count(mask)
+        assert ((labels > 0) == mask).all()
+        assert set(np.unique(labels[mask])) == set(range(1, n + 1))
+        # components are ordered by their first voxel
+        firsts = [np.flatnonzero(labels.ravel() == i)[0] for i in range(1, n + 1)]
+        assert firsts == sorted(firsts)
+
+
+def test_label_blobs_ignores_diagonals():
+    mask = np.zeros((3, 3, 3), dtype=bool)
+    mask[0, 0, 0] = mask[1, 1, 0] = mask[2, 2, 2] = True
+    assert label_blobs(mask)[1] == 3
+    assert label_blobs(np.zeros((2, 2, 2)))[1] == 0
+
+
+def test_classify():
+    assert classify(-0.03) == 'attractive'
+    assert classify(0.0) == 'vdw'
+    assert classify(0.03) == 'repulsive'
+
+
+def synthetic_cubes():
+    """
+    Two spherical regions under the isovalue, an attractive one of radius
+    3 voxels and a repulsive one of radius 2.
+    """
+    shape = (20, 12, 12)
+    index = np.indices(shape).transpose(1, 2, 3, 0)
+    rdg = np.full(shape, 100.0)
+    dens = np.zeros(shape)
+    for center, radius, value in (((5, 6, 6), 3, -0.02), ((15, 6, 6), 2, 0.03)):
+        r = np.sqrt(((index - center) ** 2).sum(axis=-1))
+        inside = r <= radius
+        rdg[inside] = 0.1 * r[inside] / radius
+        dens[inside] = value * DENSITY_SCALE
+    origin, spacing = np.zeros(3), np.full(3, 0.5)
+    coords = np.array([[2.5, 3.0, 3.0], [7.5, 3.0, 3.0], [9.5, 5.5, 5.5]])
+    header = origin, spacing, [1, 1, 1], coords, COMMENTS
+    return Cube(rdg, *header), Cube(dens, *header)
+
+
+def test_blob_table_on_synthetic_regions():
+    gradient, density = synthetic_cubes()
+    rows = blob_table(gradient, density, isovalue=0.3)
+    assert [row['kind'] for row in rows] == ['attractive', 'repulsive']
+    assert [row['voxels'] for row in rows] == [
+        int((gradient.data[:10] < 0.3).sum()), int((gradient.data[10:] < 0.3).sum())]
+    big, small = rows
+    np.testing.assert_allclose(big['volume'], big['voxels'] * 0.125)
+    np.testing.assert_allclose(big['rho^1'], big['voxels'] * 0.02 * 0.125)
+    np.testing.assert_allclose(big['rho^2'], big['voxels'] * 0.02 ** 2 * 0.125)
+    np.testing.assert_allclose([big['x'], big['y'], big['z']],
+                               np.array([2.5, 3.0, 3.0]) * BOHR)
+    assert big['rdg_min'] == 0 and big['sign_rho'] == -0.02
+    assert big['atoms'] == [0, 1] and big['distances'][0] == 0
+    assert small['atoms'][0] == 1
+    assert blob_table(gradient, density, isovalue=0.3, min_voxels=big['voxels']) == [big]
+    assert blob_table(gradient, density, isovalue=0.0) == []
+
+
+def test_summarize_and_format():
+    gradient, density = synthetic_cubes()
+    rows = blob_table(gradient, density)
+    summary = summarize(rows)
+    assert [summary[kind] for kind in KINDS] == [1, 0, 1]
+    np.testing.assert_allclose(summary['attractive_rho'], rows[0]['rho^1'])
+    assert summary['vdw_rho'] == 0
+    lines = format_table(rows).splitlines()
+    assert lines[0].split('\t') == list(BLOB_COLUMNS)
+    assert len(lines) == 3 and lines[1].split('\t')[1] == 'attractive'
+
+
+def test_nearest_atoms_matches_brute_force():
+    rng = np.random.RandomState(1)
+    points, coords = rng.uniform(0, 10, (500, 3)), rng.uniform(0, 10, (30, 3))
+    atoms, distances = nearest_atoms(points, coords, n=3, chunk_size=1000)
+    best = np.sqrt(((points[:, None] - coords[None]) ** 2).sum(axis=2)).min(axis=0)
+    assert atoms == list(np.argsort(best)[:3])
+    np.testing.assert_allclose(distances, np.sort(best)[:3])
+
+
+def test_dimer_blobs_cover_the_nci_regions(dimer, options):
+    gradient, density = output_cubes(PromolecularNCI().compute_grids(dimer, **options))
+    rows = blob_table(gradient, density)
+    inside = gradient.data < 0.3
+    assert rows and sum(row['voxels'] for row in rows) == inside.sum()
+    dv = np.prod(gradient.spacing)
+    np.testing.assert_allclose(sum(row['rho^1'] for row in rows),
+                               np.abs(density.data[inside]).sum() / DENSITY_SCALE * dv)
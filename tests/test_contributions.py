@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+from __future__ import print_function, division
+# Additional 3rd parties
+import numpy as np
+import pytest
+# Own
+from nciplot.blobs import DENSITY_SCALE, KINDS
+from nciplot.contributions import (atom_contributions, group_contributions,
+                                   contribution_colors, format_contributions,
+                                   CONTRIBUTION_COLUMNS)
+from nciplot.promolecular import PromolecularNCI, brute_force_nearest, output_cubes
+
+
+@pytest.fixture
+def cubes(dimer, options):
+    return output_cubes(PromolecularNCI().compute_grids(dimer, **options))
+
+
+@pytest.mark.parametrize('n_nearest', [1, 2])
+def test_atom_contributions_match_brute_force(cubes, n_nearest):
+    gradient, density = cubes
+    contributions = atom_contributions(gradient, density, n_nearest=n_nearest,
+                                       batch_size=1000)
+    inside = np.argwhere(gradient.data < 0.3)
+    assert len(inside)
+    points = inside * gradient.spacing + gradient.origin
+    atoms, _ = brute_force_nearest(points, gradient.coords, n_nearest)
+    rho = np.abs(density.data[tuple(inside.T)]) / DENSITY_SCALE * np.prod(gradient.spacing)
+    n = len(gradient.coords)
+    expected = np.bincount(atoms.ravel(), weights=np.repeat(rho / n_nearest, n_nearest),
+                           minlength=n)
+    np.testing.assert_allclose(contributions['rho'], expected, rtol=1e-6)
+    np.testing.assert_allclose(contributions['voxels'].sum(), len(inside))
+    np.testing.assert_allclose(sum(contributions[kind] for kind in KINDS),
+                               contributions['rho'], rtol=1e-10)
+
+
+def test_group_contributions(cubes):
+    contributions = atom_contributions(*cubes)
+    groups = group_contributions(contributions, [0, 0, 0, 1, 1, 1])
+    assert sorted(groups) == sorted(CONTRIBUTION_COLUMNS)
+    for column in CONTRIBUTION_COLUMNS:
+        np.testing.assert_allclose(groups[column], [contributions[column][:3].sum(),
+                                                    contributions[column][3:].sum()])
+
+
+def test_colors_and_table():
+    contributions = dict((column, np.zeros(3)) for column in CONTRIBUTION_COLUMNS)
+    contributions['rho'][:] = contributions['attractive'][:] = [2.0, 1.0, 0.0]
+    colors = contribution_colors(contributions)
+    np.testing.assert_allclose(colors, [[0, 0, 1, 1], [0.5, 0.5, 1, 1], [1, 1, 1, 1]])
+    lines = format_contributions(['a', 'b', 'c'], contributions).splitlines()
+    assert [line.split('\t')[0] for line in lines] == ['name', 'a', 'b']
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+from __future__ import print_function, division
+# Python stdlib
+import os
+# Additional 3rd parties
+import numpy as np
+import pytest
+# Own
+from nciplot.cube import (read_cube, write_cube, load_cube, volume_order, stitch_cubes,
+                          sidecar_path, fresh_sidecar)
+
+
+@pytest.fixture
+def values():
+    rng = np.random.RandomState(0)
+    return rng.uniform(-1, 1, (5, 4, 7))  # nz is not a multiple of six
+
+
+def test_write_read_roundtrip(tmp_path, values):
+    path = str(tmp_path / 'a.cube')
+    coords = np.array([[0.0, 0.0, 0.0], [1.5, -0.5, 2.0]])
+    write_cube(path, values, (-1.0, 0.5, 2.0), (0.2, 0.3, 0.4), [8, 1], coords)
+    cube = read_cube(path)
+    np.testing.assert_allclose(cube.data, values, rtol=1e-5)
+    np.testing.assert_allclose(cube.origin, (-1.0, 0.5, 2.0))
+    np.testing.assert_allclose(cube.spacing, (0.2, 0.3, 0.4))
+    assert cube.numbers == [8, 1]
+    np.testing.assert_allclose(cube.coords, coords)
+
+
+def test_load_cube_uses_fresh_sidecars_only(tmp_path, values):
+    path = str(tmp_path / 'a.cube')
+    write_cube(path, values, (0, 0, 0), (0.2, 0.2, 0.2))
+    first = load_cube(path)
+    assert os.path.isfile(sidecar_path(path)) and fresh_sidecar(path)
+    assert first.data.dtype == np.float32 and first.data.transpose(2, 1, 0).flags['C_CONTIGUOUS']
+    cached = load_cube(path)
+    assert isinstance(cached.data.base, np.memmap) or not cached.data.flags['WRITEABLE']
+    np.testing.assert_array_equal(cached.data, first.data)
+    # rewritten with the same shape: the stale sidecar must not be used
+    write_cube(path, -values, (0, 0, 0), (0.2, 0.2, 0.2))
+    os.utime(path, (os.stat(path).st_atime, os.stat(path).st_mtime + 10))
+    assert not fresh_sidecar(path)
+    np.testing.assert_allclose(load_cube(path).data, -values, rtol=1e-5)
+    assert fresh_sidecar(path)
+
+
+def test_load_cube_without_sidecar(tmp_path, values):
+    path = str(tmp_path / 'a.cube')
+    write_cube(path, values, (0, 0, 0), (0.2, 0.2, 0.2))
+    np.testing.assert_allclose(load_cube(path, sidecar=False).data, values, rtol=1e-5)
+    assert not os.path.exists(sidecar_path(path))
+
+
+def test_volume_order_keeps_ordered_cubes(tmp_path, values):
+    path = str(tmp_path / 'a.cube')
+    write_cube(path, values, (0, 0, 0), (0.2, 0.2, 0.2))
+    ordered = volume_order(read_cube(path))
+    assert volume_order(ordered) is ordered
+
+
+def test_stitch_cubes(tmp_path, values):
+    paths = [str(tmp_path / 'a.cube'), str(tmp_path / 'b.cube')]
+    write_cube(paths[0], values[:3], (0, 0, 0), (0.2, 0.2, 0.2))
+    write_cube(paths[1], values[2:], (0.4, 0, 0), (0.2, 0.2, 0.2))
+    stitched = stitch_cubes([read_cube(p) for p in paths])
+    np.testing.assert_allclose(stitched.data, values, rtol=1e-5)
+    np.testing.assert_allclose(stitched.origin, 0)
+    write_cube(paths[1], values, (0, 0, 0), (0.1, 0.2, 0.2))
+    with pytest.raises(ValueError):
+        stitch_cubes([read_cube(p) for p in paths])
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+from __future__ import print_function, division
+# Additional 3rd parties
+import numpy as np
+import pytest
+# Own
+from nciplot.promolecular import (PromolecularNCI, FieldCache, CellList, BOHR, evaluate,
+                                  atomic_numbers, cutoff_radii, brute_force_nearest,
+                                  pack_hessian, unpack_hessian, grid_box)
+from nciplot.xyz import write_xyz
+
+
+def assert_same_grids(a, b):
+    """
+    Compare two `NCIGrids` voxel by voxel. RDG is only compared where
+    there is density, as it diverges in the void.
+    """
+    assert a.rho.shape == b.rho.shape
+    np.testing.assert_allclose(a.origin, b.origin)
+    np.testing.assert_allclose(a.rho, b.rho, rtol=1e-8, atol=1e-14)
+    np.testing.assert_allclose(a.sl2rho, b.sl2rho, rtol=1e-8, atol=1e-14)
+    dense = b.rho > 1e-6
+    np.testing.assert_allclose(a.rdg[dense], b.rdg[dense], rtol=1e-6)
+    assert (a.excluded == b.excluded).all()
+
+
+@pytest.fixture
+def atoms(water):
+    elements = sum([e for e, _ in water], [])
+    coords = np.concatenate([c for _, c in water]) / BOHR
+    return coords, atomic_numbers(elements), np.repeat([0, 1], 3)
+
+
+def test_derivatives_match_finite_differences(atoms):
+    coords, numbers, fragments = atoms
+    rng = np.random.RandomState(0)
+    points = coords[rng.randint(len(coords), size=20)] + rng.uniform(-2, 2, (20, 3))
+    rho, grad, hess, rho_fragments = evaluate(points, coords, numbers, fragments, 2)
+    np.testing.assert_allclose(rho_fragments.sum(axis=1), rho)
+    h = 1e-4
+    for axis in range(3):
+        step = np.zeros(3)
+        step[axis] = h
+        rho_p, grad_p, _, _ = evaluate(points + step, coords, numbers)
+        rho_m, grad_m, _, _ = evaluate(points - step, coords, numbers)
+        np.testing.assert_allclose(grad[:, axis], (rho_p - rho_m) / (2 * h),
+                                   rtol=1e-5, atol=1e-9)
+        np.testing.assert_allclose(hess[:, :, axis], (grad_p - grad_m) / (2 * h),
+                                   rtol=1e-5, atol=1e-8)
+
+
+def test_hessian_packing_roundtrip(atoms):
+    coords, numbers, _ = atoms
+    _, _, hess, _ = evaluate(coords + 0.3, coords, numbers)
+    np.testing.assert_allclose(unpack_hessian(pack_hessian(hess)), hess, rtol=1e-14)
+
+
+def test_query_box_matches_brute_force():
+    rng = np.random.RandomState(1)
+    coords = rng.uniform(0, 30, (300, 3))
+    radii = rng.uniform(1, 6, 300)
+    cells = CellList(coords, radii.max())
+    for _ in range(50):
+        lo = rng.uniform(-5, 30, 3)
+        hi = lo + rng.uniform(0, 8, 3)
+        gap = np.maximum(np.maximum(lo - coords, coords - hi), 0)
+        expected = np.flatnonzero((gap * gap).sum(axis=1) <= radii ** 2)
+        np.testing.assert_array_equal(cells.query_box(lo, hi, radii), expected)
+
+
+@pytest.mark.parametrize('k', [1, 3])
+def test_nearest_matches_brute_force(k):
+    rng = np.random.RandomState(2)
+    coords = rng.uniform(0, 30, (200, 3))
+    points = rng.uniform(-10, 40, (2000, 3))  # also far outside the cells
+    indices, distances = CellList(coords, 4.0).nearest(points, k)
+    expected, expected_distances = brute_force_nearest(points, coords, k)
+    np.testing.assert_allclose(distances, expected_distances)
+    np.testing.assert_array_equal(indices, expected)
+
+
+def test_nearest_with_less_atoms_than_k():
+    coords = np.array([[0.0, 0.0, 0.0], [3.0, 0.0, 0.0]])
+    indices, _ = CellList(coords, 4.0).nearest(np.array([[1.0, 0.0, 0.0]]), 3)
+    np.testing.assert_array_equal(indices, [[0, 1, -1]])
+
+
+def test_blocks_match_a_single_block(dimer, options):
+    # with a negligible density threshold, no atom is left out of any block
+    blocked = PromolecularNCI(block_size=8, density_threshold=1e-30).compute_grids(
+        dimer, **options)
+    single = PromolecularNCI(block_size=1000, density_threshold=1e-30).compute_grids(
+        dimer, **options)
+    assert_same_grids(blocked, single)
+    assert blocked.evaluated == single.evaluated == single.rho.size
+
+
+def test_density_cutoff_is_negligible(dimer, options, atoms):
+    coords, numbers, _ = atoms
+    grids = PromolecularNCI(block_size=8, density_threshold=1e-5).compute_grids(dimer, **options)
+    points = grids.origin + grids.spacing * np.argwhere(np.ones(grids.rho.shape, dtype=bool))
+    rho, _, _, _ = evaluate(points, coords, numbers)
+    np.testing.assert_allclose(grids.rho.ravel(), rho, atol=1e-5 * len(numbers))
+    assert (cutoff_radii(numbers, 1e-5) > cutoff_radii(numbers, 1e-3)).all()
+
+
+def test_incremental_update_matches_full_run(tmp_path, water, dimer, box, options):
+    engine = PromolecularNCI(block_size=8, fields=FieldCache())
+    first = engine.compute_grids(dimer, cube=box, **options)
+    assert engine.state is not None
+    before = first.rho.copy()
+    elements, coords = water[1]
+    coords[1] += [0.15, -0.1, 0.05]  # a single hydrogen
+    moved = [dimer[0], write_xyz(str(tmp_path / 'moved.xyz'), elements, coords)]
+    updated = engine.compute_grids(moved, cube=box, **options)
+    assert 0 < updated.evaluated < updated.rho.size
+    assert not np.array_equal(updated.rho, before)
+    full = PromolecularNCI(block_size=8).compute_grids(moved, cube=box, **options)
+    assert_same_grids(updated, full)
+
+
+def test_too_many_moved_atoms_run_in_full(tmp_path, water, dimer, box, options):
+    engine = PromolecularNCI(block_size=8, fields=FieldCache(max_moved=0.25))
+    engine.compute_grids(dimer, cube=box, **options)
+    elements, coords = water[1]
+    moved = [dimer[0], write_xyz(str(tmp_path / 'moved.xyz'), elements, coords + 0.1)]
+    grids = engine.compute_grids(moved, cube=box, **options)
+    assert grids.evaluated == PromolecularNCI(block_size=8).compute_grids(
+        moved, cube=box, **options).evaluated
+
+
+def test_field_cache_budget(dimer, box, options):
+    fields = FieldCache()
+    engine = PromolecularNCI(fields=fields)
+    grids = engine.compute_grids(dimer, cube=box, **options)
+    assert 0 < fields.size() <= fields.max_bytes
+    fields.resize(fields.size() - 1)
+    assert engine.state is None and not fields.size()
+    small = FieldCache(max_bytes=grids.rho.size)  # far less than a state
+    engine = PromolecularNCI(fields=small)
+    engine.compute_grids(dimer, cube=box, **options)
+    assert engine.state is None
+
+
+def test_adaptive_grid_evaluates_less_and_keeps_refined_values(dimer, options):
+    full = PromolecularNCI().compute_grids(dimer, **options)
+    adaptive = PromolecularNCI().compute_grids(dimer, adaptive=4, **options)
+    assert adaptive.evaluated <= full.evaluated
+    refined = ~adaptive.excluded
+    assert refined.any()
+    np.testing.assert_allclose(adaptive.rho[refined], full.rho[refined], rtol=1e-12)
+    np.testing.assert_allclose(adaptive.rdg[refined], full.rdg[refined], rtol=1e-12)
+    nci = lambda g: ~g.excluded & (g.rdg < 0.3) & (g.rho < 0.07)
+    assert nci(full).any()
+    assert (nci(adaptive) == nci(full)).all()
+
+
+def test_grid_box_follows_search_options(atoms):
+    coords, _, fragments = atoms
+    origin, spacing, shape = grid_box(coords, fragments, cube=(0, 0, 0, 1, 2, 3),
+                                      increments=(0.5, 0.5, 0.5))
+    np.testing.assert_allclose(origin, 0)
+    np.testing.assert_allclose(spacing, 0.5 / BOHR)
+    assert shape == (3, 5, 7)
+    origin, _, shape = grid_box(coords, fragments, ligand=(2, 1.0), increments=(0.5,) * 3)
+    np.testing.assert_allclose(origin, coords[3:].min(axis=0) - 1.0 / BOHR)
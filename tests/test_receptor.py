@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+from __future__ import print_function, division
+# Python stdlib
+import os
+# Additional 3rd parties
+import numpy as np
+# Own
+from nciplot.promolecular import PromolecularNCI, BOHR
+from nciplot.receptor import receptor_grid, receptor_grids, evict_receptor_grids
+
+
+def test_pose_grids_match_full_run(tmp_path, water, dimer, box, options):
+    elements, coords = water[0]
+    # with a negligible density threshold, both runs see every atom everywhere
+    grid = receptor_grid(elements, coords, cube=box, increments=options['increments'],
+                         root=str(tmp_path / 'receptors'), block_size=8,
+                         density_threshold=1e-30)
+    engine = PromolecularNCI(receptor=grid, padding=2.0, density_threshold=1e-30)
+    pose = engine.compute_grids(dimer[1:], intermolecular=options['intermolecular'])
+    hi = pose.origin + pose.spacing * (np.array(pose.rho.shape) - 1)
+    full = PromolecularNCI(density_threshold=1e-30).compute_grids(
+        dimer, cube=tuple(pose.origin * BOHR) + tuple(hi * BOHR), **options)
+    assert full.rho.shape == pose.rho.shape
+    np.testing.assert_allclose(full.origin, pose.origin)
+    np.testing.assert_allclose(pose.rho, full.rho, rtol=1e-10, atol=1e-14)
+    np.testing.assert_allclose(pose.sl2rho, full.sl2rho, rtol=1e-10, atol=1e-14)
+    dense = full.rho > 1e-6
+    np.testing.assert_allclose(pose.rdg[dense], full.rdg[dense], rtol=1e-8)
+    assert (pose.excluded == full.excluded).all()
+    assert (~pose.excluded).any()
+    # the receptor was only evaluated around the ligand
+    assert not grid.filled.all()
+
+
+def test_receptor_grid_is_reused(tmp_path, water, box):
+    elements, coords = water[0]
+    root = str(tmp_path / 'receptors')
+    grid = receptor_grid(elements, coords, cube=box, increments=(0.5,) * 3, root=root)
+    assert grid.fill() > 0
+    again = receptor_grid(elements, coords, cube=box, increments=(0.5,) * 3, root=root)
+    assert again.directory == grid.directory
+    assert again.fill() == 0
+    np.testing.assert_array_equal(np.asarray(again.rho), np.asarray(grid.rho))
+    other = receptor_grid(elements, coords + 0.1, cube=box, increments=(0.5,) * 3, root=root)
+    assert other.directory != grid.directory
+
+
+def test_least_recently_used_grids_are_evicted(tmp_path, water, box):
+    elements, coords = water[0]
+    root = str(tmp_path / 'receptors')
+    keys = []
+    for i in range(3):
+        grid = receptor_grid(elements, coords + i, cube=box, increments=(0.5,) * 3, root=root)
+        grid.fill()
+        header = os.path.join(grid.directory, 'header.json')
+        os.utime(header, (1000 + i, 1000 + i))  # distinct use times
+        keys.append(os.path.basename(grid.directory))
+    entries = receptor_grids(root)
+    assert [key for _, _, key in entries] == keys
+    largest = max(size for _, size, _ in entries)
+    evict_receptor_grids(root, max_size=largest, keep=keys[0])
+    assert [key for _, _, key in receptor_grids(root)] == [keys[0]]
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+from __future__ import print_function, division
+# Additional 3rd parties
+import numpy as np
+# Own
+from nciplot.blobs import KINDS, CLASS_THRESHOLD
+from nciplot.promolecular import PromolecularNCI, FieldCache
+from nciplot.scanning import deletion_scan, nci_mask, format_scan, SCAN_COLUMNS
+from nciplot.xyz import write_xyz
+
+
+def test_deletion_scan_matches_rerun(tmp_path, water, dimer, box, options):
+    engine = PromolecularNCI(fields=FieldCache())
+    full = engine.compute_grids(dimer, cube=box, **options)
+    groups = [[0], [4], [1, 5]]  # an oxygen, a hydrogen, one of each molecule
+    losses = deletion_scan(engine.state, groups, max_workers=2)
+    assert sorted(losses) == sorted(SCAN_COLUMNS)
+    before = nci_mask(full.rho, full.rdg, full.excluded)
+    assert before.any()
+    dv = np.prod(full.spacing)
+    for i, group in enumerate(groups):
+        paths = []
+        for j, (elements, coords) in enumerate(water):
+            keep = [k for k in range(3) if 3 * j + k not in group]
+            paths.append(write_xyz(str(tmp_path / 'deleted{}.xyz'.format(j)),
+                                   [elements[k] for k in keep], coords[keep]))
+        ref = PromolecularNCI().compute_grids(paths, cube=box, **options)
+        after = nci_mask(ref.rho, ref.rdg, ref.excluded)
+        assert losses['voxels'][i] == before.sum() - after.sum()
+        np.testing.assert_allclose(losses['volume'][i], losses['voxels'][i] * dv)
+        old, new = full.sl2rho[before], ref.sl2rho[after]
+        np.testing.assert_allclose(losses['rho'][i],
+                                   (np.abs(old).sum() - np.abs(new).sum()) * dv,
+                                   rtol=1e-6, atol=1e-12)
+        for kind, select in zip(KINDS, (lambda v: v < -CLASS_THRESHOLD,
+                                        lambda v: np.abs(v) <= CLASS_THRESHOLD,
+                                        lambda v: v > CLASS_THRESHOLD)):
+            expected = (np.abs(old[select(old)]).sum() - np.abs(new[select(new)]).sum()) * dv
+            np.testing.assert_allclose(losses[kind][i], expected, rtol=1e-6, atol=1e-12)
+    # the state is only read
+    np.testing.assert_array_equal(engine.state.rho, full.rho)
+
+
+def test_groups_far_from_the_grid_lose_nothing(dimer, options):
+    engine = PromolecularNCI(fields=FieldCache())
+    engine.compute_grids(dimer, **options)
+    losses = deletion_scan(engine.state, [[]])
+    assert all(losses[column][0] == 0 for column in SCAN_COLUMNS)
+
+
+def test_format_scan_sorts_by_rho():
+    losses = dict((column, np.array([1.0, 3.0, 2.0])) for column in SCAN_COLUMNS)
+    lines = format_scan(['a', 'b', 'c'], losses, top=2).splitlines()
+    assert lines[0].split('\t') == ['name'] + list(SCAN_COLUMNS)
+    assert [line.split('\t')[0] for line in lines[1:]] == ['b', 'c']
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+from __future__ import print_function, division
+# Additional 3rd parties
+import numpy as np
+import pytest
+# Own
+from nciplot.promolecular import PromolecularNCI, output_cubes
+from nciplot.sparse import SparseVolume, DEFAULT_THRESHOLD, FILLS
+
+
+@pytest.fixture
+def cubes(dimer, options):
+    return output_cubes(PromolecularNCI().compute_grids(dimer, **options))
+
+
+@pytest.mark.parametrize('block_size', [4, 8])
+def test_dense_keeps_the_voxels_under_threshold(tmp_path, cubes, block_size):
+    gradient, density = cubes
+    volume = SparseVolume.from_cubes(gradient, density, block_size=block_size)
+    assert 0 < volume.fraction < 1
+    loaded = SparseVolume.load(volume.save(str(tmp_path / 'volume.npz')))
+    assert loaded.shape == gradient.data.shape and loaded.block_size == block_size
+    np.testing.assert_allclose(loaded.origin, gradient.origin)
+    np.testing.assert_allclose(loaded.coords, gradient.coords)
+    grad, dens = loaded.dense('grad'), loaded.dense('dens')
+    assert grad.shape == dens.shape == gradient.data.shape
+    counts = [-(-n // block_size) for n in loaded.shape]
+    stored = np.zeros(int(np.prod(counts)), dtype=bool)
+    stored[loaded.blocks] = True
+    stored = stored.reshape(counts)
+    for axis in range(3):
+        stored = stored.repeat(block_size, axis=axis)
+    stored = stored[tuple(slice(0, n) for n in loaded.shape)]
+    # every voxel under the threshold, and its neighbours, are kept exactly
+    under = gradient.data < DEFAULT_THRESHOLD
+    assert under.any() and stored[under].all()
+    assert stored[1:][under[:-1]].all() and stored[:-1][under[1:]].all()
+    np.testing.assert_allclose(grad[stored], gradient.data[stored], rtol=1e-6)
+    np.testing.assert_allclose(dens[stored], density.data[stored], rtol=1e-6, atol=1e-6)
+    assert (grad[~stored] == FILLS['grad']).all() and (dens[~stored] == FILLS['dens']).all()
+    np.testing.assert_array_equal(loaded.cube('dens').data, dens)
+
+
+def test_empty_volume(cubes):
+    gradient, density = cubes
+    volume = SparseVolume.from_cubes(gradient, density, threshold=0.0)
+    assert volume.fraction == 0
+    assert (volume.dense('grad') == FILLS['grad']).all()
+
+
+def test_shapes_must_match(cubes):
+    gradient, density = cubes
+    with pytest.raises(ValueError):
+        SparseVolume.from_cubes(gradient, density._replace(data=density.data[1:]))